@@ -0,0 +1,261 @@
+"""Micro-benchmarks for the hot path of the flight loop.
+
+Times each stage of FlightController.loop and a whole loop iteration against
+in-memory fake sensor and ESC backends, so the results only depend on the
+flight code and the CPU. Run on the drone for numbers that matter.
+
+Save a baseline with
+    python -m drone.benchmarks.control_loop --save baseline.json
+and later check for regressions with
+    python -m drone.benchmarks.control_loop --compare baseline.json
+which exits with status 1 if a stage got slower than the threshold allows.
+"""
+import argparse
+import json
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+
+from drone.flight_controller.command_channel import CommandChannel
+from drone.flight_controller.esc import ESCGroup
+from drone.flight_controller.flight_controller import FlightController
+from drone.flight_controller.imu import IMU
+from drone.flight_controller.metrics import IMU_READ, LoopMetrics
+from drone.flight_controller.mpu6050 import MPU6050
+from drone.flight_controller.pid import PID, MultiAxisPID
+from drone.flight_controller.telemetry import TelemetryChannel
+from drone.flight_controller.watchdog import WatchdogChannel
+
+
+class _StaticI2CBus:
+    """i2c bus that cycles through a few fixed MPU6050 samples."""
+
+    def __init__(self):
+        self._samples = [list(struct.pack(">7h", ax, ay, -16384, 1700,
+                                          gx, gy, 40))
+                         for ax, ay, gx, gy in [(120, -80, 30, -20),
+                                                (-60, 150, -45, 10),
+                                                (90, 40, 5, 60)]]
+        self._index = 0
+
+    def write_byte_data(self, address, register, value):
+        pass
+
+    def read_i2c_block_data(self, address, register, length):
+        self._index = (self._index + 1) % len(self._samples)
+        return self._samples[self._index][:length]
+
+
+class _NullPigpio:
+    """pigpio connection that discards everything."""
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        pass
+
+    def store_script(self, script):
+        return 0
+
+    def script_status(self, script_id):
+        return 1, []
+
+    def run_script(self, script_id, params):
+        return 0
+
+
+def _create_flight_controller(telemetry):
+    imu = IMU(mpu6050=MPU6050(_StaticI2CBus()))
+    imu.calibrate(n=100)
+    imu.update_orientation()
+    flight_controller = FlightController(telemetry=telemetry)
+    flight_controller.setup(imu=imu, escs=ESCGroup([13, 12, 24, 18],
+                                                   pi=_NullPigpio()))
+    return flight_controller
+
+
+def _measure(function, iterations, repeats, before_repeat=None):
+    """Measure the cost of calling function.
+
+    Returns
+    -------
+    dict
+        The best time of the repeats in ns per call, the net number of
+        allocated memory blocks per call and the peak of the memory allocated
+        during the calls in bytes.
+    """
+    best = None
+    for _ in range(repeats):
+        if before_repeat is not None:
+            before_repeat()
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    if before_repeat is not None:
+        before_repeat()
+    blocks = sys.getallocatedblocks()
+    for _ in range(iterations):
+        function()
+    blocks = sys.getallocatedblocks() - blocks
+
+    if before_repeat is not None:
+        before_repeat()
+    tracemalloc.start()
+    for _ in range(iterations):
+        function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ns_per_iteration": best / iterations,
+            "allocated_blocks": blocks / iterations,
+            "peak_bytes": peak}
+
+
+def run(iterations=500, repeats=20):
+    """Run the benchmarks.
+
+    Parameters
+    ----------
+    iterations : int (default 500)
+        Calls per repeat. Kept short of the time after which the flight
+        loop treats the link as lost.
+    repeats : int (default 20)
+        The fastest repeat is reported.
+
+    Returns
+    -------
+    dict
+        Results per stage and the maximum loop rate.
+    """
+    channel = CommandChannel(create=True)
+    telemetry = TelemetryChannel(create=True)
+    watchdog = WatchdogChannel(create=True)
+    flight_controller = _create_flight_controller(telemetry)
+    flight_controller._flying = True
+    try:
+        channel.write(alive=True, command={"throttle": 1500, "yaw": 1500,
+                                           "pitch": 1500, "roll": 1500})
+
+        def new_message():
+            # A message per repeat keeps the link loss detection quiet.
+            channel.write(command={"throttle": 1500})
+
+        pid = PID(1.0, 0.1, 0.5)
+        multi_axis_pid = MultiAxisPID([1.0] * 3, [0.1] * 3, [0.5] * 3,
+                                      [100.0] * 3, [30.0] * 3, [300.0] * 3)
+        errors = [0.1, -0.2, 0.3]
+        escs = flight_controller._escs
+        metrics = LoopMetrics(shared=False)
+        changing_pulses = [[1200, 1300, 1400, 1500], [1210, 1310, 1410, 1510]]
+        stages = [
+            ("imu.update_orientation", flight_controller._imu.update_orientation),
+            ("command_channel.read", channel.read),
+            ("pid.calculate", lambda: pid.calculate(0.1)),
+            ("multi_axis_pid.update",
+             lambda: multi_axis_pid.update(errors, 0.002)),
+            ("calculate_pids", flight_controller._calculate_pids),
+            ("calculate_pulses", flight_controller._calculate_pulses),
+            ("send_pulses", flight_controller._send_pulses),
+            ("publish_telemetry", flight_controller._publish_telemetry),
+            ("metrics.observe", lambda: metrics.observe(IMU_READ, 1500)),
+            ("watchdog.beat", lambda: watchdog.beat(1500.0)),
+            ("watchdog.tripped", watchdog.tripped),
+            ("escs.set_pulsewidths (all changed)",
+             lambda: escs.set_pulsewidths(
+                 changing_pulses[escs.writes % 2])),
+            ("loop_iteration", lambda: flight_controller._iterate(channel)),
+        ]
+        results = {}
+        for name, function in stages:
+            results[name] = _measure(function, iterations, repeats,
+                                     new_message)
+    finally:
+        channel.close()
+        channel.unlink()
+        telemetry.close()
+        telemetry.unlink()
+        watchdog.close()
+        watchdog.unlink()
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "stages": results,
+            "max_loop_rate": 1e9 / results["loop_iteration"]["ns_per_iteration"]}
+
+
+def compare(results, baseline, threshold):
+    """Find the stages that are slower than in the baseline.
+
+    Parameters
+    ----------
+    results : dict
+    baseline : dict
+    threshold : float
+        Allowed relative slowdown, e.g. 0.1 for 10 %.
+
+    Returns
+    -------
+    list of str
+        Descriptions of the regressions.
+    """
+    regressions = []
+    for name, result in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["ns_per_iteration"]
+        after = result["ns_per_iteration"]
+        if after > before * (1 + threshold):
+            regressions.append("{}: {:.0f} ns -> {:.0f} ns (+{:.0%})".format(
+                name, before, after, after / before - 1))
+    return regressions
+
+
+def _print_results(results, baseline=None):
+    print("{:<36}{:>14}{:>12}{:>14}{:>10}".format(
+        "stage", "ns/iteration", "blocks/it", "peak bytes", "change"))
+    for name, result in results["stages"].items():
+        change = ""
+        if baseline is not None and name in baseline["stages"]:
+            before = baseline["stages"][name]["ns_per_iteration"]
+            change = "{:+.1%}".format(result["ns_per_iteration"] / before - 1)
+        print("{:<36}{:>14.0f}{:>12.2f}{:>14}{:>10}".format(
+            name, result["ns_per_iteration"], result["allocated_blocks"],
+            result["peak_bytes"], change))
+    print("Max loop rate {:.0f} Hz".format(results["max_loop_rate"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the hot path of the flight loop.")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--save", metavar="PATH",
+                        help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed relative slowdown per stage")
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.repeats)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    _print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Cost and accuracy of the attitude estimators.
+
+Every estimator of drone.flight_controller.estimators is run over the same
+reference dataset, the MPU6050 samples of a simulated open loop flight with
+known true orientation, sampled at the loop rate. The cost is the time of an
+update and the accuracy the error of the estimated tilt, i.e. the direction
+of gravity, which is what the roll and pitch are calculated from. The yaw is
+not compared, because without a magnetometer it only follows the gyroscope
+in every estimator.
+
+    python -m drone.benchmarks.estimators --loop-rate 500 --max-error 2
+
+prints the results and the cheapest estimator whose tilt error stays below
+the given number of degrees.
+"""
+import argparse
+from math import acos, pi, sqrt
+
+from drone.benchmarks.control_loop import _measure
+from drone.flight_controller.estimators import ESTIMATORS
+from drone.flight_controller.mpu6050 import MPU6050
+from drone.simulation.clock import SimulatedClock
+from drone.simulation.hardware import SimulatedI2CBus, SimulatedMPU6050Device
+from drone.simulation.quadcopter import Quadcopter
+
+
+# Motor commands of the reference flight from the given time in seconds on:
+# still on the ground, a climb, and doublets in roll, pitch and yaw while
+# about hovering. Motors 0 and 3 are on the left, 0 and 1 at the back, and
+# 1 and 3 spin clockwise, see Quadcopter.
+_HOVER = 1470
+_REFERENCE_FLIGHT = [
+    (0.0, (1000, 1000, 1000, 1000)),
+    (1.0, (1650, 1650, 1650, 1650)),
+    (1.6, (_HOVER, ) * 4),
+    (2.0, (_HOVER + 40, _HOVER - 40, _HOVER - 40, _HOVER + 40)),
+    (2.15, (_HOVER - 40, _HOVER + 40, _HOVER + 40, _HOVER - 40)),
+    (2.45, (_HOVER + 40, _HOVER - 40, _HOVER - 40, _HOVER + 40)),
+    (2.6, (_HOVER, ) * 4),
+    (3.5, (_HOVER + 40, _HOVER + 40, _HOVER - 40, _HOVER - 40)),
+    (3.65, (_HOVER - 40, _HOVER - 40, _HOVER + 40, _HOVER + 40)),
+    (3.95, (_HOVER + 40, _HOVER + 40, _HOVER - 40, _HOVER - 40)),
+    (4.1, (_HOVER, ) * 4),
+    (5.0, (_HOVER - 60, _HOVER + 60, _HOVER - 60, _HOVER + 60)),
+    (5.5, (_HOVER + 60, _HOVER - 60, _HOVER + 60, _HOVER - 60)),
+    (6.0, (_HOVER, ) * 4),
+]
+_STILL_TIME = 1.0
+_DURATION = 7.0
+_PHYSICS_RATE = 2000
+
+
+def reference_dataset(loop_rate=500, seed=0):
+    """Simulate the reference flight.
+
+    Parameters
+    ----------
+    loop_rate : float (default 500)
+        Rate of the samples in Hz.
+    seed : int (default 0)
+        Seed for the sensor noise.
+
+    Returns
+    -------
+    still : list of tuples
+        Gyroscope and accelerometer samples (gx, gy, gz, ax, ay, az) while
+        the quadcopter is still on the ground, in degrees/sec and g.
+    flight : list of tuples
+        Samples of the rest of the flight as (gx, gy, gz, ax, ay, az, ux, uy,
+        uz), where the gyroscope offsets are substracted, the angular speeds
+        are in radians/sec and u is the true direction up in the frame of the
+        module.
+    """
+    clock = SimulatedClock()
+    quadcopter = Quadcopter()
+    device = SimulatedMPU6050Device(quadcopter, clock, seed=seed)
+    bus = SimulatedI2CBus()
+    bus.attach(device.address, device)
+    mpu6050 = MPU6050(bus)
+    mpu6050.setup()
+
+    physics_dt = 1.0 / _PHYSICS_RATE
+    sample_interval = 1.0 / loop_rate
+    next_sample = 0.0
+    script = list(_REFERENCE_FLIGHT)
+    still = []
+    flight = []
+    offsets = None
+    while quadcopter.time < _DURATION:
+        while script and script[0][0] <= quadcopter.time:
+            quadcopter.motor_commands = list(script.pop(0)[1])
+        quadcopter.step(physics_dt)
+        if quadcopter.time < next_sample:
+            continue
+        next_sample += sample_interval
+        (ax, ay, az), (gx, gy, gz), _ = mpu6050.get_measurement()
+        if quadcopter.time < _STILL_TIME:
+            still.append((gx, gy, gz, ax, ay, az))
+            continue
+        if offsets is None:
+            offsets = [sum(sample[i] for sample in still) / len(still)
+                       for i in range(3)]
+        # The module is mounted with its y and z axes opposite to the body.
+        ux, uy, uz = quadcopter.world_to_body((0.0, 0.0, 1.0))
+        flight.append(((gx - offsets[0]) * pi / 180,
+                       (gy - offsets[1]) * pi / 180,
+                       (gz - offsets[2]) * pi / 180,
+                       ax, ay, az, ux, -uy, -uz))
+    return still, flight
+
+
+def tilt_errors(estimator, still, flight, time_interval):
+    """Run an estimator over the reference dataset.
+
+    Returns
+    -------
+    list of floats
+        Angle in degrees between the estimated and the true direction up for
+        every sample of the flight.
+    """
+    n = len(still)
+    estimator.initialize(sum(sample[3] for sample in still) / n,
+                         sum(sample[4] for sample in still) / n,
+                         sum(sample[5] for sample in still) / n)
+    errors = []
+    for gx, gy, gz, ax, ay, az, ux, uy, uz in flight:
+        estimator.update(gx, gy, gz, ax, ay, az, time_interval)
+        q0 = estimator.q0
+        q1 = estimator.q1
+        q2 = estimator.q2
+        q3 = estimator.q3
+        vx = 2.0 * (q1 * q3 - q0 * q2)
+        vy = 2.0 * (q0 * q1 + q2 * q3)
+        vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+        cosine = (vx * ux + vy * uy + vz * uz) / sqrt(
+            (vx * vx + vy * vy + vz * vz) * (ux * ux + uy * uy + uz * uz))
+        errors.append(acos(max(-1.0, min(1.0, cosine))) * 180 / pi)
+    return errors
+
+
+def run(loop_rate=500, repeats=20, seed=0):
+    """Measure the cost and accuracy of every estimator.
+
+    Parameters
+    ----------
+    loop_rate : float (default 500)
+    repeats : int (default 20)
+        Repeats of the cost measurement, the fastest is reported.
+    seed : int (default 0)
+
+    Returns
+    -------
+    dict
+        Per estimator the time of an update in ns, the share of the loop
+        period it takes, and the RMS and maximum tilt error in degrees.
+    """
+    still, flight = reference_dataset(loop_rate, seed)
+    time_interval = 1.0 / loop_rate
+    results = {}
+    for name, estimator_class in ESTIMATORS.items():
+        errors = tilt_errors(estimator_class(), still, flight, time_interval)
+
+        estimator = estimator_class()
+        update = estimator.update
+        gx, gy, gz, ax, ay, az = flight[len(flight) // 2][:6]
+        cost = _measure(lambda: update(gx, gy, gz, ax, ay, az, time_interval),
+                        1000, repeats)
+        results[name] = {
+            "ns_per_update": cost["ns_per_iteration"],
+            "allocated_blocks": cost["allocated_blocks"],
+            "loop_share": cost["ns_per_iteration"] * loop_rate / 1e9,
+            "rms_tilt_error": sqrt(sum(e * e for e in errors) / len(errors)),
+            "max_tilt_error": max(errors),
+        }
+    return results
+
+
+def cheapest(results, max_error):
+    """Get the name of the cheapest estimator whose RMS tilt error is at most
+    max_error degrees, or None."""
+    candidates = [name for name, result in results.items()
+                  if result["rms_tilt_error"] <= max_error]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda name: results[name]["ns_per_update"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cost and accuracy of the attitude estimators.")
+    parser.add_argument("--loop-rate", type=float, default=500)
+    parser.add_argument("--max-error", type=float, default=2.0,
+                        help="largest acceptable RMS tilt error in degrees")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(args.loop_rate, args.repeats, args.seed)
+    print("{:<16}{:>12}{:>12}{:>12}{:>14}{:>14}".format(
+        "estimator", "ns/update", "blocks/it", "loop share", "RMS tilt deg",
+        "max tilt deg"))
+    for name, result in results.items():
+        print("{:<16}{:>12.0f}{:>12.2f}{:>12.2%}{:>14.2f}{:>14.2f}".format(
+            name, result["ns_per_update"], result["allocated_blocks"],
+            result["loop_share"], result["rms_tilt_error"],
+            result["max_tilt_error"]))
+    name = cheapest(results, args.max_error)
+    if name is None:
+        print("No estimator is within {} degrees".format(args.max_error))
+    else:
+        print("Cheapest within {} degrees at {:.0f} Hz: {}".format(
+            args.max_error, args.loop_rate, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Interference of slow sensors with the IMU on a shared i2c bus.
+
+Runs a 400 kHz simulated bus in wall clock time, where every transaction
+takes the time of its bits on the wire. The IMU is read at the loop rate
+like the flight loop does, with one 14 byte block read, while a
+magnetometer and a barometer are polled at their own rates. The same is run
+twice: once with the sensors scheduled by I2CBusManager and once with the
+bus only behind a lock.
+
+    python -m drone.benchmarks.i2c_bus --duration 5
+
+prints how long the IMU waited for the bus, the rates the sensors achieved
+and the bus utilisation of each device.
+"""
+import argparse
+import time
+
+from drone.flight_controller.i2c_bus import I2CBusManager
+from drone.flight_controller.scheduler import RateScheduler
+from drone.simulation.hardware import SimulatedI2CBus, SimulatedRegisterDevice
+
+
+_MPU6050 = 0x68
+_MAGNETOMETER = 0x1E
+_BAROMETER = 0x76
+
+
+def _run(duration, loop_rate, magnetometer_rate, barometer_rate,
+         prioritised):
+    bus = SimulatedI2CBus(bus_speed=400000, sleep=time.sleep)
+    for address in (_MPU6050, _MAGNETOMETER, _BAROMETER):
+        bus.attach(address, SimulatedRegisterDevice(address))
+    manager = I2CBusManager(bus, schedule=prioritised)
+    imu = manager.add_device("imu", _MPU6050, priority=0, rate=loop_rate)
+    magnetometer = manager.add_device("magnetometer", _MAGNETOMETER,
+                                      priority=1)
+    barometer = manager.add_device("barometer", _BAROMETER, priority=2)
+
+    def read_magnetometer():
+        magnetometer.read_i2c_block_data(_MAGNETOMETER, 0x03, 6)
+
+    def read_barometer():
+        # Pressure and temperature, and the status register.
+        barometer.read_byte_data(_BAROMETER, 0xF3)
+        barometer.read_i2c_block_data(_BAROMETER, 0xF7, 6)
+
+    manager.poll(magnetometer, read_magnetometer, magnetometer_rate)
+    manager.poll(barometer, read_barometer, barometer_rate)
+    manager.start()
+    scheduler = RateScheduler(loop_rate)
+    scheduler.start()
+    end = time.monotonic() + duration
+    try:
+        while time.monotonic() < end:
+            imu.read_i2c_block_data(_MPU6050, 0x3B, 14)
+            scheduler.wait()
+    finally:
+        manager.stop()
+    statistics = manager.get_statistics()
+    statistics["missed_deadlines"] = scheduler.missed_deadlines
+    return statistics
+
+
+def run(duration=5.0, loop_rate=500, magnetometer_rate=100,
+        barometer_rate=50):
+    """Run the comparison.
+
+    Returns
+    -------
+    dict
+        The statistics of I2CBusManager.get_statistics with the missed
+        deadlines of the IMU loop, for "prioritised" and "lock".
+    """
+    return {name: _run(duration, loop_rate, magnetometer_rate,
+                       barometer_rate, prioritised)
+            for name, prioritised in (("prioritised", True),
+                                      ("lock", False))}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Interference of slow sensors with the IMU on the bus.")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--loop-rate", type=float, default=500)
+    parser.add_argument("--magnetometer-rate", type=float, default=100)
+    parser.add_argument("--barometer-rate", type=float, default=50)
+    args = parser.parse_args()
+
+    results = run(args.duration, args.loop_rate, args.magnetometer_rate,
+                  args.barometer_rate)
+    for name, statistics in results.items():
+        print("{}: bus utilisation {:.1%}, IMU missed {} deadlines".format(
+            name, statistics["utilisation"], statistics["missed_deadlines"]))
+        print("  {:<14}{:>8}{:>12}{:>14}{:>14}{:>10}".format(
+            "device", "busy", "rate Hz", "mean wait us", "max wait us",
+            "deferred"))
+        for device, usage in statistics["devices"].items():
+            rate = usage.get("rate")
+            print("  {:<14}{:>8.1%}{:>12}{:>14.0f}{:>14.0f}{:>10}".format(
+                device, usage["utilisation"],
+                "" if rate is None else "{:.1f}".format(rate),
+                usage["mean_wait"] * 1e6, usage["max_wait"] * 1e6,
+                usage["deferred"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Detection latency of the failsafe watchdog.
+
+Runs the watchdog in its own process like on the drone, beats its heartbeat
+at the loop rate from this process and stops beating at a random moment, as
+a hung flight loop would. Every trial reports how long after the deadline
+the watchdog detected the stale heartbeat and how long sending the failsafe
+pulses took, with the pulses going to a connection that discards them.
+
+    python -m drone.benchmarks.watchdog --trials 20 --timeout 0.05
+
+Run on the drone, with the flight loop competing for the CPU, for numbers
+that matter.
+"""
+import argparse
+import multiprocessing as mp
+import random
+import time
+
+from drone.flight_controller.watchdog import (HEARTBEAT, Watchdog,
+                                              WatchdogChannel)
+
+
+class _NullPigpio:
+    """pigpio connection that discards everything."""
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        pass
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(trials=20, timeout=0.05, poll_interval=0.001, loop_rate=500,
+        seed=0):
+    """Measure the latencies.
+
+    Parameters
+    ----------
+    trials : int (default 20)
+    timeout : float (default 0.05)
+        Heartbeat timeout of the watchdog in seconds.
+    poll_interval : float (default 0.001)
+        Seconds between the checks of the watchdog.
+    loop_rate : float (default 500)
+        Rate of the heartbeats in Hz.
+    seed : int (default 0)
+        Seed for the moments the heartbeats stop.
+
+    Returns
+    -------
+    dict
+        The mean, 99th percentile and maximum in ms of the detection latency,
+        i.e. from the deadline to the detection, of the cut latency and of
+        the reaction time, i.e. from the last heartbeat to the failsafe
+        pulses.
+    """
+    generator = random.Random(seed)
+    interval = 1.0 / loop_rate
+    detections = []
+    cuts = []
+    reactions = []
+    for _ in range(trials):
+        channel = WatchdogChannel(create=True)
+        try:
+            watchdog = Watchdog(channel, heartbeat_timeout=timeout,
+                                poll_interval=poll_interval,
+                                kill_flight_loop=False, pi=_NullPigpio())
+            process = mp.Process(target=watchdog.run, daemon=True)
+            process.start()
+            stop = time.monotonic() + generator.uniform(0.05, 0.15)
+            channel.arm()
+            while time.monotonic() < stop:
+                time.sleep(interval)
+                channel.beat(1500.0)
+            process.join(5.0)
+            trip = channel.get_trip()
+            if trip.reason != HEARTBEAT:
+                raise RuntimeError("The watchdog did not trip")
+            detections.append(trip.detection_latency_ns / 1e6)
+            cuts.append(trip.cut_latency_ns / 1e6)
+            reactions.append((trip.stale_ns + trip.cut_latency_ns) / 1e6)
+        finally:
+            channel.close()
+            channel.unlink()
+
+    def summary(values):
+        return {"mean": sum(values) / len(values),
+                "p99": _percentile(values, 0.99), "max": max(values)}
+
+    return {"detection_latency_ms": summary(detections),
+            "cut_latency_ms": summary(cuts),
+            "reaction_time_ms": summary(reactions)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Detection latency of the failsafe watchdog.")
+    parser.add_argument("--trials", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=0.05,
+                        help="heartbeat timeout in seconds")
+    parser.add_argument("--poll-interval", type=float, default=0.001)
+    parser.add_argument("--loop-rate", type=float, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(args.trials, args.timeout, args.poll_interval,
+                  args.loop_rate, args.seed)
+    print("{:<24}{:>10}{:>10}{:>10}".format("ms", "mean", "p99", "max"))
+    for name, summary in results.items():
+        print("{:<24}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            name[:-3].replace("_", " "), summary["mean"], summary["p99"],
+            summary["max"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Hardware backends of the drone.
+
+The hardware is used through three kinds of devices: the i2c bus of the
+MPU6050 (the smbus interface), the PWM output of the ESCs (the pigpio.pi
+interface) and the ADC of the voltage meter (the gpiozero MCP3008
+interface). Every backend provides a factory for each kind:
+
+real
+    smbus, pigpio and gpiozero on the Raspberry Pi.
+simulated
+    A simulated quadcopter running in wall clock time, see
+    drone.simulation.world.
+replay
+    The sensor samples of a flight log from FlightRecorder, read from the
+    path in the DRONE_REPLAY_LOG environment variable. The PWM output is only
+    stored.
+
+The backend is chosen with select, or with the DRONE_BACKEND environment
+variable, and defaults to real. The driver libraries and the simulation are
+imported only when a device of their backend is created.
+"""
+import os
+
+
+BACKEND_VARIABLE = "DRONE_BACKEND"
+REPLAY_LOG_VARIABLE = "DRONE_REPLAY_LOG"
+KINDS = ("i2c", "pwm", "adc")
+
+_factories = {}
+_selected = None
+
+
+def register(backend, kind, factory):
+    """Register a factory for a kind of device of a backend.
+
+    Parameters
+    ----------
+    backend : str
+    kind : str
+        One of KINDS.
+    factory : callable
+        Called with the keyword arguments given to create.
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown device kind {}".format(kind))
+    _factories[(backend, kind)] = factory
+
+
+def select(backend):
+    """Use the given backend instead of the one in DRONE_BACKEND."""
+    if not any(name == backend for name, _ in _factories):
+        raise ValueError("Unknown backend {}".format(backend))
+    global _selected
+    _selected = backend
+
+
+def selected_backend():
+    """Get the name of the backend in use."""
+    if _selected is not None:
+        return _selected
+    return os.environ.get(BACKEND_VARIABLE, "real")
+
+
+def create(kind, **kwargs):
+    """Create a device of the backend in use.
+
+    Parameters
+    ----------
+    kind : str
+        One of KINDS.
+    kwargs
+        Passed to the factory. All backends accept bus for i2c and channel and
+        device for adc.
+    """
+    backend = selected_backend()
+    try:
+        factory = _factories[(backend, kind)]
+    except KeyError:
+        raise ValueError("Backend {} has no {} device".format(backend, kind))
+    return factory(**kwargs)
+
+
+def _real_i2c(bus=1):
+    import smbus
+    return smbus.SMBus(bus)
+
+
+def _real_pwm():
+    import pigpio
+    return pigpio.pi()
+
+
+def _real_adc(channel=0, device=0):
+    from gpiozero import MCP3008
+    return MCP3008(channel=channel, device=device)
+
+
+def _simulated_i2c(bus=1):
+    from drone.simulation.world import get_world
+    return get_world().bus
+
+
+def _simulated_pwm():
+    from drone.simulation.world import get_world
+    return get_world().pi
+
+
+def _simulated_adc(channel=0, device=0):
+    from drone.simulation.world import get_world
+    return get_world().adc
+
+
+def _replay_log_path():
+    try:
+        return os.environ[REPLAY_LOG_VARIABLE]
+    except KeyError:
+        raise ValueError("Set {} to the flight log to replay".format(
+            REPLAY_LOG_VARIABLE))
+
+
+def _replay_i2c(bus=1):
+    from drone.simulation.replay import ReplayI2CBus
+    return ReplayI2CBus(_replay_log_path())
+
+
+def _replay_pwm():
+    from drone.simulation.replay import ReplayPigpio
+    return ReplayPigpio()
+
+
+def _replay_adc(channel=0, device=0):
+    from drone.simulation.replay import ReplayADC
+    return ReplayADC()
+
+
+register("real", "i2c", _real_i2c)
+register("real", "pwm", _real_pwm)
+register("real", "adc", _real_adc)
+register("simulated", "i2c", _simulated_i2c)
+register("simulated", "pwm", _simulated_pwm)
+register("simulated", "adc", _simulated_adc)
+register("replay", "i2c", _replay_i2c)
+register("replay", "pwm", _replay_pwm)
+register("replay", "adc", _replay_adc)
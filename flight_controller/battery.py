@@ -0,0 +1,158 @@
+"""Battery monitoring outside the flight loop.
+
+A read of the MCP3008 is an SPI transaction, too slow and too variable for
+every iteration of the flight loop. BatteryMonitor reads the voltage meter
+in a background thread at a low rate and keeps the results in plain
+attributes, which the flight loop reads without any locking: assigning and
+reading one attribute is atomic in Python.
+"""
+import os
+import threading
+import time
+from math import exp, isnan
+
+from drone.flight_controller.voltage_meter import VoltageMeter
+
+
+UNKNOWN = -1
+OK = 0
+LOW = 1
+CRITICAL = 2
+
+# Largest voltage of a charged LiPo cell, with a margin for the measurement
+# error, for estimating the number of cells from a charged pack.
+_MAX_CELL_VOLTAGE = 4.3
+# Below this voltage there is assumed to be no battery connected, e.g. when
+# powered from USB or in the simulation.
+_MIN_BATTERY_VOLTAGE = 2.5
+
+
+class BatteryMonitor:
+    """Background sampled battery voltage.
+
+    The voltage is smoothed with an exponential moving average. The number
+    of cells is estimated from the first measurement, so the pack should be
+    charged and not under load when the monitor is started, or the number
+    given. The voltage per cell gives the state:
+
+    UNKNOWN
+        No battery measured yet.
+    OK
+    LOW
+        Below low_cell_voltage, time to land.
+    CRITICAL
+        Below critical_cell_voltage, the pack is being damaged.
+
+    The state only gets worse, because the voltage recovers whenever the
+    throttle is lowered.
+
+    The thrust of a motor falls with the voltage of the pack, so the same
+    throttle hovers lower as the pack drains and sags under load.
+    throttle_scale is the factor of the throttle above the idle pulse that
+    gives the thrust of reference_cell_voltage per cell, see
+    FlightController._calculate_pulses.
+    """
+
+    def __init__(self, voltage_meter=None, rate=10.0, time_constant=1.0,
+                 cells=None, low_cell_voltage=3.5, critical_cell_voltage=3.3,
+                 reference_cell_voltage=3.9, max_throttle_scale=1.3):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        voltage_meter : VoltageMeter or None (default None)
+            If None, a VoltageMeter with the selected backend is created when
+            the monitor is started, i.e. in the process of the flight loop.
+        rate : float (default 10.0)
+            Rate of the measurements in Hz.
+        time_constant : float (default 1.0)
+            Time constant of the smoothing in seconds.
+        cells : int or None (default None)
+            Number of cells in series. If None, it is estimated.
+        low_cell_voltage : float (default 3.5)
+        critical_cell_voltage : float (default 3.3)
+        reference_cell_voltage : float (default 3.9)
+            Voltage per cell at which the throttle is not scaled, i.e. at
+            which the gains were tuned.
+        max_throttle_scale : float (default 1.3)
+            Limit of throttle_scale. The scale is also at least
+            1 / max_throttle_scale.
+        """
+        self.voltage_meter = voltage_meter
+        self.rate = rate
+        self.time_constant = time_constant
+        self.low_cell_voltage = low_cell_voltage
+        self.critical_cell_voltage = critical_cell_voltage
+        self.reference_cell_voltage = reference_cell_voltage
+        self.max_throttle_scale = max_throttle_scale
+        # Published to the flight loop.
+        self.cells = cells
+        self.voltage = float("nan")
+        self.cell_voltage = float("nan")
+        self.throttle_scale = 1.0
+        self.state = UNKNOWN
+        self._smoothing = 1.0 - exp(-1.0 / (rate * time_constant))
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start sampling in a background thread."""
+        if self.voltage_meter is None:
+            self.voltage_meter = VoltageMeter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stop.set()
+        self._thread.join()
+
+    def sample(self):
+        """Measure the voltage once and update the published values."""
+        voltage = self.voltage_meter.get_voltage()
+        if voltage < _MIN_BATTERY_VOLTAGE:
+            return
+        if isnan(self.voltage):
+            smoothed = voltage
+        else:
+            smoothed = self.voltage + self._smoothing * (voltage - self.voltage)
+        if self.cells is None:
+            self.cells = int(voltage / _MAX_CELL_VOLTAGE) + 1
+        cell_voltage = smoothed / self.cells
+        scale = self.reference_cell_voltage / cell_voltage
+        scale = min(self.max_throttle_scale,
+                    max(1.0 / self.max_throttle_scale, scale))
+
+        state = OK
+        if cell_voltage < self.critical_cell_voltage:
+            state = CRITICAL
+        elif cell_voltage < self.low_cell_voltage:
+            state = LOW
+        if state > self.state:
+            if state == LOW:
+                print("Battery low: {:.2f} V".format(smoothed))
+            elif state == CRITICAL:
+                print("Battery critical: {:.2f} V".format(smoothed))
+            self.state = state
+        self.voltage = smoothed
+        self.cell_voltage = cell_voltage
+        self.throttle_scale = scale
+
+    def _sample_loop(self):
+        # Lower the priority of this thread only, so that it never delays the
+        # flight loop. On Linux the thread id works as a process id.
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        interval = 1.0 / self.rate
+        next_sample = time.monotonic()
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print("Battery measurement failed: {}".format(e))
+            next_sample += interval
+            if self._stop.wait(max(0.0, next_sample - time.monotonic())):
+                return
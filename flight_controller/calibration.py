@@ -0,0 +1,207 @@
+import json
+import os
+import time
+from math import sqrt
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".drone",
+                                  "gyroscope_calibration.json")
+
+
+def sensor_id(mpu6050):
+    """Identify an MPU6050 by its bus, address and WHO_AM_I register.
+
+    The module has no serial number, so a replaced module on the same bus
+    and address is only detected by the stillness check of IMU.calibrate.
+
+    Parameters
+    ----------
+    mpu6050 : MPU6050
+
+    Returns
+    -------
+    str
+    """
+    return "{}:{:#04x}:{:#04x}".format(mpu6050.bus_number,
+                                       mpu6050.i2c_address,
+                                       mpu6050.read_who_am_i())
+
+
+def measure_gyroscope(mpu6050, n):
+    """Average n gyroscope measurements.
+
+    Parameters
+    ----------
+    mpu6050 : MPU6050
+    n : int
+
+    Returns
+    -------
+    tuple
+        The means and standard deviations of the angular speeds around x, y
+        and z in degrees/sec, i.e. ``((mx, my, mz), (sx, sy, sz))``.
+    """
+    sums = [0.0, 0.0, 0.0]
+    squares = [0.0, 0.0, 0.0]
+    for _ in range(n):
+        gyroscope = mpu6050.get_gyroscope_measurement()
+        for i in range(3):
+            sums[i] += gyroscope[i]
+            squares[i] += gyroscope[i] * gyroscope[i]
+    means = tuple(s / n for s in sums)
+    deviations = tuple(sqrt(max(0.0, q / n - m * m))
+                       for q, m in zip(squares, means))
+    return means, deviations
+
+
+class CalibrationCache:
+    """Gyroscope offsets stored on disk between flights.
+
+    The offsets are stored per sensor and per whole degree Celsius, since the
+    gyroscope bias drifts with the temperature. The file is JSON of the form
+    ``{sensor id: {temperature: {"x": .., "y": .., "z": .., "time": ..}}}``.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_temperature_difference=3.0):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        path : str (default ~/.drone/gyroscope_calibration.json)
+        max_temperature_difference : float (default 3.0)
+            Offsets calibrated at most this many degrees Celsius away from the
+            current temperature are used.
+        """
+        self.path = path
+        self.max_temperature_difference = max_temperature_difference
+
+    def load(self, sensor, temperature):
+        """Get the offsets calibrated closest to the given temperature.
+
+        Parameters
+        ----------
+        sensor : str
+            See sensor_id.
+        temperature : float
+            Temperature in degrees Celsius.
+
+        Returns
+        -------
+        dict or None
+            The offsets for x, y and z in degrees/sec, or None if there are
+            none close enough to the temperature.
+        """
+        entries = self._read().get(sensor, {})
+        best = None
+        for key, entry in entries.items():
+            difference = abs(float(key) - temperature)
+            if (difference <= self.max_temperature_difference
+                    and (best is None or difference < best[0])):
+                best = difference, entry
+        if best is None:
+            return None
+        return {axis: best[1][axis] for axis in ("x", "y", "z")}
+
+    def save(self, sensor, temperature, offsets):
+        """Store offsets, replacing the ones of the same temperature.
+
+        Parameters
+        ----------
+        sensor : str
+            See sensor_id.
+        temperature : float
+            Temperature in degrees Celsius.
+        offsets : dict
+            The offsets for x, y and z in degrees/sec.
+        """
+        data = self._read()
+        entry = {axis: offsets[axis] for axis in ("x", "y", "z")}
+        entry["time"] = time.time()
+        data.setdefault(sensor, {})[str(int(round(temperature)))] = entry
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write and rename, so a crash never leaves a truncated file behind.
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+class GyroscopeBiasEstimator:
+    """Online refinement of the gyroscope offsets.
+
+    Whenever the drone has been still for a while, the offsets are moved
+    slowly towards the measured angular speeds, which follows the thermal
+    drift of the bias during long sessions. The drone is still when the
+    angular speeds with the offsets substracted are small and the
+    accelerometer measures only gravity.
+    """
+
+    def __init__(self, offsets, time_constant=10.0, rate_threshold=1.0,
+                 acceleration_threshold=0.05, still_time=0.5):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        offsets : dict
+            The offsets for x, y and z in degrees/sec. Updated in place.
+        time_constant : float (default 10.0)
+            Time constant of the refinement in seconds of stillness.
+        rate_threshold : float (default 1.0)
+            Largest angular speed in degrees/sec counted as still.
+        acceleration_threshold : float (default 0.05)
+            Largest difference of the acceleration from 1 g counted as still.
+        still_time : float (default 0.5)
+            Seconds the drone needs to be still before refining.
+        """
+        self.offsets = offsets
+        self.time_constant = time_constant
+        self.rate_threshold = rate_threshold
+        self.acceleration_threshold = acceleration_threshold
+        self.still_time = still_time
+        self.still_for = 0.0
+        self.updates = 0
+
+    def update(self, gx, gy, gz, ax, ay, az, time_interval):
+        """Refine the offsets with a measurement.
+
+        Parameters
+        ----------
+        gx, gy, gz : float
+            Angular speeds in degrees/sec, the offsets not substracted.
+        ax, ay, az : float
+            Accelerations in g.
+        time_interval : float
+            Time since the previous measurement in seconds.
+
+        Returns
+        -------
+        bool
+            True if the offsets were refined.
+        """
+        offsets = self.offsets
+        dx = gx - offsets["x"]
+        dy = gy - offsets["y"]
+        dz = gz - offsets["z"]
+        if (dx * dx + dy * dy + dz * dz > self.rate_threshold ** 2
+                or abs(sqrt(ax * ax + ay * ay + az * az) - 1.0)
+                > self.acceleration_threshold):
+            self.still_for = 0.0
+            return False
+        self.still_for += time_interval
+        if self.still_for < self.still_time:
+            return False
+        alpha = min(1.0, time_interval / self.time_constant)
+        offsets["x"] += alpha * dx
+        offsets["y"] += alpha * dy
+        offsets["z"] += alpha * dz
+        self.updates += 1
+        return True
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import namedtuple
+
+from drone.flight_controller.seqlock import SeqlockBlock
+
+
+Command = namedtuple("Command", ["sequence", "alive", "throttle", "yaw",
+                                 "pitch", "roll", "timestamp_ns"])
+Command.__doc__ = """Latest state of the controls.
+
+sequence : int
+    Incremented on every received message, 0 before the first one.
+alive : int
+    UNKNOWN until the client has said whether it is alive, then ALIVE or
+    NOT_ALIVE.
+throttle, yaw, pitch, roll : int
+    Stick values in range 1000-2000.
+timestamp_ns : int
+    time.monotonic_ns of the latest message.
+"""
+
+UNKNOWN = -1
+NOT_ALIVE = 0
+ALIVE = 1
+
+# Range of the stick values.
+MIN_VALUE = 1000
+MAX_VALUE = 2000
+
+
+class CommandChannel:
+    """Latest-value command channel from the web server to the flight loop.
+
+    The web server writes every message it receives into a block of shared
+    memory and the flight loop reads the newest state from it. Unlike a queue,
+    messages that the flight loop did not have time to read are merged
+    instead of piling up, so the latency of the commands stays constant no
+    matter how fast the client sends them.
+    """
+
+    _format = "<QbhhhhQ"
+
+    def __init__(self, name=None, create=False):
+        """Create or attach to the channel.
+
+        Parameters
+        ----------
+        name : str or None (default None)
+            Name of the shared memory block of an existing channel.
+        create : bool (default False)
+            Create a new channel. The creator is responsible for unlinking it.
+        """
+        self._block = SeqlockBlock(self._format, name=name, create=create)
+        self.name = self._block.name
+        self._lock = threading.Lock()
+        if create:
+            self._state = {"sequence": 0, "alive": UNKNOWN, "throttle": 1000,
+                           "yaw": 1500, "pitch": 1500, "roll": 1500}
+            self._publish(0)
+        else:
+            self._state = self.read()._asdict()
+            del self._state["timestamp_ns"]
+
+    def write(self, alive=None, command=None):
+        """Merge a message into the channel.
+
+        Parameters
+        ----------
+        alive : bool or None (default None)
+            Whether the client is alive. None keeps the previous value.
+        command : dict or None (default None)
+            The keys can be throttle, yaw, pitch and/or roll. The values need
+            to be in range 1000-2000. Missing keys keep their previous values.
+
+        Raises
+        ------
+        ValueError
+            If a value is out of range or not a number. The message is
+            rejected as a whole and the channel keeps its state.
+        """
+        values = {}
+        if command:
+            for key in ("throttle", "yaw", "pitch", "roll"):
+                if key in command:
+                    try:
+                        value = int(command[key])
+                    except (TypeError, OverflowError):
+                        raise ValueError("{} {!r} is not a number".format(
+                            key, command[key])) from None
+                    if not MIN_VALUE <= value <= MAX_VALUE:
+                        raise ValueError("{} {} is out of range {}-{}".format(
+                            key, value, MIN_VALUE, MAX_VALUE))
+                    values[key] = value
+        with self._lock:
+            state = self._state
+            if alive is not None:
+                state["alive"] = ALIVE if alive else NOT_ALIVE
+            state.update(values)
+            state["sequence"] += 1
+            self._publish(time.monotonic_ns())
+
+    def read(self):
+        """Get the latest state.
+
+        Returns
+        -------
+        Command
+        """
+        return Command._make(self._block.read())
+
+    def close(self):
+        """Detach from the channel."""
+        self._block.close()
+
+    def unlink(self):
+        """Remove the channel. Call only from the creator."""
+        self._block.unlink()
+
+    def _publish(self, timestamp_ns):
+        state = self._state
+        self._block.write(state["sequence"], state["alive"],
+                          state["throttle"], state["yaw"], state["pitch"],
+                          state["roll"], timestamp_ns)
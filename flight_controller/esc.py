@@ -1,6 +1,18 @@
-import pigpio
+import subprocess
 from time import sleep
 
+from drone.flight_controller import backends
+from drone.flight_controller.startup import port_open, wait_until
+
+
+# The port pigpiod listens to.
+PIGPIOD_PORT = 8888
+
+# Script states reported by pigpio.script_status.
+_SCRIPT_INITING = 0
+_SCRIPT_HALTED = 1
+_SCRIPT_FAILED = 4
+
 
 class ESC:
     """Electronic Speed Controller.
@@ -14,7 +26,7 @@ class ESC:
     min_value = 1000
     max_value = 2000
 
-    def __init__(self, gpio_pin):
+    def __init__(self, gpio_pin, pi=None):
         """Initialize variables.
 
         Parameters
@@ -22,8 +34,13 @@ class ESC:
         gpio_pin : int
             The pin in which the esc is attached to. The pin number is in the 
             name of the pin and not the index. For the pin layout see https://pinout.xyz/
+        pi : pigpio.pi or None (default None)
+            Connection to the pigpio daemon. If None, a new connection is
+            opened with the selected backend.
         """
-        self.pi = pigpio.pi()
+        if pi is None:
+            pi = backends.create("pwm")
+        self.pi = pi
         self.gpio_pin = gpio_pin
 
     def set_pulsewidth(self, pulsewidth):
@@ -36,11 +53,7 @@ class ESC:
         pulsewidth : int
             Pulsewidth in microseconds.
         """
-        if pulsewidth > self.max_value:
-            pulsewidth = 1900
-        elif pulsewidth < self.min_value:
-            pulsewidth = 1000
-        self.pi.set_servo_pulsewidth(self.gpio_pin, pulsewidth)
+        self.pi.set_servo_pulsewidth(self.gpio_pin, _clamp(pulsewidth))
 
     def initialize(self):
         """Initialize the electronic speed controllers.
@@ -50,3 +63,142 @@ class ESC:
         start of every flight.
         """
         raise NotImplementedError("Is not tested properly.")
+
+
+class ESCGroup:
+    """The electronic speed controllers of all motors.
+
+    All ESCs share one connection to the pigpio daemon and a pulsewidth is
+    only sent when it differs from the one the ESC already has, since every
+    write is a round trip to the daemon. When several pulsewidths change, they
+    are sent with a single call of a script stored in the daemon, e.g.
+    "servo 13 p0 servo 12 p1 servo 24 p2 servo 18 p3". If the script can not
+    be stored, or a run of it fails or is rejected, e.g. while the previous
+    run is still going, the changed pulsewidths are sent one by one.
+    pulsewidths only holds the values that were sent successfully.
+    """
+
+    def __init__(self, gpio_pins, pi=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        gpio_pins : list of ints
+            The pins of the escs in the motor order. See ESC.
+        pi : pigpio.pi or None (default None)
+            Connection to the pigpio daemon. If None, a new connection is
+            opened with the selected backend.
+        """
+        if pi is None:
+            pi = backends.create("pwm")
+        self.pi = pi
+        self.escs = [ESC(pin, pi=pi) for pin in gpio_pins]
+        self.gpio_pins = list(gpio_pins)
+        self.pulsewidths = [None] * len(self.escs)
+        self.writes = 0
+        self._script_id = self._store_script()
+
+    def set_pulsewidths(self, pulsewidths):
+        """Set the speeds of the motors.
+
+        The pulsewidths are restricted like in ESC.set_pulsewidth.
+
+        Parameters
+        ----------
+        pulsewidths : list of ints
+            Pulsewidths in microseconds in the motor order.
+
+        Raises
+        ------
+        Exception
+            The error of pigpio if a pulsewidth could not be sent. The
+            pulsewidths sent before it are kept in pulsewidths.
+        """
+        current = self.pulsewidths
+        # Committed to pulsewidths only once sent.
+        new = current[:]
+        changed = 0
+        for i in range(len(current)):
+            pulsewidth = _clamp(pulsewidths[i])
+            if pulsewidth != current[i]:
+                new[i] = pulsewidth
+                changed += 1
+        if changed == 0:
+            return
+        if changed > 1 and self._script_id is not None:
+            try:
+                status = self.pi.run_script(self._script_id, new)
+            except Exception as e:
+                status = e
+            self.writes += 1
+            if status == 0:
+                self.pulsewidths = new
+                return
+        for i, pin in enumerate(self.gpio_pins):
+            if new[i] != current[i]:
+                self.pi.set_servo_pulsewidth(pin, new[i])
+                current[i] = new[i]
+                self.writes += 1
+
+    def close(self):
+        """Delete the script from the pigpio daemon."""
+        if self._script_id is not None:
+            self.pi.delete_script(self._script_id)
+            self._script_id = None
+
+    def _store_script(self):
+        """Store the script that sets all pulsewidths in the pigpio daemon.
+
+        Returns
+        -------
+        int or None
+            The id of the script, or None if it could not be stored.
+        """
+        if len(self.gpio_pins) > 10:
+            # A script has 10 parameters.
+            return None
+        script = " ".join("servo {} p{}".format(pin, i)
+                          for i, pin in enumerate(self.gpio_pins))
+        try:
+            script_id = self.pi.store_script(script.encode())
+            status = _SCRIPT_INITING
+            while status == _SCRIPT_INITING:
+                sleep(0.01)
+                status, _ = self.pi.script_status(script_id)
+        except Exception as e:
+            print("Sending pulsewidths one by one, could not store the "
+                  "script: {}".format(e))
+            return None
+        if status == _SCRIPT_FAILED:
+            self.pi.delete_script(script_id)
+            return None
+        return script_id
+
+
+def _clamp(pulsewidth):
+    """Restrict a pulsewidth like ESC.set_pulsewidth."""
+    if pulsewidth > ESC.max_value:
+        return 1900
+    if pulsewidth < ESC.min_value:
+        return 1000
+    return pulsewidth
+
+
+def start_pigpio_daemon(timeout=10.0):
+    """Start pigpiod and wait until it accepts connections.
+
+    Nothing is started if the daemon is already running or if the hardware
+    backend is not the real one.
+
+    Parameters
+    ----------
+    timeout : float (default 10.0)
+        Seconds to wait for the daemon at most.
+    """
+    if backends.selected_backend() != "real":
+        return
+    probe = port_open("localhost", PIGPIOD_PORT)
+    if probe():
+        return
+    subprocess.Popen("sudo pigpiod", shell=True)
+    wait_until(probe, timeout, description="pigpiod")
@@ -0,0 +1,224 @@
+"""Attitude estimators for IMU.
+
+Every estimator keeps the orientation as the quaternion q0, q1, q2, q3 in the
+convention of Madgwick's filter and has the same interface:
+
+update(gx, gy, gz, ax, ay, az, time_interval)
+    One step with the angular speeds in radians/sec, the offsets already
+    substracted, and the accelerations in any unit.
+initialize(ax, ay, az)
+    Set the roll and pitch from an accelerometer measurement of a still
+    module and the yaw to 0.
+
+The estimators differ in cost and in how well they reject the accelerations
+that are not gravity. Run ``python -m drone.benchmarks.estimators`` to
+measure the cost of an update and the accuracy on a reference flight.
+"""
+from math import atan2, cos, sin, sqrt
+
+from drone.flight_controller.madgwick import madgwick_update
+
+
+class _Estimator:
+    __slots__ = ("q0", "q1", "q2", "q3")
+
+    def __init__(self):
+        self.q0 = 1.0
+        self.q1 = 0.0
+        self.q2 = 0.0
+        self.q3 = 0.0
+
+    def initialize(self, ax, ay, az):
+        roll = atan2(ay, az)
+        pitch = atan2(-ax, sqrt(ay * ay + az * az))
+        cr = cos(roll / 2)
+        sr = sin(roll / 2)
+        cp = cos(pitch / 2)
+        sp = sin(pitch / 2)
+        self.q0 = cr * cp
+        self.q1 = sr * cp
+        self.q2 = cr * sp
+        self.q3 = -sr * sp
+
+
+class MadgwickEstimator(_Estimator):
+    """Madgwick's gradient descent filter.
+
+    Steps with madgwick_update of drone.flight_controller.madgwick, so the
+    quaternions are bit-for-bit the same as with update_orientation_batch.
+    """
+
+    __slots__ = ("beta", )
+
+    def __init__(self, beta=100):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        beta : float (default 100)
+            Gain of the accelerometer correction.
+        """
+        super().__init__()
+        self.beta = beta
+
+    def update(self, gx, gy, gz, ax, ay, az, time_interval):
+        recip_norm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
+        self.q0, self.q1, self.q2, self.q3 = madgwick_update(
+            self.q0, self.q1, self.q2, self.q3, gx, gy, gz, ax * recip_norm,
+            ay * recip_norm, az * recip_norm, time_interval, self.beta)
+
+
+class MahonyEstimator(_Estimator):
+    """Mahony's nonlinear complementary filter.
+
+    The error between the measured and the estimated direction of gravity is
+    fed back to the angular speeds through a proportional and an integral
+    gain. The integral term also estimates the remaining gyroscope bias. The
+    implementation follows
+    https://github.com/PaulStoffregen/MahonyAHRS/blob/master/src/MahonyAHRS.cpp
+    """
+
+    __slots__ = ("kp", "ki", "integral_x", "integral_y", "integral_z")
+
+    def __init__(self, kp=1.0, ki=0.0):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        kp : float (default 1.0)
+            Proportional gain in 1/s.
+        ki : float (default 0.0)
+            Integral gain in 1/s^2.
+        """
+        super().__init__()
+        self.kp = kp
+        self.ki = ki
+        self.integral_x = 0.0
+        self.integral_y = 0.0
+        self.integral_z = 0.0
+
+    def update(self, gx, gy, gz, ax, ay, az, time_interval):
+        q0 = self.q0
+        q1 = self.q1
+        q2 = self.q2
+        q3 = self.q3
+
+        recip_norm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
+        ax *= recip_norm
+        ay *= recip_norm
+        az *= recip_norm
+
+        # Estimated direction of gravity and its error to the measured one
+        vx = q1 * q3 - q0 * q2
+        vy = q0 * q1 + q2 * q3
+        vz = q0 * q0 - 0.5 + q3 * q3
+        ex = 2.0 * (ay * vz - az * vy)
+        ey = 2.0 * (az * vx - ax * vz)
+        ez = 2.0 * (ax * vy - ay * vx)
+
+        if self.ki > 0.0:
+            ki_dt = self.ki * time_interval
+            self.integral_x += ki_dt * ex
+            self.integral_y += ki_dt * ey
+            self.integral_z += ki_dt * ez
+            gx += self.integral_x
+            gy += self.integral_y
+            gz += self.integral_z
+        kp = self.kp
+        gx += kp * ex
+        gy += kp * ey
+        gz += kp * ez
+
+        half_dt = 0.5 * time_interval
+        gx *= half_dt
+        gy *= half_dt
+        gz *= half_dt
+        q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                          q1 + q0 * gx + q2 * gz - q3 * gy,
+                          q2 + q0 * gy - q1 * gz + q3 * gx,
+                          q3 + q0 * gz + q1 * gy - q2 * gx)
+
+        recip_norm = 1.0 / sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q0 = q0 * recip_norm
+        self.q1 = q1 * recip_norm
+        self.q2 = q2 * recip_norm
+        self.q3 = q3 * recip_norm
+
+
+class ComplementaryEstimator(_Estimator):
+    """Lightweight complementary filter.
+
+    The tilt follows the gyroscope at high frequencies and the accelerometer
+    at low frequencies, with the crossover at the given time constant. Like
+    the proportional term of Mahony's filter, the error between the measured
+    and the estimated direction of gravity turns the orientation towards the
+    measured one, but measurements whose magnitude is far from 1 g are not
+    used, e.g. while accelerating, and there are no square roots: the
+    accelerations are not normalised and the quaternion is renormalised with
+    one Newton step.
+    """
+
+    __slots__ = ("time_constant", "acceleration_threshold")
+
+    def __init__(self, time_constant=0.5, acceleration_threshold=0.2):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        time_constant : float (default 0.5)
+            Time constant in seconds in which the tilt follows the
+            accelerometer.
+        acceleration_threshold : float (default 0.2)
+            Largest relative difference of the acceleration from 1 g with
+            which the accelerometer is used. The accelerations are assumed
+            to be in g.
+        """
+        super().__init__()
+        self.time_constant = time_constant
+        self.acceleration_threshold = acceleration_threshold
+
+    def update(self, gx, gy, gz, ax, ay, az, time_interval):
+        q0 = self.q0
+        q1 = self.q1
+        q2 = self.q2
+        q3 = self.q3
+
+        # Compare the squares to avoid a square root.
+        threshold = self.acceleration_threshold
+        squared_norm = ax * ax + ay * ay + az * az
+        if ((1.0 - threshold) * (1.0 - threshold) < squared_norm
+                < (1.0 + threshold) * (1.0 + threshold)):
+            # Half of the estimated direction of gravity. The accelerations
+            # are not normalised, which changes the gain by at most the
+            # threshold.
+            vx = q1 * q3 - q0 * q2
+            vy = q0 * q1 + q2 * q3
+            vz = q0 * q0 - 0.5 + q3 * q3
+            gain = 2.0 / self.time_constant
+            gx += gain * (ay * vz - az * vy)
+            gy += gain * (az * vx - ax * vz)
+            gz += gain * (ax * vy - ay * vx)
+
+        half_dt = 0.5 * time_interval
+        gx *= half_dt
+        gy *= half_dt
+        gz *= half_dt
+        q0, q1, q2, q3 = (q0 - q1 * gx - q2 * gy - q3 * gz,
+                          q1 + q0 * gx + q2 * gz - q3 * gy,
+                          q2 + q0 * gy - q1 * gz + q3 * gx,
+                          q3 + q0 * gz + q1 * gy - q2 * gx)
+
+        # A step changes the norm only a little, so one Newton step of
+        # 1 / sqrt(x) from x = 1 is enough to keep the quaternion normalised.
+        recip_norm = 1.5 - 0.5 * (q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q0 = q0 * recip_norm
+        self.q1 = q1 * recip_norm
+        self.q2 = q2 * recip_norm
+        self.q3 = q3 * recip_norm
+
+
+ESTIMATORS = {
+    "madgwick": MadgwickEstimator,
+    "mahony": MahonyEstimator,
+    "complementary": ComplementaryEstimator,
+}
@@ -1,20 +1,102 @@
-import subprocess
-from time import sleep
+import copy
+import json
+import os
+from math import nan, pi
+from time import perf_counter_ns
 
+from drone.flight_controller.battery import UNKNOWN as BATTERY_UNKNOWN
+from drone.flight_controller.calibration import CalibrationCache
+from drone.flight_controller.command_channel import NOT_ALIVE
+from drone.flight_controller.estimators import MadgwickEstimator
 from drone.flight_controller.imu import IMU
-from drone.flight_controller.pid import PID
-from drone.flight_controller.esc import ESC
+from drone.flight_controller.metrics import (
+    ATTITUDE_UPDATE, COMMAND_INTAKE, ESC_OUTPUT, IMU_READ, MIXING, PID_UPDATE,
+    TIMING_STATISTICS, LoopMetrics)
+from drone.flight_controller.mixer import Mixer
+from drone.flight_controller.mpu6050 import MPU6050
+from drone.flight_controller.pid import MultiAxisPID
+from drone.flight_controller.esc import ESCGroup, start_pigpio_daemon
+from drone.flight_controller.scheduler import RateScheduler
+from drone.flight_controller.telemetry import MAX_MOTORS
+from drone.flight_controller.watchdog import describe_trip
+
+
+_DEGREES = 180 / pi
+
+# Keyword arguments of the MultiAxisPID controllers, each list being for the
+# yaw, pitch and roll axes in this order. The angle controller works on the
+# errors of the pitch and roll angles in degrees and of the yaw rate in
+# degrees/sec, the yaw command being a rate. Without the rate controller its
+# outputs are mixed to the pulses directly. With it the pitch and roll
+# outputs are the wanted rates in degrees/sec and the rate controller works on
+# the errors of the rates measured by the gyroscope. Beta is the gain of
+# Madgwick's filter of the IMU.
+DEFAULT_GAINS = {
+    "angle": {"p": [0.0, 0.0, 0.0], "i": [0.0, 0.0, 0.0],
+              "d": [0.0, 0.0, 0.0], "integral_limit": [100.0, 100.0, 100.0],
+              "derivative_cutoff": [30.0, 30.0, 30.0],
+              "output_limit": [300.0, 300.0, 300.0]},
+    "rate": {"p": [0.0, 0.0, 0.0], "i": [0.0, 0.0, 0.0],
+             "d": [0.0, 0.0, 0.0], "integral_limit": [100.0, 100.0, 100.0],
+             "derivative_cutoff": [60.0, 60.0, 60.0],
+             "output_limit": [300.0, 300.0, 300.0]},
+    "beta": 100,
+}
+DEFAULT_GAINS_PATH = os.path.join(os.path.expanduser("~"), ".drone",
+                                  "gains.json")
+
+
+def load_gains(path=DEFAULT_GAINS_PATH):
+    """Load gains saved with save_gains, e.g. by the auto-tuner.
+
+    The values missing from the file are taken from DEFAULT_GAINS.
+
+    Parameters
+    ----------
+    path : str (default DEFAULT_GAINS_PATH)
+
+    Returns
+    -------
+    dict
+        The gains for FlightController.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    gains = copy.deepcopy(DEFAULT_GAINS)
+    for controller in ("angle", "rate"):
+        gains[controller].update(data.get(controller, {}))
+    gains["beta"] = data.get("beta", gains["beta"])
+    return gains
+
+
+def save_gains(gains, path=DEFAULT_GAINS_PATH):
+    """Save gains for load_gains.
+
+    Parameters
+    ----------
+    gains : dict
+        See DEFAULT_GAINS.
+    path : str (default DEFAULT_GAINS_PATH)
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(gains, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
 
 
 class FlightController:
     """Flight controller for quadcopter.
 
-    The motors are indexed as follows
-    0   1
+    The motors of the default quad_x mixer are indexed as follows, front
+    being up
+    3   2
      \ /
       |
      / \
-    3   2
+    0   1
     """
 
     _min_roll = -30  # angle in degrees
@@ -28,67 +110,347 @@ class FlightController:
     # the drone is flying and the PID values are calculated.
     _flying_threshold = 1100
 
-    def __init__(self):
+    def __init__(self, loop_rate=500, recorder=None, scheduler=None,
+                 telemetry=None, telemetry_rate=50, gains=None,
+                 rate_loop=False, angle_loop_interval=2, battery=None,
+                 watchdog=None, command_timeout=1.0, realtime=None,
+                 metrics=None, metrics_rate=10, bus_manager=None,
+                 mixer=None, esc_pins=(13, 12, 24, 18)):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        loop_rate : float (default 500)
+            The rate in Hz in which the flight loop is run.
+        recorder : FlightRecorder or None (default None)
+            If given, every iteration of the flight loop is recorded.
+        scheduler : RateScheduler or None (default None)
+            Scheduler for the flight loop, e.g. one running on a simulated
+            clock. If None, a real-time scheduler with loop_rate is used.
+        telemetry : TelemetryChannel or None (default None)
+            If given, the state of the flight loop is published to it.
+        telemetry_rate : float (default 50)
+            Rate in Hz in which the telemetry is published.
+        gains : dict or None (default None)
+            Gains of the angle and rate controllers and of the IMU, see
+            DEFAULT_GAINS and load_gains. If None, DEFAULT_GAINS is used.
+        rate_loop : bool (default False)
+            Run a rate controller on the gyroscope under the angle controller.
+        angle_loop_interval : int (default 2)
+            With the rate controller, the angle controller is run only every
+            angle_loop_interval iterations.
+        battery : BatteryMonitor or None (default None)
+            If given, it is started with the flight loop, the throttle is
+            scaled with its throttle_scale to compensate for the voltage of
+            the pack and its voltage is published to the telemetry.
+        watchdog : WatchdogChannel or None (default None)
+            If given, the flight loop beats its heartbeat every iteration and
+            stops when the watchdog has tripped, see
+            drone.flight_controller.watchdog.
+        command_timeout : float (default 1.0)
+            Seconds without a message from the client after which the motors
+            are set to idle and an error is raised. The simulated and web
+            clients send a message at least every 0.5 s.
+        realtime : RealTime or None (default None)
+            If given, the flight loop is run in its real-time mode and its
+            garbage collections and page faults are added to the loop
+            statistics.
+        metrics : LoopMetrics or None (default None)
+            If given, the timing histograms of the stages of the flight loop
+            are published to it. They are always collected.
+        metrics_rate : float (default 10)
+            Rate in Hz in which the metrics are published.
+        bus_manager : I2CBusManager or None (default None)
+            If given, the MPU6050 is added to it as a real-time device read
+            at the loop rate, and its polls of the other sensors on the bus
+            are run with the flight loop.
+        mixer : Mixer or None (default None)
+            Mixes the throttle and the PID outputs to the pulses of the
+            motors. If None, a quad_x Mixer in airmode is used. The flight
+            recorder needs to record as many motors and the telemetry holds
+            at most MAX_MOTORS.
+        esc_pins : sequence of ints (default (13, 12, 24, 18))
+            The gpio pins of the ESCs in the motor order of the mixer, see
+            setup_escs. The default is the back left, back right, front right
+            and front left motors of a quad_x.
+        """
+        if gains is None:
+            gains = DEFAULT_GAINS
         self._imu = None
-        self._errors = {"yaw": None, "pitch": None, "roll": None}
-        self._pids = {"yaw": PID(0, 0, 0), "pitch": PID(0, 0, 0), "roll": PID(0, 0, 0)}
-        self._pulses = [1000, 1000, 1000, 1000]
+        # Errors and the outputs of the controllers for yaw, pitch and roll.
+        self._errors = [0.0, 0.0, 0.0]
+        self._rate_errors = [0.0, 0.0, 0.0]
+        self._angle_pid = MultiAxisPID(**gains["angle"])
+        self._rate_pid = MultiAxisPID(**gains["rate"])
+        self._beta = gains.get("beta", DEFAULT_GAINS["beta"])
+        self._rate_loop = rate_loop
+        if rate_loop:
+            self._outputs = self._rate_pid.output
+        else:
+            self._outputs = self._angle_pid.output
+        self._angle_loop_interval = angle_loop_interval
+        self._angle_loop_countdown = 0
+        self._angle_loop_dt = 0.0
+        self._previous_control_ns = None
+        if mixer is None:
+            mixer = Mixer()
+        if recorder is not None and recorder.motors != mixer.motors:
+            raise ValueError("The flight recorder records {} motors, the "
+                             "mixer has {}".format(recorder.motors,
+                                                   mixer.motors))
+        if telemetry is not None and mixer.motors > MAX_MOTORS:
+            raise ValueError("The telemetry holds at most {} motors, the "
+                             "mixer has {}".format(MAX_MOTORS, mixer.motors))
+        self._mixer = mixer
+        self._esc_pins = list(esc_pins)
+        self._pulses = [1000] * mixer.motors
         self._commands = {"throttle": 100, "yaw": 0, "pitch": 0, "roll": 0}
-        self._escs = [None, None, None, None]
+        self._escs = None
         self._flying = False
+        if scheduler is None:
+            scheduler = RateScheduler(loop_rate)
+        self._scheduler = scheduler
+        self._recorder = recorder
+        self._telemetry = telemetry
+        self._telemetry_interval = max(1, int(round(
+            self._scheduler.rate / telemetry_rate)))
+        self._telemetry_countdown = 0
+        self._battery = battery
+        self._battery_voltage = float("nan")
+        self._watchdog = watchdog
+        self._realtime = realtime
+        self._bus_manager = bus_manager
+        if metrics is None:
+            metrics = LoopMetrics(shared=False)
+        self._metrics = metrics
+        self._metrics_interval = max(1, int(round(
+            self._scheduler.rate / metrics_rate)))
+        self._metrics_countdown = 0
+        self._messages = 0
+        self._command_timeout_ns = int(command_timeout * 1e9)
+        self._previous_command_ns = 0
+        self._previous_sequence = 0
 
-    def setup(self):
+    def setup(self, imu=None, escs=None):
         """Common setup wrapper.
 
         Initialize the inertial measurement unit and the electronic speed
         controllers.
+
+        Parameters
+        ----------
+        imu : IMU or None (default None)
+            Use this calibrated IMU instead of initializing the hardware one.
+        escs : ESCGroup or None (default None)
+            Use these ESCs instead of initializing the hardware ones.
+        """
+        self.setup_imu(imu)
+        self.setup_escs(escs)
+
+    def setup_imu(self, imu=None):
+        """Initialize the inertial measurement unit.
+
+        Independent of setup_escs, so the two can be run concurrently.
+
+        Parameters
+        ----------
+        imu : IMU or None (default None)
+            Use this calibrated IMU instead of initializing the hardware one.
+        """
+        if imu is None:
+            self._initialize_imu()
+        else:
+            self._imu = imu
+
+    def setup_escs(self, escs=None):
+        """Initialize the electronic speed controllers.
+
+        Parameters
+        ----------
+        escs : ESCGroup or None (default None)
+            Use these ESCs instead of initializing the hardware ones on the
+            esc_pins.
         """
-        self._initialize_imu()
-        self._initialize_escs()
+        if escs is None:
+            self._initialize_escs(self._esc_pins)
+        else:
+            self._escs = escs
+        if len(self._escs.escs) != self._mixer.motors:
+            raise ValueError("{} ESCs for {} motors".format(
+                len(self._escs.escs), self._mixer.motors))
 
-    def loop(self, queue):
+    def loop(self, channel):
         """Flight loop.
 
         At each loop update orientation, read commands, calculate errors, PIDs
-        and pulses, and last send the pulses to the ESCs.
+        and pulses, and last send the pulses to the ESCs. The loop is run at
+        a fixed rate, the remaining time of each iteration is waited.
 
-        Use multiprocessing.Queue to receive commands. If there are no commands
-        recieved for a while, then it is assumed that something is wrong and an
-        error is raised.
+        Use a CommandChannel to receive commands. If there are no commands
+        recieved in command_timeout seconds, then it is assumed that something
+        is wrong, the motors are set to idle and an error is raised.
 
         Parameters
         ----------
-        queue : multiprocessing.Queue
+        channel : CommandChannel
         """
-        no_message_counter = 0
-        while True:
-            self._imu.update_orientation()
-            if not queue.empty():
-                no_message_counter = 0
-                data = queue.get()
-                if "alive" in data:
-                    if data["alive"] == False:
-                        print("Shutting down")
-                        return
-                if "command" in data:
-                    self._parse_commands(data["command"])
-            else:
-                no_message_counter += 1
-                if no_message_counter > 1000:
-                    raise AssertionError("No message received in 1000 epochs")
-            if self._flying:
-                self._calculate_pids()
-            else:
-                for pid in self._pids:
-                    self._pids[pid].pid = 0
-            self._calculate_pulses()
+        self._previous_sequence = channel.read().sequence
+        if self._recorder is not None:
+            imu = self._imu
+            offsets = imu.gyroscope_offsets
+            self._recorder.start(self._scheduler.rate,
+                                 (offsets["x"], offsets["y"], offsets["z"]),
+                                 (imu.q0, imu.q1, imu.q2, imu.q3),
+                                 imu.get_measurement_age())
+        if self._battery is not None:
+            self._battery.start()
+        if self._bus_manager is not None:
+            self._bus_manager.start()
+        # The threads started above would inherit the real-time mode.
+        if self._realtime is not None:
+            print("Real-time mode:")
+            for name, description in self._realtime.enter().items():
+                print("  {}: {}".format(name, description))
+            if self._recorder is not None:
+                self._recorder.set_measurement_age(
+                    self._imu.get_measurement_age())
+        self._scheduler.start()
+        self._previous_command_ns = self._scheduler.now()
+        if self._watchdog is not None:
+            self._watchdog.arm()
+        try:
+            while self._iterate(channel):
+                self._scheduler.wait()
+        finally:
+            if self._realtime is not None:
+                self._realtime.exit()
+            if self._battery is not None:
+                self._battery.stop()
+            if self._bus_manager is not None:
+                self._bus_manager.stop()
+            if self._recorder is not None:
+                self._recorder.stop()
+
+    def _iterate(self, channel):
+        """Run one iteration of the flight loop.
+
+        Parameters
+        ----------
+        channel : CommandChannel
+
+        Returns
+        -------
+        bool
+            False if the client asked to shut down or the watchdog has
+            tripped, otherwise True.
+        """
+        observe = self._metrics.observe
+        start = perf_counter_ns()
+        imu = self._imu
+        imu.update_orientation()
+        end = perf_counter_ns()
+        observe(IMU_READ, imu.read_duration_ns)
+        observe(ATTITUDE_UPDATE, end - start - imu.read_duration_ns)
+
+        start = end
+        command = channel.read()
+        if command.sequence != self._previous_sequence:
+            self._previous_sequence = command.sequence
+            self._messages += 1
+            self._previous_command_ns = self._scheduler.now()
+            if command.alive == NOT_ALIVE:
+                if self._watchdog is not None:
+                    self._watchdog.disarm()
+                print("Shutting down")
+                print(self.get_loop_statistics())
+                return False
+            self._parse_commands({"throttle": command.throttle,
+                                  "yaw": command.yaw,
+                                  "pitch": command.pitch,
+                                  "roll": command.roll})
+        elif (self._scheduler.now() - self._previous_command_ns
+              > self._command_timeout_ns):
+            self._pulses[:] = [1000] * len(self._pulses)
             self._send_pulses()
+            raise AssertionError("No message received in {} s".format(
+                self._command_timeout_ns / 1e9))
+        end = perf_counter_ns()
+        observe(COMMAND_INTAKE, end - start)
+
+        start = end
+        if self._flying:
+            self._calculate_pids()
+        elif self._previous_control_ns is not None:
+            self._reset_pids()
+        end = perf_counter_ns()
+        observe(PID_UPDATE, end - start)
+
+        start = end
+        self._calculate_pulses()
+        end = perf_counter_ns()
+        observe(MIXING, end - start)
+
+        watchdog = self._watchdog
+        if watchdog is not None:
+            # Checked just before sending, so the pulses of the watchdog are
+            # not overwritten after the trip.
+            if watchdog.tripped():
+                print(describe_trip(watchdog.get_trip()))
+                return False
+            watchdog.beat(self._commands["throttle"])
+        start = perf_counter_ns()
+        self._send_pulses()
+        observe(ESC_OUTPUT, perf_counter_ns() - start)
+
+        if self._recorder is not None:
+            self._record()
+        if self._telemetry is not None:
+            self._telemetry_countdown -= 1
+            if self._telemetry_countdown <= 0:
+                self._telemetry_countdown = self._telemetry_interval
+                self._publish_telemetry()
+        self._metrics_countdown -= 1
+        if self._metrics_countdown <= 0:
+            self._metrics_countdown = self._metrics_interval
+            self._publish_metrics()
+        return True
+
+    def get_loop_statistics(self):
+        """Get the timing statistics of the flight loop.
+
+        Returns
+        -------
+        dict
+            See RateScheduler.get_statistics, and RealTime.get_statistics in
+            the real-time mode. mixer_saturations is the number of
+            iterations in which the mixer had to fit the pulses in the range.
+        """
+        statistics = self._scheduler.get_statistics()
+        statistics["mixer_saturations"] = self._mixer.saturations
+        if self._realtime is not None:
+            statistics.update(self._realtime.get_statistics())
+        return statistics
+
+    def get_battery_state(self):
+        """Get the state of the battery for failsafes.
+
+        Returns
+        -------
+        int
+            One of UNKNOWN, OK, LOW and CRITICAL of
+            drone.flight_controller.battery, UNKNOWN without a battery
+            monitor.
+        """
+        if self._battery is None:
+            return BATTERY_UNKNOWN
+        return self._battery.state
 
     def _parse_commands(self, commands):
         """Handle inputted commands.
 
         Parse the commands and set the flying status. If throttle is set to
-        greater than 1100, then it is assumed that the drone is airborne.
+        greater than 1100, then it is assumed that the drone is airborne, and
+        the refinement of the gyroscope offsets is paused.
 
         Throttle's value stays intact.
 
@@ -116,69 +478,149 @@ class FlightController:
                 self._commands[key] = -30 + (value - 1000) * 60 / 1000
             elif key == "throttle":
                 self._commands[key] = value
-        if self._commands["throttle"] > self._flying_threshold:
-            self._flying = True
-        else:
-            self._flying = False
+        flying = self._commands["throttle"] > self._flying_threshold
+        if flying != self._flying:
+            self._flying = flying
+            # The gyroscope offsets are only refined on the ground.
+            self._imu.set_bias_tracking(not flying)
 
     def _initialize_imu(self):
-        """Connect and calibrate the inertial measurement unit."""
-        self._imu = IMU()
-        self._imu.calibrate()
+        """Connect and calibrate the inertial measurement unit.
+
+        The gyroscope offsets are cached between flights and refined while
+        the drone is still on the ground.
+        """
+        mpu6050 = None
+        if self._bus_manager is not None:
+            mpu6050 = MPU6050(bus=self._bus_manager.add_device(
+                "mpu6050", MPU6050.i2c_address, priority=0,
+                rate=self._scheduler.rate))
+        self._imu = IMU(mpu6050=mpu6050, track_gyroscope_bias=True,
+                        estimator=MadgwickEstimator(beta=self._beta))
+        if self._imu.calibrate(cache=CalibrationCache()):
+            print("Using cached gyroscope offsets")
 
-    def _initialize_escs(self, front_left_pin=18, front_right_pin=24,
-                        back_right_pin=12, back_left_pin=13):
+    def _initialize_escs(self, gpio_pins):
         """Initialize the electronic speed controllers.
 
         Sets the pulsewidths to 1000 which initializes the escs. Assuming that
         the escs have went through the first time initialization.
 
-        Starts the pigpiod daemon.
+        Starts the pigpiod daemon if it is not running.
 
         Parameters
         ----------
-        front_left_pin : int
-            The front left motor's gpio pin in the raspberry pi
-        front_right_pin : int
-            The front right motor's gpio pin in the raspberry pi
-        back_right_pin : int
-            The back right motor's gpio pin in the raspberry pi
-        back_left_pin : int
-            The back left motor's gpio pin in the raspberry pi
+        gpio_pins : list of ints
+            The gpio pins of the escs in the raspberry pi in the motor order,
+            e.g. back left, back right, front right and front left for the
+            quad_x mixer.
         """
-        subprocess.Popen("sudo pigpiod", shell=True)
-        sleep(2)
-        self._escs = [ESC(front_left_pin), ESC(front_right_pin),
-                     ESC(back_right_pin), ESC(back_left_pin)]
-        for esc in self._escs:
-            esc.set_pulsewidth(1000)
+        start_pigpio_daemon()
+        self._escs = ESCGroup(gpio_pins)
+        self._escs.set_pulsewidths([1000] * len(gpio_pins))
 
     def _calculate_pids(self):
         """Calculate the PID values.
 
-        The PID is calculated for each yaw, pitch and roll individually.
+        The PIDs of yaw, pitch and roll are stepped together with the time
+        since the previous calculation. The orientation from the IMU is in
+        radians and the commands in degrees, so the orientation is converted
+        to degrees.
         """
-        self._errors["yaw"] = self._commands["yaw"] - self._imu.yaw
-        self._errors["pitch"] = self._commands["pitch"] - self._imu.pitch
-        self._errors["roll"] = self._commands["roll"] - self._imu.roll
-        for pid in self._pids:
-            self._pids[pid].calculate(self._errors[pid])
+        imu = self._imu
+        commands = self._commands
+        now = self._scheduler.now()
+        if self._previous_control_ns is None:
+            dt = self._scheduler.period_ns / 1e9
+        else:
+            dt = (now - self._previous_control_ns) / 1e9
+        self._previous_control_ns = now
+
+        errors = self._errors
+        errors[0] = commands["yaw"] - imu.yaw_rate * _DEGREES
+        errors[1] = commands["pitch"] - imu.pitch * _DEGREES
+        errors[2] = commands["roll"] - imu.roll * _DEGREES
+        if not self._rate_loop:
+            self._angle_pid.update(errors, dt)
+            return
+
+        self._angle_loop_dt += dt
+        self._angle_loop_countdown -= 1
+        if self._angle_loop_countdown <= 0:
+            self._angle_loop_countdown = self._angle_loop_interval
+            # Yaw has no angle loop, its command is the wanted rate.
+            errors[0] = 0.0
+            self._angle_pid.update(errors, self._angle_loop_dt)
+            errors[0] = commands["yaw"] - imu.yaw_rate * _DEGREES
+            self._angle_loop_dt = 0.0
+        wanted_rates = self._angle_pid.output
+        rate_errors = self._rate_errors
+        rate_errors[0] = errors[0]
+        rate_errors[1] = wanted_rates[1] - imu.pitch_rate * _DEGREES
+        rate_errors[2] = wanted_rates[2] - imu.roll_rate * _DEGREES
+        self._rate_pid.update(rate_errors, dt)
+
+    def _reset_pids(self):
+        """Clear the controllers while on the ground."""
+        self._angle_pid.reset()
+        self._rate_pid.reset()
+        self._angle_loop_countdown = 0
+        self._angle_loop_dt = 0.0
+        self._previous_control_ns = None
 
     def _calculate_pulses(self):
         """Calculate the pulses to be send to the escs.
 
-        Uses the PID to calculate the pulsewidths.
+        Mixes the throttle and the outputs of the PIDs with the mixer. With
+        a battery monitor the throttle above the idle pulse is scaled to
+        compensate for the voltage of the pack.
         """
-        self._pulses[0] = int(self._commands["throttle"] + self._pids["roll"].pid
-                             + self._pids["pitch"].pid - self._pids["yaw"].pid)
-        self._pulses[1] = int(self._commands["throttle"] - self._pids["roll"].pid
-                             + self._pids["pitch"].pid + self._pids["yaw"].pid)
-        self._pulses[2] = int(self._commands["throttle"] - self._pids["roll"].pid
-                             - self._pids["pitch"].pid - self._pids["yaw"].pid)
-        self._pulses[3] = int(self._commands["throttle"] + self._pids["roll"].pid
-                             - self._pids["pitch"].pid + self._pids["yaw"].pid)
+        throttle = self._commands["throttle"]
+        if self._battery is not None:
+            throttle = 1000 + (throttle - 1000) * self._battery.throttle_scale
+        yaw, pitch, roll = self._outputs
+        self._mixer.mix(throttle, roll, pitch, yaw, self._pulses)
+
+    def _record(self):
+        """Append the state of this iteration to the flight recorder."""
+        imu = self._imu
+        commands = self._commands
+        errors = self._errors
+        outputs = self._outputs
+        self._recorder.record(
+            self._scheduler.now(), imu.mpu6050.raw_sample,
+            imu.q0, imu.q1, imu.q2, imu.q3,
+            commands["throttle"], commands["yaw"], commands["pitch"],
+            commands["roll"], errors[0], errors[1], errors[2],
+            outputs[0], outputs[1], outputs[2], self._pulses)
+
+    def _publish_telemetry(self):
+        """Publish the state of this iteration to the telemetry channel."""
+        imu = self._imu
+        scheduler = self._scheduler
+        period = scheduler.last_period
+        if self._battery is not None:
+            self._battery_voltage = self._battery.voltage
+        self._telemetry.publish(
+            scheduler.now(), self._flying, imu.yaw * _DEGREES,
+            imu.pitch * _DEGREES, imu.roll * _DEGREES,
+            self._commands["throttle"], self._pulses, self._battery_voltage,
+            1e9 / period if period else 0.0, scheduler.missed_deadlines)
+
+    def _publish_metrics(self):
+        """Publish the stage histograms, the loop counters and timing."""
+        scheduler = self._scheduler
+        period = scheduler.last_period
+        recorder = self._recorder
+        statistics = scheduler.get_statistics()
+        self._metrics.publish(
+            scheduler.iterations, scheduler.missed_deadlines,
+            1e9 / period if period else 0.0, self._messages,
+            self._previous_sequence,
+            recorder.queue_depth if recorder is not None else 0,
+            recorder.dropped if recorder is not None else 0,
+            *[statistics.get(name, nan) for name in TIMING_STATISTICS])
 
     def _send_pulses(self):
         """Change pulsewidths for the escs."""
-        for i in range(4):
-            self._escs[i].set_pulsewidth(self._pulses[i])
+        self._escs.set_pulsewidths(self._pulses)
@@ -0,0 +1,284 @@
+"""Shared i2c bus with prioritised access.
+
+I2CBusManager owns the handle of the bus and hands out a ManagedDevice with
+the smbus interface for every device on it, e.g. MPU6050(bus=device). A
+transaction can not be interrupted, so a slow sensor holding the bus would
+delay the IMU. The devices are therefore scheduled by priority:
+
+priority 0
+    Real-time devices, i.e. the IMU read by the flight loop. Their
+    transactions only wait for a transaction already on the bus. From their
+    rate the manager predicts when the next one is due.
+priority 1 and up
+    Slower sensors, polled at their target rates by a background thread, see
+    poll. Their transactions are started only if they fit, with their
+    longest duration so far and a guard time, before the next real-time
+    transaction is due, and otherwise deferred until after it. Among the
+    polls that are due the lowest priority number goes first.
+
+The manager keeps the bus utilisation, the number of transactions and the
+latencies of every device, see get_statistics.
+"""
+import os
+import threading
+import time
+
+from drone.flight_controller import backends
+
+
+class ManagedDevice:
+    """A device on a managed bus, with the smbus interface."""
+
+    def __init__(self, manager, name, address, priority, rate):
+        self.name = name
+        self.address = address
+        self.priority = priority
+        self.period_ns = int(1e9 / rate) if rate else None
+        # Start of the latest transaction, for predicting the next one of a
+        # real-time device.
+        self.latest_start_ns = None
+        # Longest transaction so far, starting from a conservative guess.
+        self.max_duration_ns = 500000
+        self.transactions = 0
+        self.busy_ns = 0
+        self.wait_ns = 0
+        self.max_wait_ns = 0
+        self.deferred = 0
+        self._manager = manager
+
+    def write_byte_data(self, address, register, value):
+        return self._manager._transfer(self, self._manager.bus.write_byte_data,
+                                       address, register, value)
+
+    def read_byte_data(self, address, register):
+        return self._manager._transfer(self, self._manager.bus.read_byte_data,
+                                       address, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self._manager._transfer(
+            self, self._manager.bus.read_i2c_block_data, address, register,
+            length)
+
+
+class _Poll:
+    __slots__ = ("device", "function", "period_ns", "next_ns", "runs",
+                 "missed", "errors")
+
+    def __init__(self, device, function, rate, now):
+        self.device = device
+        self.function = function
+        self.period_ns = int(1e9 / rate)
+        self.next_ns = now
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+
+
+class I2CBusManager:
+    """Owner of an i2c bus, see the module docstring."""
+
+    def __init__(self, bus=1, guard_time=0.0001, schedule=True,
+                 clock=time.perf_counter_ns, sleep=time.sleep):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        bus : int or object (default 1)
+            Number of the i2c bus, opened with the selected backend, or an
+            already opened bus with the smbus interface, e.g. a simulated one.
+        guard_time : float (default 0.0001)
+            Seconds kept free before a real-time transaction is due.
+        schedule : bool (default True)
+            If False, the transactions of all devices only take turns behind
+            a lock, e.g. for measuring what the scheduling saves.
+        clock : callable
+            Returns the current time in nanoseconds.
+        sleep : callable
+            Sleeps the given amount of seconds.
+        """
+        if isinstance(bus, int):
+            bus = backends.create("i2c", bus=bus)
+        self.bus = bus
+        self.guard_ns = int(guard_time * 1e9)
+        self.schedule = schedule
+        self.devices = {}
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._polls = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_ns = clock()
+
+    def add_device(self, name, address, priority=1, rate=None):
+        """Add a device to the bus.
+
+        Parameters
+        ----------
+        name : str
+        address : int
+            The i2c address, for the statistics. The transactions use the
+            address they are called with, like smbus.
+        priority : int (default 1)
+            0 for a real-time device, larger for less important ones.
+        rate : float or None (default None)
+            Rate in Hz in which a real-time device is read, e.g. the loop
+            rate. Needed for keeping the bus free for it.
+
+        Returns
+        -------
+        ManagedDevice
+        """
+        device = ManagedDevice(self, name, address, priority, rate)
+        self.devices[name] = device
+        return device
+
+    def poll(self, device, function, rate):
+        """Call a function that reads a device at a target rate.
+
+        The calls are made by the background thread started with start. A
+        call that is late by a whole period is skipped and counted as missed.
+
+        Parameters
+        ----------
+        device : ManagedDevice
+            A device with priority 1 or larger.
+        function : callable
+            Called without arguments, does the transactions of device.
+        rate : float
+            Target rate in Hz.
+        """
+        if device.priority == 0:
+            raise ValueError("Real-time devices are read by their owner")
+        self._polls.append(_Poll(device, function, rate, self._clock()))
+
+    def start(self):
+        """Start polling in a background thread, if anything is polled."""
+        if not self._polls:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_statistics(self):
+        """Get the bus usage of every device.
+
+        Returns
+        -------
+        dict
+            utilisation is the share of the time the bus was busy, and per
+            device in devices the share of the time it kept the bus busy,
+            the number of transactions, the mean and maximum time waited for
+            the bus in seconds, and the number of deferred transactions. For
+            polled devices also the achieved rate in Hz and the numbers of
+            missed and failed polls.
+        """
+        elapsed_ns = max(1, self._clock() - self._start_ns)
+        devices = {}
+        for name, device in self.devices.items():
+            transactions = device.transactions
+            devices[name] = {
+                "utilisation": device.busy_ns / elapsed_ns,
+                "transactions": transactions,
+                "mean_wait": (device.wait_ns / transactions / 1e9
+                              if transactions else 0.0),
+                "max_wait": device.max_wait_ns / 1e9,
+                "deferred": device.deferred,
+            }
+        for poll in self._polls:
+            devices[poll.device.name].update({
+                "rate": poll.runs * 1e9 / elapsed_ns,
+                "missed": poll.missed,
+                "errors": poll.errors,
+            })
+        return {"utilisation": sum(device.busy_ns for device
+                                   in self.devices.values()) / elapsed_ns,
+                "devices": devices}
+
+    def _transfer(self, device, function, *args):
+        """Do one transaction of a device when the bus is free for it."""
+        requested = self._clock()
+        if device.priority > 0 and self.schedule:
+            self._wait_for_window(device)
+        with self._lock:
+            start = self._clock()
+            try:
+                return function(*args)
+            finally:
+                end = self._clock()
+                duration = end - start
+                wait = start - requested
+                device.latest_start_ns = start
+                device.transactions += 1
+                device.busy_ns += duration
+                device.wait_ns += wait
+                if wait > device.max_wait_ns:
+                    device.max_wait_ns = wait
+                if duration > device.max_duration_ns or device.transactions == 1:
+                    device.max_duration_ns = duration
+
+    def _wait_for_window(self, device):
+        """Wait until a transaction of device fits before the next real-time
+        transaction."""
+        deferred = False
+        while True:
+            now = self._clock()
+            wait_ns = 0
+            for other in self.devices.values():
+                if other.priority or other.period_ns is None \
+                        or other.latest_start_ns is None:
+                    continue
+                due = other.latest_start_ns + other.period_ns
+                if now - due > other.period_ns:
+                    # The real-time device has stopped or skipped a slot.
+                    continue
+                if now + device.max_duration_ns + self.guard_ns > due:
+                    # Wait until the real-time transaction has started.
+                    wait_ns = max(wait_ns, due - now, 20000)
+            if not wait_ns:
+                if deferred:
+                    device.deferred += 1
+                return
+            deferred = True
+            self._sleep(wait_ns / 1e9)
+
+    def _poll_loop(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        polls = self._polls
+        while not self._stop.is_set():
+            now = self._clock()
+            selected = None
+            next_ns = None
+            for poll in polls:
+                if poll.next_ns <= now:
+                    if selected is None or (poll.device.priority, poll.next_ns) \
+                            < (selected.device.priority, selected.next_ns):
+                        selected = poll
+                elif next_ns is None or poll.next_ns < next_ns:
+                    next_ns = poll.next_ns
+            if selected is None:
+                timeout = 0.01 if next_ns is None else (next_ns - now) / 1e9
+                self._stop.wait(timeout)
+                continue
+            try:
+                selected.function()
+            except Exception as e:
+                selected.errors += 1
+                print("Polling {} failed: {}".format(selected.device.name, e))
+            selected.runs += 1
+            selected.next_ns += selected.period_ns
+            now = self._clock()
+            if now - selected.next_ns > selected.period_ns:
+                skipped = (now - selected.next_ns) // selected.period_ns
+                selected.missed += skipped
+                selected.next_ns += skipped * selected.period_ns
@@ -1,6 +1,13 @@
+from drone.flight_controller.calibration import (GyroscopeBiasEstimator,
+                                                 measure_gyroscope, sensor_id)
+from drone.flight_controller.estimators import MadgwickEstimator
+from drone.flight_controller.madgwick import quaternion_to_euler
 from drone.flight_controller.mpu6050 import MPU6050
 import time
-from math import sin, pi, sqrt, atan2, fabs, copysign, asin
+from math import pi
+
+
+_RADIANS = pi / 180
 
 
 class IMU:
@@ -8,155 +15,240 @@ class IMU:
 
     Module for figuring the current orientation.
     """
-    def __init__(self):
+    # Largest standard deviation of the gyroscope in degrees/sec for the
+    # module to be considered still during calibration.
+    _max_still_deviation = 0.5
+    # Largest difference in degrees/sec between the cached offsets and a quick
+    # measurement for the cached offsets to be used.
+    _max_offset_difference = 1.0
+
+    def __init__(self, use_fifo=False, mpu6050=None, clock=time.time,
+                 track_gyroscope_bias=False, estimator=None):
+        """Initialize variables and set up the MPU6050.
+
+        Parameters
+        ----------
+        use_fifo : bool (default False)
+            Let the MPU6050 sample at 1 kHz into its FIFO and integrate every
+            buffered sample with the sample period of the module as the time
+            step, instead of polling the latest sample and timing it with the
+            wall clock.
+        mpu6050 : MPU6050 or None (default None)
+            The module to use. If None, the module in the default i2c bus is
+            used.
+        clock : callable (default time.time)
+            Returns the current time in seconds. Used for the time steps when
+            the FIFO is not used.
+        track_gyroscope_bias : bool (default False)
+            Keep refining the gyroscope offsets whenever the module is still,
+            see GyroscopeBiasEstimator. Only while enabled with
+            set_bias_tracking, e.g. while on the ground.
+        estimator : estimator or None (default None)
+            Attitude estimator from drone.flight_controller.estimators. If
+            None, Madgwick's filter with beta 100 is used.
+        """
         self.roll = None
         self.pitch = None
         self.yaw = None
-        self.q0 = 1.0
-        self.q1 = 0.0
-        self.q2 = 0.0
-        self.q3 = 0.0
+        # Angular speeds around the axes of the euler angles in radians/sec.
+        self.roll_rate = 0.0
+        self.pitch_rate = 0.0
+        self.yaw_rate = 0.0
+        if estimator is None:
+            estimator = MadgwickEstimator(beta=100)
+        self.estimator = estimator
         self.gyroscope_offsets = {"x": 0.0, "y": 0.0, "z": 0.0}
         self.time_of_previous_measurement = None
-        self.mpu6050 = MPU6050()
-        self.mpu6050.setup()
+        # Duration of the MPU6050 read of the latest update_orientation.
+        self.read_duration_ns = 0
+        self.use_fifo = use_fifo
+        self._clock = clock
+        if mpu6050 is None:
+            mpu6050 = MPU6050()
+        self.mpu6050 = mpu6050
+        if track_gyroscope_bias:
+            self.bias_estimator = GyroscopeBiasEstimator(self.gyroscope_offsets)
+        else:
+            self.bias_estimator = None
+        self.bias_tracking = track_gyroscope_bias
+        if use_fifo:
+            self.mpu6050.setup(use_fifo=True, sample_rate_divider=0,
+                               dlpf_config=1)
+        else:
+            self.mpu6050.setup()
+
+    def set_bias_tracking(self, enabled):
+        """Enable or pause the refinement of the gyroscope offsets.
 
-    def calibrate(self, n=2000):
+        A steady hover or a slow turn can look still to the bias estimator,
+        so the refinement must be paused while flying.
+
+        Parameters
+        ----------
+        enabled : bool
+            Ignored without track_gyroscope_bias.
+        """
+        if self.bias_estimator is None:
+            return
+        if not enabled:
+            # Has to be still again for a while after enabling.
+            self.bias_estimator.still_for = 0.0
+        self.bias_tracking = enabled
+
+    def calibrate(self, n=2000, cache=None, quick_n=100):
         """Calculate the offsets for gyroscope.
 
         The offset is calculated using the average of the measurements.
 
+        With a cache, the offsets calibrated earlier for this module at about
+        the current temperature are used if a quick measurement shows that
+        the module is still and agrees with them. Otherwise the full
+        calibration is done and, if the module stayed still, stored to the
+        cache.
+
         Parameters
         ----------
         n : int
             Number of measurements of which the average is taken.
+        cache : CalibrationCache or None (default None)
+        quick_n : int (default 100)
+            Number of measurements in the quick check of the cached offsets.
+
+        Returns
+        -------
+        bool
+            True if the cached offsets were used.
+        """
+        from_cache = False
+        if cache is not None:
+            sensor = sensor_id(self.mpu6050)
+            temperature = self.mpu6050.get_temperature_measurement()
+            offsets = cache.load(sensor, temperature)
+            if offsets is not None:
+                means, deviations = measure_gyroscope(self.mpu6050, quick_n)
+                difference = max(abs(means[0] - offsets["x"]),
+                                 abs(means[1] - offsets["y"]),
+                                 abs(means[2] - offsets["z"]))
+                from_cache = (max(deviations) <= self._max_still_deviation
+                              and difference <= self._max_offset_difference)
+        if from_cache:
+            self.gyroscope_offsets.update(offsets)
+        else:
+            means, deviations = measure_gyroscope(self.mpu6050, n)
+            self.gyroscope_offsets["x"] = means[0]
+            self.gyroscope_offsets["y"] = means[1]
+            self.gyroscope_offsets["z"] = means[2]
+            if cache is not None and max(deviations) <= self._max_still_deviation:
+                cache.save(sensor, temperature, self.gyroscope_offsets)
+        # Start from the tilt of the module instead of level, which is far from
+        # it with the module mounted upside down.
+        (ax, ay, az), _, _ = self.mpu6050.get_measurement()
+        self.estimator.initialize(ax, ay, az)
+        self.time_of_previous_measurement = self._clock()
+        if self.use_fifo:
+            # The samples buffered during the calibration are stale.
+            self.mpu6050.reset_fifo()
+        return from_cache
+
+    @property
+    def q0(self):
+        return self.estimator.q0
+
+    @property
+    def q1(self):
+        return self.estimator.q1
+
+    @property
+    def q2(self):
+        return self.estimator.q2
+
+    @property
+    def q3(self):
+        return self.estimator.q3
+
+    def get_measurement_age(self):
+        """Get the seconds since the previous measurement, 0.0 in FIFO mode.
+
+        In polling mode this is the time step of the next update.
         """
-        gyroscope_sums = [0.0, 0.0, 0.0]
-        for _ in range(n):
-            gx, gy, gz = self.mpu6050.get_gyroscope_measurement()
-            gyroscope_sums[0] += gx
-            gyroscope_sums[1] += gy
-            gyroscope_sums[2] += gz
-        self.time_of_previous_measurement = time.time()
-        self.gyroscope_offsets["x"] = gyroscope_sums[0] / n
-        self.gyroscope_offsets["y"] = gyroscope_sums[1] / n
-        self.gyroscope_offsets["z"] = gyroscope_sums[2] / n
-
-    def update_orientation(self, beta=100):
-        """Use Madgwick's filter to calculate the orientation.
-
-        The implementation is copied from https://github.com/arduino-libraries/MadgwickAHRS/blob/master/src/MadgwickAHRS.cpp
-        and translated to python.
+        if self.use_fifo or self.time_of_previous_measurement is None:
+            return 0.0
+        return self._clock() - self.time_of_previous_measurement
+
+    def update_orientation(self, beta=None):
+        """Use the attitude estimator to calculate the orientation.
+
+        See drone.flight_controller.estimators for the implementations.
+
+        In FIFO mode every sample buffered since the previous call is
+        integrated, each with the sample period of the MPU6050 as the time
+        step. Otherwise the latest sample is read and the time step is the
+        wall clock time since the previous call.
 
         Parameters
         ----------
-        beta : float (default 100)
-            Hyperparameter to be used in the calculations of Madgwick's filter.
-            The default value has been set to 100, because that value seemed to
-            work fairly well. The only problem is that the module is flipped
-            upside down, then the orientation is oscillates badly. But this is 
-            okay for now.
+        beta : float or None (default None)
+            Hyperparameter of Madgwick's filter, used from now on. Only for
+            MadgwickEstimator, whose default of 100 seemed to work fairly
+            well. The only problem is that the module is flipped upside down,
+            then the orientation is oscillates badly. But this is okay for
+            now.
         """
-        # Calculate the time between measurements
-        # TODO: The frequency in which the MPU6050 does measurements might
-        #       affect the time interval in a wrong way, investigate this more.
-        now = time.time()
-        time_interval = now - self.time_of_previous_measurement
-        self.time_of_previous_measurement = now
-
-        # Get measurements
-        gx, gy, gz = self.mpu6050.get_gyroscope_measurement()
-        ax, ay, az = self.mpu6050.get_accelerometer_measurement()
-
-        # Substract the offsets
-        gx -= self.gyroscope_offsets["x"]
-        gy -= self.gyroscope_offsets["y"]
-        gz -= self.gyroscope_offsets["z"]
-
-        # convert degrees/sec to radians/sec
-        gx *= pi / 180
-        gy *= pi / 180
-        gz *= pi / 180
-
-        # Rate of change of quaternion from gyroscope
-        qDot1 = 0.5 * (-self.q1 * gx - self.q2 * gy - self.q3 * gz)
-        qDot2 = 0.5 * (self.q0 * gx + self.q2 * gz - self.q3 * gy)
-        qDot3 = 0.5 * (self.q0 * gy - self.q1 * gz + self.q3 * gx)
-        qDot4 = 0.5 * (self.q0 * gz + self.q1 * gy - self.q2 * gx)
-
-        # Normalise accelerometer measurement
-        recip_norm = 1.0 / sqrt(ax * ax + ay * ay + az * az)
-        ax *= recip_norm
-        ay *= recip_norm
-        az *= recip_norm
-
-        # Auxiliary variables to avoid repeated arithmetic
-        _2q0 = 2.0 * self.q0
-        _2q1 = 2.0 * self.q1
-        _2q2 = 2.0 * self.q2
-        _2q3 = 2.0 * self.q3
-        _4q0 = 4.0 * self.q0
-        _4q1 = 4.0 * self.q1
-        _4q2 = 4.0 * self.q2
-        _8q1 = 8.0 * self.q1
-        _8q2 = 8.0 * self.q2
-        q0q0 = self.q0 ** 2
-        q1q1 = self.q1 ** 2
-        q2q2 = self.q2 ** 2
-        q3q3 = self.q3 ** 2
-
-        # Gradient decent algorithm corrective step
-        s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay;
-        s1 = _4q1 * q3q3 - _2q3 * ax + 4.0 * q0q0 * self.q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
-        s2 = 4.0 * q0q0 * self.q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
-        s3 = 4.0 * q1q1 * self.q3 - _2q1 * ax + 4.0 * q2q2 * self.q3 - _2q2 * ay
-        recip_norm = 1.0 / sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)  # normalise step magnitude
-        s0 *= recip_norm
-        s1 *= recip_norm
-        s2 *= recip_norm
-        s3 *= recip_norm
-
-        # Apply feedback step
-        qDot1 -= beta * s0;
-        qDot2 -= beta * s1;
-        qDot3 -= beta * s2;
-        qDot4 -= beta * s3;
-
-        # Integrate rate of change of quaternion to yield quaternion
-        self.q0 += qDot1 / time_interval
-        self.q1 += qDot2 / time_interval
-        self.q2 += qDot3 / time_interval
-        self.q3 += qDot4 / time_interval
-
-        # Normalise quaternion
-        recip_norm = 1.0 / sqrt(self.q0 * self.q0 + self.q1 * self.q1 + self.q2 * self.q2 + self.q3 * self.q3);
-        self.q0 *= recip_norm;
-        self.q1 *= recip_norm;
-        self.q2 *= recip_norm;
-        self.q3 *= recip_norm;
-
-        # roll (x-axis rotation)
-        sinr_cosp = 2.0 * (self.q0 * self.q1 + self.q2 * self.q3)
-        cosr_cosp = 1.0 - 2.0 * (self.q1 * self.q1 + self.q2 * self.q2)
-        self.roll = atan2(sinr_cosp, cosr_cosp)
-        if self.roll < 0:
-            self.roll += pi
+        if beta is not None:
+            self.estimator.beta = beta
+        if self.use_fifo:
+            time_interval = self.mpu6050.sample_period
+            start = time.perf_counter_ns()
+            samples = self.mpu6050.read_fifo()
+            self.read_duration_ns = time.perf_counter_ns() - start
+            for (ax, ay, az), (gx, gy, gz) in samples:
+                self._integrate(gx, gy, gz, ax, ay, az, time_interval)
         else:
-            self.roll -= pi
-        
-        # pitch (y-axis rotation)
-        sinp = 2.0 * (self.q0 * self.q2 - self.q3 * self.q1)
-        if fabs(sinp) >= 1:
-            self.pitch = copysign(pi / 2, sinp) #  Use 90 degrees if out of range
-        else:
-            self.pitch = asin(sinp)
-        
-        # yaw (z-axis rotation)
-        siny_cosp = 2.0 * (self.q0 * self.q3 + self.q1 * self.q2)
-        cosy_cosp = 1.0 - 2.0 * (self.q2 * self.q2 + self.q3 * self.q3)  
-        self.yaw = atan2(siny_cosp, cosy_cosp)
+            now = self._clock()
+            time_interval = now - self.time_of_previous_measurement
+            self.time_of_previous_measurement = now
+            start = time.perf_counter_ns()
+            (ax, ay, az), (gx, gy, gz), _ = self.mpu6050.get_measurement()
+            self.read_duration_ns = time.perf_counter_ns() - start
+            self._integrate(gx, gy, gz, ax, ay, az, time_interval)
+        self._update_euler_angles()
         return self.yaw, self.pitch, self.roll
 
+    def _integrate(self, gx, gy, gz, ax, ay, az, time_interval):
+        """Do one step of the attitude estimator.
+
+        Parameters
+        ----------
+        gx, gy, gz : float
+            Angular speeds in degrees/sec, the offsets not yet substracted.
+        ax, ay, az : float
+            Accelerations in g.
+        time_interval : float
+            Time between this and the previous measurement in seconds.
+        """
+        if self.bias_tracking:
+            self.bias_estimator.update(gx, gy, gz, ax, ay, az, time_interval)
+
+        # Substract the offsets and convert degrees/sec to radians/sec
+        offsets = self.gyroscope_offsets
+        gx = (gx - offsets["x"]) * _RADIANS
+        gy = (gy - offsets["y"]) * _RADIANS
+        gz = (gz - offsets["z"]) * _RADIANS
+
+        # The module is mounted upside down, so the pitch and yaw of the euler
+        # angles turn the opposite way around the y and z axes of the module.
+        self.roll_rate = gx
+        self.pitch_rate = -gy
+        self.yaw_rate = -gz
+
+        self.estimator.update(gx, gy, gz, ax, ay, az, time_interval)
+
+    def _update_euler_angles(self):
+        """Convert the quaternion to roll, pitch and yaw in radians."""
+        estimator = self.estimator
+        self.yaw, self.pitch, self.roll = quaternion_to_euler(
+            estimator.q0, estimator.q1, estimator.q2, estimator.q3)
+
     def __repr__(self):
         return ("yaw: {:10.4f}, pitch: {:10.4f}, roll: {:10.4f}"
                 .format(self.yaw * 180 / pi, self.pitch * 180 / pi,
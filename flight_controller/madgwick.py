@@ -0,0 +1,195 @@
+"""Madgwick's orientation filter.
+
+The implementation is copied from https://github.com/arduino-libraries/MadgwickAHRS/blob/master/src/MadgwickAHRS.cpp
+and translated to python. It is used for reconstructing the orientation from
+logged samples. The live orientation in IMU is calculated with
+MadgwickEstimator from drone.flight_controller.estimators, which steps with
+madgwick_update too, so both give the same results.
+"""
+from math import pi, sqrt, atan2, fabs, copysign, asin
+
+
+def madgwick_update(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, time_interval,
+                    beta):
+    """Do one step of Madgwick's filter.
+
+    Parameters
+    ----------
+    q0, q1, q2, q3 : float
+        The current orientation quaternion.
+    gx, gy, gz : float
+        Angular speeds in radians/sec.
+    ax, ay, az : float
+        Normalised accelerations.
+    time_interval : float
+        Time between this and the previous measurement in seconds.
+    beta : float
+
+    Returns
+    -------
+    tuple of floats
+        The updated orientation quaternion.
+    """
+    # Rate of change of quaternion from gyroscope
+    qDot1 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+    qDot2 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+    qDot3 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+    qDot4 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+    # Auxiliary variables to avoid repeated arithmetic
+    _2q0 = 2.0 * q0
+    _2q1 = 2.0 * q1
+    _2q2 = 2.0 * q2
+    _2q3 = 2.0 * q3
+    _4q0 = 4.0 * q0
+    _4q1 = 4.0 * q1
+    _4q2 = 4.0 * q2
+    _8q1 = 8.0 * q1
+    _8q2 = 8.0 * q2
+    q0q0 = q0 ** 2
+    q1q1 = q1 ** 2
+    q2q2 = q2 ** 2
+    q3q3 = q3 ** 2
+
+    # Gradient decent algorithm corrective step
+    s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+    s1 = _4q1 * q3q3 - _2q3 * ax + 4.0 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+    s2 = 4.0 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+    s3 = 4.0 * q1q1 * q3 - _2q1 * ax + 4.0 * q2q2 * q3 - _2q2 * ay
+    recip_norm = 1.0 / sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)  # normalise step magnitude
+    s0 *= recip_norm
+    s1 *= recip_norm
+    s2 *= recip_norm
+    s3 *= recip_norm
+
+    # Apply feedback step
+    qDot1 -= beta * s0
+    qDot2 -= beta * s1
+    qDot3 -= beta * s2
+    qDot4 -= beta * s3
+
+    # Integrate rate of change of quaternion to yield quaternion
+    q0 += qDot1 * time_interval
+    q1 += qDot2 * time_interval
+    q2 += qDot3 * time_interval
+    q3 += qDot4 * time_interval
+
+    # Normalise quaternion
+    recip_norm = 1.0 / sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+    return q0 * recip_norm, q1 * recip_norm, q2 * recip_norm, q3 * recip_norm
+
+
+def quaternion_to_euler(q0, q1, q2, q3):
+    """Convert an orientation quaternion to yaw, pitch and roll.
+
+    Returns
+    -------
+    tuple of floats
+        Yaw, pitch and roll in radians.
+    """
+    # roll (x-axis rotation)
+    sinr_cosp = 2.0 * (q0 * q1 + q2 * q3)
+    cosr_cosp = 1.0 - 2.0 * (q1 * q1 + q2 * q2)
+    roll = atan2(sinr_cosp, cosr_cosp)
+    if roll < 0:
+        roll += pi
+    else:
+        roll -= pi
+
+    # pitch (y-axis rotation)
+    sinp = 2.0 * (q0 * q2 - q3 * q1)
+    if fabs(sinp) >= 1:
+        pitch = copysign(pi / 2, sinp)  # Use 90 degrees if out of range
+    else:
+        pitch = asin(sinp)
+
+    # yaw (z-axis rotation)
+    siny_cosp = 2.0 * (q0 * q3 + q1 * q2)
+    cosy_cosp = 1.0 - 2.0 * (q2 * q2 + q3 * q3)
+    yaw = atan2(siny_cosp, cosy_cosp)
+    return yaw, pitch, roll
+
+
+def update_orientation_batch(gyroscope, accelerometer, timestamps,
+                             gyroscope_offsets=(0.0, 0.0, 0.0), beta=100,
+                             quaternion=(1.0, 0.0, 0.0, 0.0),
+                             previous_timestamp=None):
+    """Run Madgwick's filter over logged samples.
+
+    Does the same calculations as IMU.update_orientation does for each
+    sample with the default estimator. Everything except the filter recursion itself, i.e. the offset
+    substraction, the unit conversion, the normalisation of the accelerations
+    and the conversion to euler angles, is vectorized with numpy.
+
+    The quaternions are bit-for-bit the same as with IMU.update_orientation.
+    The euler angles may differ in the last bit, because numpy's
+    trigonometric functions are not guaranteed to round like the math
+    module's.
+
+    Parameters
+    ----------
+    gyroscope : array_like, shape (n, 3)
+        Angular speeds in degrees/sec, the offsets not yet substracted.
+    accelerometer : array_like, shape (n, 3)
+        Accelerations in any unit.
+    timestamps : array_like, shape (n,)
+        Times of the samples in seconds.
+    gyroscope_offsets : sequence of floats (default (0.0, 0.0, 0.0))
+        Gyroscope offsets for x, y and z, as calculated by IMU.calibrate.
+    beta : float (default 100)
+    quaternion : sequence of floats (default (1.0, 0.0, 0.0, 0.0))
+        The orientation before the first sample.
+    previous_timestamp : float or None (default None)
+        Time of the measurement before the first sample. If None, the first
+        sample is not integrated, only the orientation is normalised.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Quaternions with shape (n, 4) and yaw, pitch and roll in radians with
+        shape (n,).
+    """
+    import numpy as np
+
+    gyroscope = np.asarray(gyroscope, dtype=np.float64)
+    accelerometer = np.asarray(accelerometer, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    n = len(timestamps)
+
+    # Substract the offsets and convert degrees/sec to radians/sec
+    gyroscope = ((gyroscope - np.asarray(gyroscope_offsets, dtype=np.float64))
+                 * (pi / 180))
+
+    # Normalise accelerometer measurements
+    ax = accelerometer[:, 0]
+    ay = accelerometer[:, 1]
+    az = accelerometer[:, 2]
+    recip_norm = 1.0 / np.sqrt(ax * ax + ay * ay + az * az)
+    accelerometer = accelerometer * recip_norm[:, np.newaxis]
+
+    time_intervals = np.empty(n)
+    time_intervals[1:] = timestamps[1:] - timestamps[:-1]
+    if previous_timestamp is None:
+        time_intervals[:1] = 0.0
+    else:
+        time_intervals[:1] = timestamps[:1] - previous_timestamp
+
+    quaternions = np.empty((n, 4))
+    q0, q1, q2, q3 = quaternion
+    for i, ((gx, gy, gz), (ax, ay, az), time_interval) in enumerate(zip(
+            gyroscope.tolist(), accelerometer.tolist(),
+            time_intervals.tolist())):
+        q0, q1, q2, q3 = madgwick_update(q0, q1, q2, q3, gx, gy, gz,
+                                         ax, ay, az, time_interval, beta)
+        quaternions[i] = q0, q1, q2, q3
+
+    q0, q1, q2, q3 = quaternions.T
+    roll = np.arctan2(2.0 * (q0 * q1 + q2 * q3),
+                      1.0 - 2.0 * (q1 * q1 + q2 * q2))
+    roll = np.where(roll < 0, roll + pi, roll - pi)
+    sinp = 2.0 * (q0 * q2 - q3 * q1)
+    pitch = np.where(np.fabs(sinp) >= 1, np.copysign(pi / 2, sinp),
+                     np.arcsin(np.clip(sinp, -1.0, 1.0)))
+    yaw = np.arctan2(2.0 * (q0 * q3 + q1 * q2),
+                     1.0 - 2.0 * (q2 * q2 + q3 * q3))
+    return quaternions, yaw, pitch, roll
@@ -0,0 +1,241 @@
+"""Timing histograms of the stages of the flight loop.
+
+Every iteration of the flight loop observes the duration of each stage into
+a fixed-bucket histogram. The observations only increment a list item, and
+the flight loop publishes the histograms to shared memory a few times a
+second, so the instrumentation can stay on in flight. The web server reads
+them and exposes them at /metrics in the Prometheus text format, see
+format_prometheus.
+
+The loop timing of RateScheduler.get_statistics, i.e. the minimum, mean and
+99th percentile of the loop period and of its jitter, is published with
+them, so it can be followed while flying.
+
+The bucket i holds the durations below 2**i microseconds (1.024 us exactly,
+since the bucket is the bit length of the duration in units of 1024 ns), and
+the last bucket the rest.
+"""
+from collections import namedtuple
+from math import isnan, nan
+
+from drone.flight_controller.seqlock import SeqlockBlock
+
+
+STAGES = ("imu_read", "attitude_update", "command_intake", "pid", "mixing",
+          "esc_output")
+IMU_READ = 0
+ATTITUDE_UPDATE = 1
+COMMAND_INTAKE = 2
+PID_UPDATE = 3
+MIXING = 4
+ESC_OUTPUT = 5
+
+BUCKETS = 16
+_LAST_BUCKET = BUCKETS - 1
+# Upper bounds of the buckets in seconds, the last one is +Inf.
+BUCKET_BOUNDS = tuple((1024 << i) / 1e9 for i in range(_LAST_BUCKET))
+
+# The timing statistics of RateScheduler.get_statistics in Metrics.
+TIMING_STATISTICS = ("min_period", "mean_period", "p99_period", "mean_jitter",
+                     "max_jitter", "p99_jitter")
+
+Metrics = namedtuple("Metrics", [
+    "sequence", "counts", "sums", "iterations", "missed_deadlines",
+    "loop_rate", "messages", "command_sequence", "recorder_queue_depth",
+    "recorder_dropped"] + list(TIMING_STATISTICS))
+Metrics.__doc__ = """Latest published metrics of the flight loop.
+
+sequence : int
+    Incremented on every publish, 0 before the first one.
+counts : tuple of tuples of ints
+    Per stage the number of observations in each bucket.
+sums : tuple of ints
+    Per stage the sum of the durations in nanoseconds.
+iterations : int
+missed_deadlines : int
+loop_rate : float
+    Rate of the flight loop in Hz over the latest iteration.
+messages : int
+    Number of new commands the flight loop has read. Less than the
+    messages written to the command channel if some were merged.
+command_sequence : int
+    Sequence of the latest command the flight loop has read.
+recorder_queue_depth : int
+    Records waiting in the ring buffer of the flight recorder.
+recorder_dropped : int
+    Records dropped by the flight recorder.
+min_period, mean_period, p99_period, mean_jitter, max_jitter, p99_jitter
+    : float
+    See RateScheduler.get_statistics, in seconds. NaN before the first
+    iteration.
+"""
+
+
+class LoopMetrics:
+    """Stage histograms of the flight loop, see the module docstring."""
+
+    def __init__(self, name=None, create=False, shared=True):
+        """Create or attach to the shared memory of the metrics.
+
+        Parameters
+        ----------
+        name : str or None (default None)
+            Name of the shared memory block of existing metrics.
+        create : bool (default False)
+            Create a new block. The creator is responsible for unlinking it.
+        shared : bool (default True)
+            If False, the histograms are only kept in this process and
+            publish does nothing.
+        """
+        size = len(STAGES) * BUCKETS
+        self._counts = [0] * size
+        self._sums = [0] * len(STAGES)
+        self._sequence = 0
+        self._block = None
+        self.name = None
+        if shared:
+            self._block = SeqlockBlock("<Q{}Q{}QQQdQQQQ{}d".format(
+                size, len(STAGES), len(TIMING_STATISTICS)), name=name,
+                create=create)
+            self.name = self._block.name
+            if create:
+                self.publish(0, 0, 0.0, 0, 0, 0, 0,
+                             *[nan] * len(TIMING_STATISTICS))
+            else:
+                self._sequence = self.read().sequence
+
+    def observe(self, stage, duration_ns):
+        """Add a duration to the histogram of a stage.
+
+        Parameters
+        ----------
+        stage : int
+            Index of the stage in STAGES, e.g. IMU_READ.
+        duration_ns : int
+        """
+        bucket = (duration_ns >> 10).bit_length()
+        if bucket > _LAST_BUCKET:
+            bucket = _LAST_BUCKET
+        self._counts[stage * BUCKETS + bucket] += 1
+        self._sums[stage] += duration_ns
+
+    def publish(self, iterations, missed_deadlines, loop_rate, messages,
+                command_sequence, recorder_queue_depth, recorder_dropped,
+                min_period, mean_period, p99_period, mean_jitter, max_jitter,
+                p99_jitter):
+        """Publish the histograms, the loop counters and the loop timing,
+        see Metrics.
+
+        Must be called from one process and thread at a time.
+        """
+        if self._block is None:
+            return
+        self._sequence += 1
+        self._block.write(self._sequence, *self._counts, *self._sums,
+                          iterations, missed_deadlines, loop_rate, messages,
+                          command_sequence, recorder_queue_depth,
+                          recorder_dropped, min_period, mean_period,
+                          p99_period, mean_jitter, max_jitter, p99_jitter)
+
+    def read(self):
+        """Get the latest published metrics.
+
+        Returns
+        -------
+        Metrics
+        """
+        values = self._block.read()
+        stages = len(STAGES)
+        size = stages * BUCKETS
+        counts = tuple(tuple(values[1 + i * BUCKETS:1 + (i + 1) * BUCKETS])
+                       for i in range(stages))
+        sums = values[1 + size:1 + size + stages]
+        return Metrics(values[0], counts, sums, *values[1 + size + stages:])
+
+    def close(self):
+        """Detach from the shared memory."""
+        if self._block is not None:
+            self._block.close()
+
+    def unlink(self):
+        """Remove the shared memory. Call only from the creator."""
+        self._block.unlink()
+
+
+def format_prometheus(metrics, command_sequence=None):
+    """Format metrics in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    metrics : Metrics
+    command_sequence : int or None (default None)
+        Sequence of the command channel, i.e. the messages the web server
+        has written. If given, it is exported with the number of the written
+        messages the flight loop has not read yet.
+
+    Returns
+    -------
+    str
+    """
+    lines = [
+        "# HELP drone_stage_duration_seconds Duration of a stage of the "
+        "flight loop.",
+        "# TYPE drone_stage_duration_seconds histogram",
+    ]
+    for stage, counts, total in zip(STAGES, metrics.counts, metrics.sums):
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, counts):
+            cumulative += count
+            lines.append('drone_stage_duration_seconds_bucket{{stage="{}",'
+                         'le="{:.9g}"}} {}'.format(stage, bound, cumulative))
+        cumulative += counts[-1]
+        lines.append('drone_stage_duration_seconds_bucket{{stage="{}",'
+                     'le="+Inf"}} {}'.format(stage, cumulative))
+        lines.append('drone_stage_duration_seconds_sum{{stage="{}"}} '
+                     '{:.9g}'.format(stage, total / 1e9))
+        lines.append('drone_stage_duration_seconds_count{{stage="{}"}} '
+                     '{}'.format(stage, cumulative))
+
+    def metric(name, kind, description, value):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.append("{} {}".format(name, value))
+
+    def timing(name, description, statistics, suffix):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        for statistic in statistics:
+            value = getattr(metrics, statistic + suffix)
+            lines.append('{}{{statistic="{}"}} {}'.format(
+                name, statistic, "NaN" if isnan(value)
+                else "{:.9g}".format(value)))
+
+    metric("drone_loop_iterations_total", "counter",
+           "Iterations of the flight loop.", metrics.iterations)
+    metric("drone_loop_missed_deadlines_total", "counter",
+           "Iterations of the flight loop that overran their deadline.",
+           metrics.missed_deadlines)
+    metric("drone_loop_rate_hz", "gauge",
+           "Rate of the flight loop over the latest iteration.",
+           "{:.6g}".format(metrics.loop_rate))
+    timing("drone_loop_period_seconds",
+           "Period of the flight loop, the p99 over the latest periods.",
+           ("min", "mean", "p99"), "_period")
+    timing("drone_loop_jitter_seconds",
+           "Difference of the period of the flight loop from the target.",
+           ("mean", "max", "p99"), "_jitter")
+    metric("drone_command_messages_total", "counter",
+           "New commands read by the flight loop.", metrics.messages)
+    if command_sequence is not None:
+        metric("drone_command_messages_written_total", "counter",
+               "Commands written by the web server.", command_sequence)
+        metric("drone_command_lag", "gauge",
+               "Commands written but not yet read by the flight loop.",
+               max(0, command_sequence - metrics.command_sequence))
+    metric("drone_recorder_queue_depth", "gauge",
+           "Records waiting in the ring buffer of the flight recorder.",
+           metrics.recorder_queue_depth)
+    metric("drone_recorder_dropped_total", "counter",
+           "Records dropped by the flight recorder.",
+           metrics.recorder_dropped)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,169 @@
+"""Motor mixing for multirotor frames.
+
+A frame is the position and spin direction of each motor in the motor
+order. From it a mixing matrix is precomputed with a row of roll, pitch and
+yaw coefficients for every motor, and the throttle is added to every motor
+equally:
+
+    pulse[i] = throttle + roll * M[i][0] + pitch * M[i][1] + yaw * M[i][2]
+
+The angles are measured counterclockwise seen from above from the front, so
+a motor at 90 degrees is on the left. A positive roll raises the motors on
+the left, a positive pitch the motors at the back and a positive yaw the
+motors spinning clockwise, the signs that match the angles of IMU. The roll
+and pitch columns are scaled so that their largest coefficient is 1.
+
+The motor order of quad_x is back left, back right, front right and front
+left, as in drone.simulation.quadcopter, and its matrix is the mix the
+flight controller has always used. The ESCs need to be given in the motor
+order of the frame, see FlightController.
+
+The pulses of a motor are limited, so a large attitude correction would be
+clipped by the ESCs and the drone would lose the correction on that axis.
+In airmode, Mixer keeps the spread of the attitude corrections within the
+pulse range, giving up yaw first and then scaling roll and pitch together,
+and shifts the throttle so that all motors are within the range.
+"""
+from math import cos, radians, sin
+
+
+# Motor angles in degrees and spin directions, 1 for clockwise, in the motor
+# order.
+FRAMES = {
+    "quad_x": ((135, -1), (225, 1), (315, -1), (45, 1)),
+    "quad_plus": ((180, -1), (270, 1), (0, -1), (90, 1)),
+    "hexa": ((150, -1), (210, 1), (270, -1), (330, 1), (30, -1), (90, 1)),
+    "octo": ((157.5, -1), (202.5, 1), (247.5, -1), (292.5, 1), (337.5, -1),
+             (22.5, 1), (67.5, -1), (112.5, 1)),
+}
+
+
+def mixing_matrix(motors):
+    """Compute the mixing matrix of a frame.
+
+    Parameters
+    ----------
+    motors : sequence of tuples
+        The angle in degrees and the spin direction of each motor, see
+        FRAMES.
+
+    Returns
+    -------
+    tuple of tuples of floats
+        The roll, pitch and yaw coefficients of each motor.
+    """
+    rolls = [sin(radians(angle)) for angle, _ in motors]
+    pitches = [-cos(radians(angle)) for angle, _ in motors]
+    roll_scale = max(abs(roll) for roll in rolls)
+    pitch_scale = max(abs(pitch) for pitch in pitches)
+    # Rounded, so e.g. the quad_x coefficients are exactly 1.
+    return tuple((round(roll / roll_scale, 12) + 0.0,
+                  round(pitch / pitch_scale, 12) + 0.0,
+                  float(direction))
+                 for roll, pitch, (_, direction)
+                 in zip(rolls, pitches, motors))
+
+
+class Mixer:
+    """Mixes the throttle and the PID outputs to pulses, see the module
+    docstring."""
+
+    def __init__(self, frame="quad_x", min_output=1000, max_output=1900,
+                 airmode=True):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        frame : str or sequence of tuples (default "quad_x")
+            A name in FRAMES or the angles and spin directions of the motors.
+        min_output : float (default 1000)
+            Pulsewidth of an idle motor.
+        max_output : float (default 1900)
+            Largest pulsewidth, as in ESC.set_pulsewidth.
+        airmode : bool (default True)
+            Keep the attitude corrections within the pulse range. If False,
+            the pulses are only mixed and the ESCs clip them.
+        """
+        if isinstance(frame, str):
+            frame = FRAMES[frame]
+        self.matrix = mixing_matrix(frame)
+        self.motors = len(self.matrix)
+        self.min_output = min_output
+        self.max_output = max_output
+        self.airmode = airmode
+        # Iterations in which the attitude corrections pushed a pulse out of
+        # the range.
+        self.saturations = 0
+        self._span = max_output - min_output
+
+    def mix(self, throttle, roll, pitch, yaw, pulses):
+        """Mix the pulses of the motors.
+
+        Parameters
+        ----------
+        throttle : float
+        roll, pitch, yaw : float
+            The outputs of the PIDs.
+        pulses : list
+            Set to the pulsewidths as ints, in the motor order.
+        """
+        if self.airmode:
+            if throttle < self.min_output:
+                throttle = self.min_output
+            elif throttle > self.max_output:
+                throttle = self.max_output
+        # Summed in this order, a pulse within the range is the same as
+        # with the quad_x mix written out.
+        values = [throttle + roll * r + pitch * p + yaw * y
+                  for r, p, y in self.matrix]
+        if self.airmode:
+            low = min(values)
+            high = max(values)
+            if low < self.min_output or high > self.max_output:
+                values = self._saturate(throttle, roll, pitch, yaw,
+                                        low - throttle, high - throttle)
+        for i, value in enumerate(values):
+            pulses[i] = int(value)
+
+    def _saturate(self, throttle, roll, pitch, yaw, low, high):
+        """Fit the pulses in the range.
+
+        If the attitude corrections are too far apart for the range, they
+        are reduced: yaw first, to the largest share that fits with the
+        whole roll and pitch. If roll and pitch alone do not fit, they are
+        scaled down together and yaw is dropped. Then the throttle is moved
+        so that every pulse is in the range.
+        """
+        self.saturations += 1
+        span = self._span
+        matrix = self.matrix
+        tilts = [roll * r + pitch * p for r, p, _ in matrix]
+        yaws = [yaw * y for _, _, y in matrix]
+        if high - low <= span:
+            corrections = [tilt + value for tilt, value in zip(tilts, yaws)]
+        else:
+            spread = max(tilts) - min(tilts)
+            if spread > span:
+                scale = span / spread
+                corrections = [tilt * scale for tilt in tilts]
+            else:
+                share = 1.0
+                # Each pair of motors limits the yaw by the room their tilts
+                # leave.
+                for i in range(self.motors):
+                    for j in range(self.motors):
+                        difference = yaws[i] - yaws[j]
+                        if difference > 0:
+                            share = min(share, (span - tilts[i] + tilts[j])
+                                        / difference)
+                corrections = [tilt + share * value
+                               for tilt, value in zip(tilts, yaws)]
+            low = min(corrections)
+            high = max(corrections)
+        if throttle + low < self.min_output:
+            throttle = self.min_output - low
+        elif throttle + high > self.max_output:
+            throttle = self.max_output - high
+        # Clamped against the rounding of the sums.
+        return [min(max(throttle + correction, self.min_output),
+                    self.max_output) for correction in corrections]
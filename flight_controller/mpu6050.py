@@ -1,4 +1,6 @@
-import smbus
+import struct
+
+from drone.flight_controller import backends
 
 
 class MPU6050:
@@ -14,9 +16,17 @@ class MPU6050:
     # Register addresses.
     # For register specs, see https://www.invensense.com/wp-content/uploads/2015/02/MPU-6000-Register-Map1.pdf
     PWR_MGMT_1 = 0x6B
+    SMPLRT_DIV = 0x19
+    CONFIG = 0x1A
+    FIFO_EN = 0x23
+    USER_CTRL = 0x6A
+    FIFO_COUNT_H = 0x72
+    FIFO_COUNT_L = 0x73
+    FIFO_R_W = 0x74
     ACCEL_CONFIG = 0x1B
     GYRO_CONFIG = 0x1C
-    
+    WHO_AM_I = 0x75
+
     ACCEL_XOUT_H = 0x3B
     ACCEL_XOUT_L = 0x3C
     ACCEL_YOUT_H = 0x3D
@@ -24,26 +34,106 @@ class MPU6050:
     ACCEL_ZOUT_H = 0x3F
     ACCEL_ZOUT_L = 0x40
 
+    TEMP_OUT_H = 0x41
+    TEMP_OUT_L = 0x42
+
     GYRO_XOUT_H = 0x43
     GYRO_XOUT_L = 0x44
     GYRO_YOUT_H = 0x45
     GYRO_YOUT_L = 0x46
     GYRO_ZOUT_H = 0x47
     GYRO_ZOUT_L = 0x48
-    
+
+    # The accelerometer, temperature and gyroscope registers are consecutive,
+    # so a single 14 byte block read starting from ACCEL_XOUT_H returns one
+    # coherent sample as seven big-endian signed 16-bit words.
+    _SENSOR_REGISTERS_LENGTH = 14
+    _SENSOR_REGISTERS = struct.Struct(">7h")
+
+    # FIFO_EN bits for the accelerometer and the x, y and z gyroscope. With
+    # these enabled one FIFO sample is the accelerometer registers followed
+    # by the gyroscope registers, twelve bytes in total.
+    _FIFO_SENSORS = 0b01111000
+    _FIFO_SAMPLE = struct.Struct(">6h")
+    _FIFO_SIZE = 1024
+    # USER_CTRL bits
+    _FIFO_ENABLE = 0b01000000
+    _FIFO_RESET = 0b00000100
+    # smbus block reads are limited to 32 bytes, so the FIFO is drained two
+    # samples at a time.
+    _FIFO_READ_LENGTH = 24
+
     def __init__(self, bus=1):
-        self.bus = smbus.SMBus(bus)
+        """Initialize variables.
+
+        Parameters
+        ----------
+        bus : int or object (default 1)
+            Number of the i2c bus, opened with the selected backend, or an
+            already opened bus with the smbus interface, e.g. a simulated one.
+        """
+        if isinstance(bus, int):
+            self.bus_number = bus
+            bus = backends.create("i2c", bus=bus)
+        else:
+            self.bus_number = None
+        self.bus = bus
         self.accelerometer_scale_factor = None
         self.gyroscope_scale_factor = None
+        self.sample_period = None
+        self.fifo_enabled = False
+        self.fifo_overflows = 0
+        # The latest raw sample as accelerometer x, y, z, temperature and
+        # gyroscope x, y, z. The FIFO does not contain the temperature, so in
+        # FIFO mode it is the latest directly read temperature.
+        self.raw_sample = (0, 0, 0, 0, 0, 0, 0)
 
-    def setup(self):
+    def setup(self, use_fifo=False, sample_rate_divider=0, dlpf_config=0):
         """Common setup routine for the module.
 
-        Turns on the power and configures the accelerometer and gyroscope.
+        Turns on the power, configures the sample rate, the digital low pass
+        filter, the accelerometer and gyroscope and optionally the FIFO.
+
+        Parameters
+        ----------
+        use_fifo : bool (default False)
+            Buffer every sample in the FIFO of the module. The samples are then
+            read with read_fifo.
+        sample_rate_divider : int (default 0)
+            The sample rate is the gyroscope output rate divided by
+            1 + sample_rate_divider.
+        dlpf_config : int (default 0)
+            Digital low pass filter configuration 0-7. The gyroscope output
+            rate is 8 kHz when the filter is disabled (0 or 7) and 1 kHz
+            otherwise.
         """
         self.bus.write_byte_data(self.i2c_address, self.PWR_MGMT_1, 0x00)
+        self.bus.write_byte_data(self.i2c_address, self.CONFIG, dlpf_config)
+        self.bus.write_byte_data(self.i2c_address, self.SMPLRT_DIV,
+                                 sample_rate_divider)
+        if dlpf_config in (0, 7):
+            gyroscope_output_rate = 8000.0
+        else:
+            gyroscope_output_rate = 1000.0
+        self.sample_period = (1 + sample_rate_divider) / gyroscope_output_rate
         self.setup_accelerometer()
         self.setup_gyroscope()
+        if use_fifo:
+            self.setup_fifo()
+
+    def setup_fifo(self):
+        """Enable buffering of the accelerometer and gyroscope in the FIFO."""
+        self.bus.write_byte_data(self.i2c_address, self.FIFO_EN,
+                                 self._FIFO_SENSORS)
+        self.fifo_enabled = True
+        self.reset_fifo()
+
+    def reset_fifo(self):
+        """Throw away the samples in the FIFO and keep buffering."""
+        self.bus.write_byte_data(self.i2c_address, self.USER_CTRL,
+                                 self._FIFO_RESET)
+        self.bus.write_byte_data(self.i2c_address, self.USER_CTRL,
+                                 self._FIFO_ENABLE)
 
     def setup_accelerometer(self):
         """Initialize accelerometer registers."""
@@ -55,6 +145,29 @@ class MPU6050:
         self.bus.write_byte_data(self.i2c_address, self.GYRO_CONFIG, 0b00000000)
         self.gyroscope_scale_factor = 131.0
 
+    def get_measurement(self):
+        """Get accelerations, angular speeds and temperature in one read.
+
+        All the sensor registers are read in a single i2c transaction, so the
+        accelerometer and gyroscope values are from the same sample.
+
+        Returns
+        -------
+        tuple
+            Accelerations for x, y and z, angular speeds around x, y and z and
+            the temperature in degrees Celsius, i.e.
+            ``((ax, ay, az), (gx, gy, gz), temperature)``.
+        """
+        raw_ax, raw_ay, raw_az, raw_t, raw_gx, raw_gy, raw_gz = \
+            self._read_sensor_registers()
+        accelerometer = (raw_ax / self.accelerometer_scale_factor,
+                         raw_ay / self.accelerometer_scale_factor,
+                         raw_az / self.accelerometer_scale_factor)
+        gyroscope = (raw_gx / self.gyroscope_scale_factor,
+                     raw_gy / self.gyroscope_scale_factor,
+                     raw_gz / self.gyroscope_scale_factor)
+        return accelerometer, gyroscope, self._convert_temperature(raw_t)
+
     def get_accelerometer_measurement(self):
         """Get accelerations for each axis
 
@@ -63,11 +176,7 @@ class MPU6050:
         tuple of floats
             Accelerations for x, y and z in the given order
         """
-        raw_x, raw_y, raw_z = self._read_accelerometer_registers()
-        x = raw_x / self.accelerometer_scale_factor
-        y = raw_y / self.accelerometer_scale_factor
-        z = raw_z / self.accelerometer_scale_factor
-        return x, y, z
+        return self.get_measurement()[0]
 
     def get_gyroscope_measurement(self):
         """Get angular speeds around each axis.
@@ -77,27 +186,93 @@ class MPU6050:
         tuple of floats
             Angular speeds around x, y and z in the given order
         """
-        raw_x, raw_y, raw_z = self._read_gyroscope_registers()
-        x = raw_x / self.gyroscope_scale_factor
-        y = raw_y / self.gyroscope_scale_factor
-        z = raw_z / self.gyroscope_scale_factor
-        return x, y, z
-
-    def _read_accelerometer_registers(self):
-        x = self._read_word_2c(self.ACCEL_XOUT_H)
-        y = self._read_word_2c(self.ACCEL_YOUT_H)
-        z = self._read_word_2c(self.ACCEL_ZOUT_H)
-        return x, y, z
-
-    def _read_gyroscope_registers(self):
-        x = self._read_word_2c(self.GYRO_XOUT_H)
-        y = self._read_word_2c(self.GYRO_YOUT_H)
-        z = self._read_word_2c(self.GYRO_ZOUT_H)
-        return x, y, z
-
-    def _read_word_2c(self, register):
-        high, low = self.bus.read_i2c_block_data(self.i2c_address, register, 2)
-        value = high << 8 | low
-        if value >= 0x8000:
-            return -((65535 - value) + 1)
-        return value
+        return self.get_measurement()[1]
+
+    def get_temperature_measurement(self):
+        """Get the temperature of the module.
+
+        Returns
+        -------
+        float
+            Temperature in degrees Celsius.
+        """
+        return self.get_measurement()[2]
+
+    def read_who_am_i(self):
+        """Read the WHO_AM_I register.
+
+        Returns
+        -------
+        int
+            The upper six bits of the i2c address of the module, 0x68 for a
+            genuine MPU6050.
+        """
+        return self.bus.read_byte_data(self.i2c_address, self.WHO_AM_I)
+
+    def read_fifo(self, max_samples=None):
+        """Drain the samples buffered in the FIFO.
+
+        The samples are read with as few block reads as possible. If the FIFO
+        has overflowed, the sample boundaries can not be trusted anymore, so
+        the FIFO is reset and no samples are returned.
+
+        Parameters
+        ----------
+        max_samples : int or None (default None)
+            Read at most this many samples. The rest are left in the FIFO.
+
+        Returns
+        -------
+        list of tuples
+            Samples from the oldest to the newest as
+            ``((ax, ay, az), (gx, gy, gz))``. Consecutive samples are
+            sample_period seconds apart.
+        """
+        high, low = self.bus.read_i2c_block_data(self.i2c_address,
+                                                 self.FIFO_COUNT_H, 2)
+        count = high << 8 | low
+        if count >= self._FIFO_SIZE:
+            self.fifo_overflows += 1
+            self.reset_fifo()
+            return []
+        n = count // self._FIFO_SAMPLE.size
+        if max_samples is not None and n > max_samples:
+            n = max_samples
+        remaining = n * self._FIFO_SAMPLE.size
+        data = bytearray()
+        while remaining > 0:
+            length = min(remaining, self._FIFO_READ_LENGTH)
+            data += bytes(self.bus.read_i2c_block_data(self.i2c_address,
+                                                       self.FIFO_R_W, length))
+            remaining -= length
+        if data:
+            ax, ay, az, gx, gy, gz = self._FIFO_SAMPLE.unpack_from(
+                data, len(data) - self._FIFO_SAMPLE.size)
+            self.raw_sample = (ax, ay, az, self.raw_sample[3], gx, gy, gz)
+        accelerometer_scale = self.accelerometer_scale_factor
+        gyroscope_scale = self.gyroscope_scale_factor
+        return [((ax / accelerometer_scale, ay / accelerometer_scale,
+                  az / accelerometer_scale),
+                 (gx / gyroscope_scale, gy / gyroscope_scale,
+                  gz / gyroscope_scale))
+                for ax, ay, az, gx, gy, gz in self._FIFO_SAMPLE.iter_unpack(data)]
+
+    def _read_sensor_registers(self):
+        """Read ACCEL_XOUT_H through GYRO_ZOUT_L in one transaction.
+
+        Returns
+        -------
+        tuple of ints
+            Raw signed values for accelerometer x, y, z, temperature and
+            gyroscope x, y, z in the given order.
+        """
+        data = self.bus.read_i2c_block_data(self.i2c_address,
+                                            self.ACCEL_XOUT_H,
+                                            self._SENSOR_REGISTERS_LENGTH)
+        self.raw_sample = self._SENSOR_REGISTERS.unpack(bytes(data))
+        return self.raw_sample
+
+    @staticmethod
+    def _convert_temperature(raw):
+        # Conversion from the register map, section 4.18.
+        return raw / 340.0 + 36.53
@@ -1,7 +1,139 @@
+from math import inf, pi
+
+
+class MultiAxisPID:
+    """Proportional, Integral and Derivative controller for several axes.
+
+    All the axes are stepped with one call of update. The state of every axis
+    is kept in lists indexed by the axis, so a step does no dict lookups and
+    allocates nothing.
+
+    The integral term is accumulated in the units of the output and clamped
+    to the integral limit, so it can not wind up while the output saturates.
+    The derivative of the error is low pass filtered, because the raw
+    derivative of a noisy error is mostly noise.
+    """
+
+    __slots__ = ("p", "i", "d", "integral_limit", "output_limit",
+                 "integral", "derivative", "previous_error", "output",
+                 "primed", "_time_constants", "_axes")
+
+    def __init__(self, p, i, d, integral_limit=None, derivative_cutoff=None,
+                 output_limit=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        p, i, d : list of floats
+            Gains of each axis. The integral and derivative gains are per
+            second of the time step.
+        integral_limit : list of floats or None (default None)
+            Largest absolute value of the integral term of each axis, in the
+            units of the output. None for no limits.
+        derivative_cutoff : list of floats or None (default None)
+            Cutoff frequency in Hz of the derivative filter of each axis. 0 or
+            None for an unfiltered derivative.
+        output_limit : list of floats or None (default None)
+            Largest absolute value of the output of each axis. None for no
+            limits.
+        """
+        axes = len(p)
+        self._axes = axes
+        self.p = list(p)
+        self.i = list(i)
+        self.d = list(d)
+        self.integral_limit = (list(integral_limit) if integral_limit
+                               is not None else [inf] * axes)
+        self.output_limit = (list(output_limit) if output_limit is not None
+                             else [inf] * axes)
+        if derivative_cutoff is None:
+            derivative_cutoff = [0.0] * axes
+        self._time_constants = [1.0 / (2 * pi * cutoff) if cutoff else 0.0
+                                for cutoff in derivative_cutoff]
+        self.integral = [0.0] * axes
+        self.derivative = [0.0] * axes
+        self.previous_error = [0.0] * axes
+        self.output = [0.0] * axes
+        # Until the first update there is no previous error to take the
+        # derivative against.
+        self.primed = False
+
+    def update(self, errors, dt):
+        """Step every axis.
+
+        Parameters
+        ----------
+        errors : list of floats
+            Error between the wanted and the measured value of each axis.
+        dt : float
+            Time since the previous update in seconds.
+
+        Returns
+        -------
+        list of floats
+            The output of each axis. The same list is updated in place on
+            every call.
+        """
+        p = self.p
+        i = self.i
+        d = self.d
+        integral_limit = self.integral_limit
+        output_limit = self.output_limit
+        integral = self.integral
+        derivative = self.derivative
+        previous_error = self.previous_error
+        time_constants = self._time_constants
+        output = self.output
+        if not self.primed:
+            # No previous error yet, so start with a zero derivative.
+            for k in range(self._axes):
+                previous_error[k] = errors[k]
+        for k in range(self._axes):
+            error = errors[k]
+
+            value = integral[k] + i[k] * error * dt
+            limit = integral_limit[k]
+            if value > limit:
+                value = limit
+            elif value < -limit:
+                value = -limit
+            integral[k] = value
+
+            # First order low pass filter of the derivative with the time
+            # constant tau, d += dt / (dt + tau) * (de / dt - d).
+            tau = time_constants[k]
+            derivative[k] = ((tau * derivative[k] + error - previous_error[k])
+                             / (tau + dt))
+            previous_error[k] = error
+
+            value += p[k] * error + d[k] * derivative[k]
+            limit = output_limit[k]
+            if value > limit:
+                value = limit
+            elif value < -limit:
+                value = -limit
+            output[k] = value
+        self.primed = True
+        return output
+
+    def reset(self):
+        """Clear the state of every axis, e.g. when the drone has landed."""
+        for k in range(self._axes):
+            self.integral[k] = 0.0
+            self.derivative[k] = 0.0
+            self.previous_error[k] = 0.0
+            self.output[k] = 0.0
+        self.primed = False
+
+
 class PID:
     """Proportional, Integral and Derivative controller.
 
     PID is an algorithm used to calculate actions for given state.
+
+    Kept for compatibility, a single axis MultiAxisPID stepped with a time
+    step of 1 and the derivative taken against a previous error of 0 on the
+    first call, like the original implementation.
     """
     def __init__(self, p, i, d):
         """Initialize variables.
@@ -12,12 +144,41 @@ class PID:
         i : float
         d : float
         """
-        self.pid = 0
-        self.p = p
-        self.i = i
-        self.d = d
-        self._error_sum = 0.0
-        self._previous_error = 0.0
+        self._controller = MultiAxisPID([p], [i], [d])
+        self._controller.primed = True
+        self._error = [0.0]
+
+    @property
+    def pid(self):
+        return self._controller.output[0]
+
+    @pid.setter
+    def pid(self, value):
+        self._controller.output[0] = value
+
+    @property
+    def p(self):
+        return self._controller.p[0]
+
+    @p.setter
+    def p(self, value):
+        self._controller.p[0] = value
+
+    @property
+    def i(self):
+        return self._controller.i[0]
+
+    @i.setter
+    def i(self, value):
+        self._controller.i[0] = value
+
+    @property
+    def d(self):
+        return self._controller.d[0]
+
+    @d.setter
+    def d(self, value):
+        self._controller.d[0] = value
 
     def calculate(self, error):
         """Calculate the actions to be done.
@@ -32,12 +193,5 @@ class PID:
         float
             Value of the PID calculation.
         """
-        # I
-        self._error_sum += error
-        
-        # D
-        delta_error = error - self._previous_error
-        self._previous_error = error
-        
-        # PID
-        self.pid = (error * self.p) + (self._error_sum * self.i) + (delta_error * self.d)
+        self._error[0] = error
+        return self._controller.update(self._error, 1.0)[0]
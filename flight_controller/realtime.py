@@ -0,0 +1,229 @@
+"""Real-time mode for the thread of the flight loop.
+
+RealTime.enter pins the calling thread to one CPU, asks for the SCHED_FIFO
+scheduling policy, locks the memory of the process with mlockall, and
+freezes and disables the cyclic garbage collector. Each of these is applied
+when permitted and otherwise skipped, and enter reports what was applied
+and why not. The scheduling policy and CPU affinity of a thread are
+inherited by the threads it starts later, so the threads of the flight
+recorder and the battery monitor are started before enter.
+
+For the CPU to be dedicated, everything else has to be kept off it: call
+exclude_cpu early in the parent process so its children inherit it, and
+use the isolcpus kernel parameter for the system daemons, e.g. hostapd and
+dnsmasq.
+
+While in the real-time mode, the garbage collections and page faults of the
+flight loop are counted, see RealTime.get_statistics. With the collector
+disabled any collection is an explicit gc.collect somewhere, and page faults
+in flight mean memory that was not locked or touched before.
+"""
+import ctypes
+import ctypes.util
+import gc
+import os
+import resource
+import time
+
+
+# Flags of mlockall in <sys/mman.h>.
+_MCL_CURRENT = 1
+_MCL_FUTURE = 2
+
+# The usage of the calling thread, on Linux only.
+_RUSAGE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+
+def exclude_cpu(cpu, pid=0):
+    """Keep a process or thread off a CPU.
+
+    Parameters
+    ----------
+    cpu : int or None
+        The CPU to keep free, e.g. RealTime.cpu. Nothing is done if None or
+        if it is the only CPU.
+    pid : int (default 0)
+        The process or thread, 0 for the calling one. Children started
+        later inherit the affinity.
+
+    Returns
+    -------
+    bool
+        Whether the affinity was changed.
+    """
+    if cpu is None or not hasattr(os, "sched_setaffinity"):
+        return False
+    others = os.sched_getaffinity(pid) - {cpu}
+    if not others:
+        return False
+    try:
+        os.sched_setaffinity(pid, others)
+    except OSError:
+        return False
+    return True
+
+
+class RealTime:
+    """Real-time mode, see the module docstring."""
+
+    def __init__(self, cpu=None, priority=50, lock_memory=True,
+                 control_gc=True):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        cpu : int or None (default None)
+            The CPU to pin the flight loop to. If None, the last one the
+            process may run on. Not pinned if the process may run on only
+            one CPU.
+        priority : int (default 50)
+            SCHED_FIFO priority, 1-99. Kernel threads handling interrupts
+            run at 50. If 0, the scheduling policy is not changed.
+        lock_memory : bool (default True)
+            Lock the current and future memory of the process in RAM.
+        control_gc : bool (default True)
+            Collect, freeze and disable the cyclic garbage collector.
+        """
+        if cpu is None and hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            if len(cpus) > 1:
+                cpu = cpus[-1]
+        self.cpu = cpu
+        self.priority = priority
+        self.lock_memory = lock_memory
+        self.control_gc = control_gc
+        self.applied = {}
+        self._gc_was_enabled = None
+        self._previous_policy = None
+        self._gc_collections = 0
+        self._gc_pause_ns = 0
+        self._gc_max_pause_ns = 0
+        self._gc_start_ns = 0
+        self._start_faults = (0, 0)
+
+    def enter(self):
+        """Apply the real-time mode to the calling thread.
+
+        Returns
+        -------
+        dict
+            For each of "affinity", "scheduler", "mlockall" and "gc", a
+            description of what was applied or why it was not. Whether each
+            was applied is in the applied attribute.
+        """
+        report = {}
+        report["affinity"] = self._pin()
+        report["scheduler"] = self._set_scheduler()
+        report["mlockall"] = self._lock_memory()
+        report["gc"] = self._control_gc()
+        gc.callbacks.append(self._on_gc)
+        self._start_faults = self._faults()
+        return report
+
+    def exit(self):
+        """Restore the garbage collector and the scheduling policy.
+
+        The CPU affinity and the locked memory are kept.
+        """
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        if self._gc_was_enabled is not None:
+            gc.unfreeze()
+            if self._gc_was_enabled:
+                gc.enable()
+            self._gc_was_enabled = None
+        if self._previous_policy is not None:
+            policy, priority = self._previous_policy
+            try:
+                os.sched_setscheduler(0, policy, os.sched_param(priority))
+            except OSError:
+                pass
+            self._previous_policy = None
+
+    def get_statistics(self):
+        """Get the garbage collections and page faults since enter.
+
+        Returns
+        -------
+        dict
+            gc_collections, gc_pause_total and gc_pause_max in seconds, and
+            minor_page_faults and major_page_faults of the flight loop.
+        """
+        minor, major = self._faults()
+        return {"gc_collections": self._gc_collections,
+                "gc_pause_total": self._gc_pause_ns / 1e9,
+                "gc_pause_max": self._gc_max_pause_ns / 1e9,
+                "minor_page_faults": minor - self._start_faults[0],
+                "major_page_faults": major - self._start_faults[1]}
+
+    def _pin(self):
+        if self.cpu is None:
+            self.applied["affinity"] = False
+            return "not pinned, only one CPU"
+        try:
+            os.sched_setaffinity(0, {self.cpu})
+        except (AttributeError, OSError) as e:
+            self.applied["affinity"] = False
+            return "not pinned to CPU {}: {}".format(self.cpu, e)
+        self.applied["affinity"] = True
+        return "pinned to CPU {}".format(self.cpu)
+
+    def _set_scheduler(self):
+        if not self.priority:
+            self.applied["scheduler"] = False
+            return "not changed"
+        try:
+            previous = (os.sched_getscheduler(0),
+                        os.sched_getparam(0).sched_priority)
+            os.sched_setscheduler(0, os.SCHED_FIFO,
+                                  os.sched_param(self.priority))
+        except (AttributeError, OSError) as e:
+            self.applied["scheduler"] = False
+            return "SCHED_FIFO not permitted: {}".format(e)
+        self._previous_policy = previous
+        self.applied["scheduler"] = True
+        return "SCHED_FIFO priority {}".format(self.priority)
+
+    def _lock_memory(self):
+        if not self.lock_memory:
+            self.applied["mlockall"] = False
+            return "not requested"
+        name = ctypes.util.find_library("c")
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            result = libc.mlockall(_MCL_CURRENT | _MCL_FUTURE)
+        except (AttributeError, OSError) as e:
+            self.applied["mlockall"] = False
+            return "not available: {}".format(e)
+        if result != 0:
+            self.applied["mlockall"] = False
+            return "not permitted: {}".format(os.strerror(ctypes.get_errno()))
+        self.applied["mlockall"] = True
+        return "memory locked"
+
+    def _control_gc(self):
+        if not self.control_gc:
+            self.applied["gc"] = False
+            return "not requested"
+        self._gc_was_enabled = gc.isenabled()
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.applied["gc"] = True
+        return "frozen {} objects and disabled".format(gc.get_freeze_count())
+
+    def _on_gc(self, phase, info):
+        now = time.perf_counter_ns()
+        if phase == "start":
+            self._gc_start_ns = now
+            return
+        pause = now - self._gc_start_ns
+        self._gc_collections += 1
+        self._gc_pause_ns += pause
+        if pause > self._gc_max_pause_ns:
+            self._gc_max_pause_ns = pause
+
+    @staticmethod
+    def _faults():
+        usage = resource.getrusage(_RUSAGE)
+        return usage.ru_minflt, usage.ru_majflt
@@ -0,0 +1,325 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+def record_fields(motors=4):
+    """Get the fields of one record.
+
+    The orders of the values within the fields are
+      commands: throttle, yaw, pitch and roll
+      errors and pids: yaw, pitch and roll
+      pulses: the motors in the motor order of the mixer
+
+    Parameters
+    ----------
+    motors : int (default 4)
+
+    Returns
+    -------
+    list of tuples
+        The fields as (name, struct code, count). The pulses are the last.
+    """
+    return [
+        ("timestamp_ns", "q", 1),
+        ("accelerometer_raw", "h", 3),
+        ("temperature_raw", "h", 1),
+        ("gyroscope_raw", "h", 3),
+        ("quaternion", "f", 4),
+        ("commands", "f", 4),
+        ("errors", "f", 3),
+        ("pids", "f", 3),
+        ("pulses", "i", motors),
+    ]
+
+
+def record_format(motors=4):
+    """Get the struct format of one record, see record_fields."""
+    return "<" + "".join("{}{}".format(count, code)
+                         for _, code, count in record_fields(motors))
+
+
+# The fields and format of the records of a quadcopter.
+RECORD_FIELDS = record_fields()
+RECORD_FORMAT = record_format()
+# The format of a record up to the count of the pulses.
+_FORMAT_PREFIX = RECORD_FORMAT[:-2]
+
+_MAGIC = b"DRONELOG"
+_VERSION = 2
+# Magic, version, record size, record format, max records and stored records,
+# followed by the loop rate, the gyroscope offsets, the orientation
+# quaternion and the seconds since the previous IMU measurement at the start
+# of the flight loop.
+_HEADER = struct.Struct("<8sHI32sQQd3d4dd2x")
+
+DEFAULT_LOG_DIRECTORY = os.path.join(os.path.expanduser("~"), ".drone",
+                                     "logs")
+
+
+def new_log_path(directory=DEFAULT_LOG_DIRECTORY):
+    """Get the path of a new log file, named after the current time.
+
+    Parameters
+    ----------
+    directory : str (default ~/.drone/logs)
+        Created if it does not exist.
+
+    Returns
+    -------
+    str
+        A path that does not exist yet, e.g.
+        ~/.drone/logs/flight-20240501-143000.log.
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = "flight-{}".format(time.strftime("%Y%m%d-%H%M%S"))
+    path = os.path.join(directory, name + ".log")
+    # The clock of a Raspberry Pi without network may repeat itself.
+    count = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, "{}-{}.log".format(name, count))
+        count += 1
+    return path
+
+
+class FlightRecorder:
+    """Binary flight data recorder.
+
+    Each flight loop iteration appends one fixed-size record to a preallocated
+    ring buffer. A background thread copies the records from the ring buffer
+    to a memory-mapped log file, so the flight loop never waits for the file
+    system. If the background thread falls behind and the ring buffer fills
+    up, or the log file is full, the new records are dropped and counted.
+
+    The log file is a header followed by the records, see record_fields. The
+    header stores the record format, which has the number of motors, and the
+    state of the IMU when the recording started, so the flight can be
+    replayed, see drone.simulation.replay. Use load_flight_log to read it.
+    """
+
+    def __init__(self, path, max_records=600000, buffer_records=4096,
+                 flush_interval=0.05, motors=4):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        path : str
+            Path of the log file. An existing file is overwritten.
+        max_records : int (default 600000)
+            Size of the log file in records. The default is 20 minutes at
+            500 Hz.
+        buffer_records : int (default 4096)
+            Size of the ring buffer in records.
+        flush_interval : float (default 0.05)
+            Seconds between copying the ring buffer to the log file.
+        motors : int (default 4)
+            Number of pulses in a record, the motors of the mixer.
+        """
+        self.path = path
+        self.motors = motors
+        self.max_records = max_records
+        self.flush_interval = flush_interval
+        self._ring_dropped = 0
+        self._file_dropped = 0
+        self._record = struct.Struct(record_format(motors))
+        self._buffer_records = buffer_records
+        self._ring = bytearray(buffer_records * self._record.size)
+        self._write_count = 0
+        self._flush_count = 0
+        self._stored = 0
+        self._file = None
+        self._map = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._initial_state = (0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0)
+
+    @property
+    def dropped(self):
+        """Number of records that did not fit in the ring buffer or the file."""
+        return self._ring_dropped + self._file_dropped
+
+    @property
+    def queue_depth(self):
+        """Number of records in the ring buffer waiting to be flushed."""
+        return self._write_count - self._flush_count
+
+    def start(self, loop_rate=0.0, gyroscope_offsets=(0.0, 0.0, 0.0),
+              quaternion=(1.0, 0.0, 0.0, 0.0), measurement_age=0.0):
+        """Create the log file and start the background flushing.
+
+        Parameters
+        ----------
+        loop_rate : float (default 0.0)
+            Rate of the flight loop in Hz.
+        gyroscope_offsets : sequence of floats (default (0.0, 0.0, 0.0))
+            Gyroscope offsets for x, y and z in degrees/sec.
+        quaternion : sequence of floats (default (1.0, 0.0, 0.0, 0.0))
+            The orientation before the first record.
+        measurement_age : float (default 0.0)
+            Seconds since the previous IMU measurement, which the time step
+            of the first record is measured from.
+        """
+        self._initial_state = ((loop_rate, ) + tuple(gyroscope_offsets)
+                               + tuple(quaternion) + (measurement_age, ))
+        self._file = open(self.path, "w+b")
+        self._file.truncate(_HEADER.size + self.max_records * self._record.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._write_header()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def set_measurement_age(self, measurement_age):
+        """Update the seconds since the previous IMU measurement in the
+        header, if time passed between start and the first record."""
+        self._initial_state = self._initial_state[:-1] + (measurement_age, )
+        self._write_header()
+
+    def record(self, timestamp_ns, raw_sample, q0, q1, q2, q3, throttle, yaw,
+               pitch, roll, yaw_error, pitch_error, roll_error, yaw_pid,
+               pitch_pid, roll_pid, pulses):
+        """Append a record to the ring buffer.
+
+        Parameters
+        ----------
+        timestamp_ns : int
+        raw_sample : tuple of ints
+            See MPU6050.raw_sample.
+        q0, q1, q2, q3 : float
+            The orientation quaternion.
+        throttle, yaw, pitch, roll : float
+            The commands.
+        yaw_error, pitch_error, roll_error : float
+        yaw_pid, pitch_pid, roll_pid : float
+        pulses : list of ints
+            The pulses of the motors.
+        """
+        write_count = self._write_count
+        if write_count - self._flush_count >= self._buffer_records:
+            self._ring_dropped += 1
+            return
+        ax, ay, az, t, gx, gy, gz = raw_sample
+        self._record.pack_into(
+            self._ring, (write_count % self._buffer_records) * self._record.size,
+            timestamp_ns, ax, ay, az, t, gx, gy, gz, q0, q1, q2, q3, throttle,
+            yaw, pitch, roll, yaw_error, pitch_error, roll_error, yaw_pid,
+            pitch_pid, roll_pid, *pulses)
+        self._write_count = write_count + 1
+
+    def stop(self):
+        """Flush the remaining records and close the log file.
+
+        The log file is truncated to the records actually written.
+        """
+        self._stop.set()
+        self._thread.join()
+        self._flush()
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(_HEADER.size + self._stored * self._record.size)
+        self._file.close()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        write_count = self._write_count
+        size = self._record.size
+        for i in range(self._flush_count, write_count):
+            if self._stored >= self.max_records:
+                self._file_dropped += write_count - i
+                break
+            start = (i % self._buffer_records) * size
+            offset = _HEADER.size + self._stored * size
+            self._map[offset:offset + size] = self._ring[start:start + size]
+            self._stored += 1
+        self._flush_count = write_count
+        self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, self._record.size,
+                          self._record.format.encode(), self.max_records,
+                          self._stored, *self._initial_state)
+
+
+def read_flight_log_header(path):
+    """Read the header of a log written by FlightRecorder.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    dict
+        The version, the size of the header in bytes, the number of records,
+        the record_format, the number of motors and the loop_rate,
+        gyroscope_offsets, quaternion and measurement_age at the start of the
+        recording, see FlightRecorder.start.
+    """
+    with open(path, "rb") as f:
+        data = f.read(_HEADER.size)
+    magic, version = struct.unpack_from("<8sH", data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("{} is not a flight log".format(path))
+    (_, _, record_size, record_format, _, count, loop_rate,
+     *state) = _HEADER.unpack_from(data)
+    header = {"header_size": _HEADER.size, "loop_rate": loop_rate,
+              "gyroscope_offsets": tuple(state[:3]),
+              "quaternion": tuple(state[3:7]), "measurement_age": state[7]}
+    record_format = record_format.rstrip(b"\0").decode()
+    motors = record_format[len(_FORMAT_PREFIX):-1]
+    if (not record_format.startswith(_FORMAT_PREFIX)
+            or not record_format.endswith("i") or not motors.isdigit()):
+        raise ValueError("Unsupported record format {}".format(record_format))
+    header.update(version=version, record_size=record_size, count=count,
+                  record_format=record_format, motors=int(motors))
+    return header
+
+
+def read_flight_log(path):
+    """Read a log written by FlightRecorder without numpy.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    list of tuples
+        The records with the values of record_fields flattened in order.
+    """
+    header = read_flight_log_header(path)
+    with open(path, "rb") as f:
+        f.seek(header["header_size"])
+        data = f.read(header["count"] * header["record_size"])
+    return list(struct.iter_unpack(header["record_format"], data))
+
+
+def load_flight_log(path):
+    """Load a log written by FlightRecorder.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        The fields of record_fields. Fields with one value per record have
+        shape (n,) and the others (n, count).
+    """
+    import numpy as np
+
+    header = read_flight_log_header(path)
+    fields = record_fields(header["motors"])
+    numpy_types = {"q": "<i8", "h": "<i2", "f": "<f4", "i": "<i4"}
+    dtype = np.dtype([(name, numpy_types[code], (count,) if count > 1 else ())
+                      for name, code, count in fields])
+    assert dtype.itemsize == header["record_size"]
+    records = np.fromfile(path, dtype=dtype, count=header["count"],
+                          offset=header["header_size"])
+    return {name: records[name] for name, _, _ in fields}
@@ -0,0 +1,129 @@
+import heapq
+import time
+
+
+class RateScheduler:
+    """Fixed-rate scheduler for the flight loop.
+
+    Keeps the loop running at a constant rate by waiting until the next
+    deadline at the end of every iteration. The deadlines are on a fixed grid
+    based on time.monotonic_ns, so the rate does not drift with the duration
+    of the iterations. Most of the wait is slept and the last part is spent
+    spinning, because sleep alone wakes up too late on a loaded system.
+
+    If an iteration overruns its deadline, the deadline is counted as missed
+    and the grid is restarted from the current time instead of trying to catch
+    up with back-to-back iterations.
+    """
+
+    def __init__(self, rate=500, spin_threshold=0.0005, window=1000,
+                 clock=time.monotonic_ns, sleep=time.sleep):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        rate : float (default 500)
+            Target rate of the loop in Hz.
+        spin_threshold : float (default 0.0005)
+            The last spin_threshold seconds before a deadline are spent busy
+            waiting instead of sleeping.
+        window : int (default 1000)
+            Number of the latest loop periods the 99th percentiles are
+            calculated from.
+        clock : callable
+            Returns the current time in nanoseconds.
+        sleep : callable
+            Sleeps the given amount of seconds.
+        """
+        self.rate = rate
+        self.period_ns = int(round(1e9 / rate))
+        self.spin_threshold_ns = int(spin_threshold * 1e9)
+        self._clock = clock
+        self._sleep = sleep
+        self._deadline = None
+        self._previous_wakeup = None
+        self._periods = [0] * window
+        self._period_index = 0
+        self.iterations = 0
+        self.missed_deadlines = 0
+        self._min_period = None
+        self._period_sum = 0
+        self._jitter_sum = 0
+        self._max_jitter = 0
+        self.last_period = None
+
+    def now(self):
+        """Get the current time of the scheduler's clock in nanoseconds."""
+        return self._clock()
+
+    def start(self):
+        """Start the deadline grid from the current time."""
+        now = self._clock()
+        self._previous_wakeup = now
+        self._deadline = now + self.period_ns
+
+    def wait(self):
+        """Wait until the next deadline and update the statistics."""
+        if self._deadline is None:
+            self.start()
+        deadline = self._deadline
+        now = self._clock()
+        if now > deadline:
+            self.missed_deadlines += 1
+            deadline = now
+        else:
+            remaining = deadline - now
+            if remaining > self.spin_threshold_ns:
+                self._sleep((remaining - self.spin_threshold_ns) / 1e9)
+            while self._clock() < deadline:
+                pass
+            now = self._clock()
+        self._deadline = deadline + self.period_ns
+
+        period = now - self._previous_wakeup
+        self._previous_wakeup = now
+        self.last_period = period
+        jitter = abs(period - self.period_ns)
+        self.iterations += 1
+        self._period_sum += period
+        self._jitter_sum += jitter
+        if self._min_period is None or period < self._min_period:
+            self._min_period = period
+        if jitter > self._max_jitter:
+            self._max_jitter = jitter
+        self._periods[self._period_index] = period
+        self._period_index = (self._period_index + 1) % len(self._periods)
+
+    def get_statistics(self):
+        """Get the loop timing statistics.
+
+        Jitter is the absolute difference between a loop period and the target
+        period. The minimums, means and maximums are over the whole run and the
+        99th percentiles over the latest periods.
+
+        Returns
+        -------
+        dict
+            All the times are in seconds.
+        """
+        n = min(self.iterations, len(self._periods))
+        if n == 0:
+            return {"iterations": 0, "missed_deadlines": self.missed_deadlines}
+        recent = self._periods[:n]
+        # Only the top percent is needed, and the largest jitters are at the
+        # ends of the periods. Cheap enough to be called in flight.
+        k = n - min(n - 1, int(0.99 * n))
+        longest = heapq.nlargest(k, recent)
+        jitters = heapq.nlargest(k, [abs(period - self.period_ns) for period
+                                     in longest + heapq.nsmallest(k, recent)])
+        return {
+            "iterations": self.iterations,
+            "missed_deadlines": self.missed_deadlines,
+            "target_period": self.period_ns / 1e9,
+            "min_period": self._min_period / 1e9,
+            "mean_period": self._period_sum / self.iterations / 1e9,
+            "p99_period": longest[-1] / 1e9,
+            "mean_jitter": self._jitter_sum / self.iterations / 1e9,
+            "max_jitter": self._max_jitter / 1e9,
+            "p99_jitter": jitters[-1] / 1e9,
+        }
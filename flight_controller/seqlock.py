@@ -0,0 +1,147 @@
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+# Retries of a read before its time is limited.
+_FREE_RETRIES = 100
+
+
+class SeqlockBlock:
+    """Fixed-layout record in shared memory protected by a sequence lock.
+
+    The block is meant for one writer and any number of readers in other
+    processes. The writer makes the sequence counter odd, writes the record
+    and makes the counter even again. A reader retries until it gets the same
+    even counter before and after reading the record, so readers never block
+    the writer and never take a lock or make a system call.
+
+    A writer that dies in the middle of a write leaves the counter odd for
+    good, and a writer preempted there holds it odd for a while. A reader
+    therefore retries for at most read_timeout seconds and then returns the
+    last record it read, which is stale, and counts it in stale_reads. While
+    the counter stays at the value it timed out on, later reads return the
+    stale record at once.
+
+    A write packs the record before it makes the counter odd, so values that
+    do not fit the format raise without touching the block.
+    """
+
+    _sequence = struct.Struct("<Q")
+
+    def __init__(self, fmt, name=None, create=False, read_timeout=0.001):
+        """Create or attach to the shared memory block.
+
+        Parameters
+        ----------
+        fmt : str
+            struct format of the record.
+        name : str or None (default None)
+            Name of an existing block to attach to. If None, a new block is
+            created with a generated name.
+        create : bool (default False)
+            Create a new block instead of attaching to an existing one.
+        read_timeout : float (default 0.001)
+            Seconds a read retries before it gives up, see the class
+            docstring.
+        """
+        self._record = struct.Struct(fmt)
+        size = self._sequence.size + self._record.size
+        if create:
+            self._memory = shared_memory.SharedMemory(name=name, create=True,
+                                                      size=size)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self._buffer = self._memory.buf
+        # The record is packed here first and copied to the block only
+        # when every value fits.
+        self._packed = bytearray(self._record.size)
+        self._counter = self._sequence.unpack_from(self._buffer, 0)[0]
+        self.name = self._memory.name
+        self.read_timeout_ns = int(read_timeout * 1e9)
+        self.stale_reads = 0
+        self._last = None
+        # The odd counter a read timed out on.
+        self._stuck = None
+
+    def write(self, *values):
+        """Write a new record.
+
+        Must be called from one process and thread at a time.
+
+        Parameters
+        ----------
+        values
+            Values of the record in the order of the struct format.
+
+        Raises
+        ------
+        struct.error
+            If the values do not fit the format. The block keeps the
+            previous record.
+        """
+        packed = self._packed
+        self._record.pack_into(packed, 0, *values)
+        counter = self._counter + 1
+        self._sequence.pack_into(self._buffer, 0, counter)
+        offset = self._sequence.size
+        self._buffer[offset:offset + len(packed)] = packed
+        self._counter = counter + 1
+        self._sequence.pack_into(self._buffer, 0, self._counter)
+
+    def read(self):
+        """Read the latest complete record.
+
+        Returns
+        -------
+        tuple
+            Values of the record in the order of the struct format. The
+            previously read values if no complete record could be read in
+            read_timeout.
+
+        Raises
+        ------
+        RuntimeError
+            If no complete record could be read in read_timeout and none was
+            read before.
+        """
+        sequence = self._sequence
+        record = self._record
+        buffer = self._buffer
+        offset = sequence.size
+        retries = 0
+        deadline = None
+        while True:
+            before = sequence.unpack_from(buffer, 0)[0]
+            if before == self._stuck:
+                return self._stale(before)
+            if not before & 1:
+                values = record.unpack_from(buffer, offset)
+                if sequence.unpack_from(buffer, 0)[0] == before:
+                    self._last = values
+                    return values
+            retries += 1
+            if retries >= _FREE_RETRIES:
+                now = time.perf_counter_ns()
+                if deadline is None:
+                    deadline = now + self.read_timeout_ns
+                elif now > deadline:
+                    return self._stale(before)
+
+    def _stale(self, counter):
+        self.stale_reads += 1
+        if counter & 1:
+            self._stuck = counter
+        if self._last is None:
+            raise RuntimeError("The writer of {} stopped in the middle of a "
+                               "write".format(self.name))
+        return self._last
+
+    def close(self):
+        """Detach from the shared memory block."""
+        self._buffer = None
+        self._memory.close()
+
+    def unlink(self):
+        """Remove the shared memory block. Call only from the creator."""
+        self._memory.unlink()
@@ -0,0 +1,152 @@
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def wait_until(probe, timeout, interval=0.02, description="probe"):
+    """Wait until a readiness probe succeeds.
+
+    Parameters
+    ----------
+    probe : callable
+        Returns True when the thing waited for is ready.
+    timeout : float
+        Seconds to wait at most.
+    interval : float (default 0.02)
+        Seconds between the probes.
+    description : str (default "probe")
+        Name of the thing waited for, for the error message.
+
+    Raises
+    ------
+    TimeoutError
+        If the probe did not succeed in time.
+    """
+    deadline = time.monotonic() + timeout
+    while not probe():
+        if time.monotonic() > deadline:
+            raise TimeoutError("{} not ready after {} s".format(description,
+                                                               timeout))
+        time.sleep(interval)
+
+
+def port_open(host, port):
+    """Probe for a TCP port accepting connections."""
+    def probe():
+        try:
+            with socket.create_connection((host, port), timeout=0.2):
+                return True
+        except OSError:
+            return False
+    return probe
+
+
+def http_ready(url):
+    """Probe for an HTTP server answering, with any status."""
+    def probe():
+        try:
+            urllib.request.urlopen(url, timeout=0.5).close()
+        except urllib.error.HTTPError:
+            pass
+        except OSError:
+            return False
+        return True
+    return probe
+
+
+class Startup:
+    """Runs the startup steps of the drone concurrently.
+
+    Every step runs in its own thread as soon as the steps it depends on have
+    finished, and is expected to return only when the thing it starts is
+    ready, e.g. by waiting on a readiness probe with wait_until. The start
+    and duration of each step are collected for a timing report.
+    """
+
+    def __init__(self):
+        self._steps = []
+        self.timings = {}
+
+    def add(self, name, function, after=()):
+        """Add a step.
+
+        Parameters
+        ----------
+        name : str
+        function : callable
+            Called without arguments. Returns when the step is ready.
+        after : list of str (default ())
+            Names of the steps that need to finish before this one starts.
+            They can be added later, and are checked by run.
+        """
+        self._steps.append((name, function, tuple(after)))
+
+    def run(self):
+        """Run all the steps and print the timing report.
+
+        Returns
+        -------
+        dict
+            Start time and duration in seconds of each step that was run, the
+            start being relative to the start of the whole startup.
+
+        Raises
+        ------
+        ValueError
+            If a step is to run after a step that was not added. No step is
+            run then.
+        RuntimeError
+            If a step failed. The steps depending on it are skipped.
+        """
+        finished = {name: threading.Event() for name, _, _ in self._steps}
+        for name, _, after in self._steps:
+            for dependency in after:
+                if dependency not in finished:
+                    raise ValueError("Step {} is to run after {}, which is "
+                                     "not a step".format(name, dependency))
+        start = time.monotonic()
+        errors = {}
+
+        def run_step(name, function, after):
+            try:
+                for dependency in after:
+                    finished[dependency].wait()
+                    if dependency in errors:
+                        errors[name] = "skipped, {} failed".format(dependency)
+                        return
+                step_start = time.monotonic()
+                try:
+                    function()
+                except Exception as e:
+                    errors[name] = e
+                self.timings[name] = (step_start - start,
+                                      time.monotonic() - step_start)
+            finally:
+                finished[name].set()
+
+        threads = [threading.Thread(target=run_step, args=step, daemon=True)
+                   for step in self._steps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = time.monotonic() - start
+
+        print("{:<16}{:>10}{:>10}".format("step", "start s", "took s"))
+        for name, _, _ in self._steps:
+            if name in self.timings:
+                step_start, duration = self.timings[name]
+                print("{:<16}{:>10.2f}{:>10.2f}{}".format(
+                    name, step_start, duration,
+                    "  FAILED: {}".format(errors[name]) if name in errors
+                    else ""))
+            else:
+                print("{:<16}{:>20}  {}".format(name, "", errors[name]))
+        print("Startup took {:.2f} s, the steps {:.2f} s in total".format(
+            total, sum(duration for _, duration in self.timings.values())))
+        if errors:
+            raise RuntimeError("Startup failed: {}".format(", ".join(
+                "{} ({})".format(name, error) for name, error in errors.items())))
+        return self.timings
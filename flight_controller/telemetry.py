@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+from drone.flight_controller.seqlock import SeqlockBlock
+
+
+# Most motors the telemetry carries the pulses of, an octocopter.
+MAX_MOTORS = 8
+
+Telemetry = namedtuple("Telemetry", [
+    "sequence", "timestamp_ns", "flying", "yaw", "pitch", "roll", "throttle",
+    "pulses", "battery_voltage", "loop_rate", "missed_deadlines"])
+Telemetry.__doc__ = """Latest state of the flight controller.
+
+sequence : int
+    Incremented on every publish, 0 before the first one.
+timestamp_ns : int
+    Time of the flight loop scheduler at the publish.
+flying : bool
+yaw, pitch, roll : float
+    Orientation in degrees.
+throttle : float
+    Throttle command in range 1000-2000.
+pulses : tuple of ints
+    Pulsewidths of the motors in microseconds in the motor order, empty
+    before the first publish.
+battery_voltage : float
+    Voltage of the battery, NaN if it is not measured.
+loop_rate : float
+    Rate of the flight loop in Hz over the latest iteration.
+missed_deadlines : int
+"""
+
+
+class TelemetryChannel:
+    """Latest-value telemetry channel from the flight loop to the web server.
+
+    The flight loop publishes a snapshot of its state into a block of shared
+    memory, which is a fixed-cost write that never waits for the readers.
+    The web server reads the newest snapshot whenever it wants to send one to
+    a client.
+    """
+
+    _format = "<QQ?ffffB{}hffI".format(MAX_MOTORS)
+
+    def __init__(self, name=None, create=False):
+        """Create or attach to the channel.
+
+        Parameters
+        ----------
+        name : str or None (default None)
+            Name of the shared memory block of an existing channel.
+        create : bool (default False)
+            Create a new channel. The creator is responsible for unlinking it.
+        """
+        self._block = SeqlockBlock(self._format, name=name, create=create)
+        self.name = self._block.name
+        if create:
+            self._sequence = 0
+            self._block.write(0, 0, False, 0.0, 0.0, 0.0, 1000.0, 0,
+                              *[0] * MAX_MOTORS, float("nan"), 0.0, 0)
+        else:
+            self._sequence = self.read().sequence
+
+    def publish(self, timestamp_ns, flying, yaw, pitch, roll, throttle, pulses,
+                battery_voltage, loop_rate, missed_deadlines):
+        """Publish a new snapshot.
+
+        Must be called from one process and thread at a time. See Telemetry
+        for the parameters, pulses being a list of at most MAX_MOTORS
+        pulsewidths.
+        """
+        self._sequence += 1
+        motors = len(pulses)
+        self._block.write(self._sequence, timestamp_ns, flying, yaw, pitch,
+                          roll, throttle, motors, *pulses,
+                          *[0] * (MAX_MOTORS - motors), battery_voltage,
+                          loop_rate, missed_deadlines)
+
+    def read(self):
+        """Get the latest snapshot.
+
+        Returns
+        -------
+        Telemetry
+        """
+        values = self._block.read()
+        pulses = values[8:8 + values[7]]
+        return Telemetry(*values[:7], pulses, *values[8 + MAX_MOTORS:])
+
+    def close(self):
+        """Detach from the channel."""
+        self._block.close()
+
+    def unlink(self):
+        """Remove the channel. Call only from the creator."""
+        self._block.unlink()
@@ -1,18 +1,43 @@
-from gpiozero import MCP3008
+from drone.flight_controller import backends
 
 
 class VoltageMeter:
     """Voltage meter using MCP3008 as an analog to digital converter."""
-    def __init__(self):
-        self.adc = MCP3008(channel=0, device=0)
+    def __init__(self, adc=None, reference_voltage=3.3, divider_ratio=5.0):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        adc : gpiozero.MCP3008 or None (default None)
+            The channel of the converter. If None, channel 0 is opened with
+            the selected backend.
+        reference_voltage : float (default 3.3)
+            Reference voltage of the converter.
+        divider_ratio : float (default 5.0)
+            Ratio of the measured voltage to the voltage at the input of the
+            converter, set by the resistors of the voltage divider.
+        """
+        if adc is None:
+            adc = backends.create("adc", channel=0, device=0)
+        self.adc = adc
+        self.reference_voltage = reference_voltage
+        self.divider_ratio = divider_ratio
 
     def get_measurement(self):
         """Get measurement from the analog to digital converter.
 
         Returns
         -------
-        int 
-            Integer between 0-1023, where 0 corresponds to 0 volts and 1023 
-            corresponds to 3.3 volts.
+        float
+            Number between 0-1, where 0 corresponds to 0 volts and 1
+            corresponds to the reference voltage.
         """
         return self.adc.value
+
+    def get_voltage(self):
+        """Get the measured voltage in volts.
+
+        Does one read of the converter, see BatteryMonitor for reading it
+        outside the flight loop.
+        """
+        return self.adc.value * self.reference_voltage * self.divider_ratio
@@ -0,0 +1,317 @@
+"""Failsafe watchdog in its own process.
+
+The flight loop beats a heartbeat in shared memory every iteration and the
+web server timestamps every command, see CommandChannel. The watchdog polls
+both at a fixed interval with its own clock. If the heartbeat or, once the
+client is alive, the commands are older than their timeouts, the watchdog
+trips: it cuts the pulses of the ESCs to idle, or ramps them down to idle,
+through its own connection to the pigpio daemon. Neither is a controlled
+descent. The ramp only throttles all motors down together, and nothing
+controls the attitude while it runs, so it only softens the fall.
+
+A stale heartbeat means the flight loop is hung or dead, so the watchdog
+kills its process before taking over the ESCs, and the loop can not
+overwrite the failsafe pulses if it wakes up. On stale commands the loop is
+healthy: it sees the trip in the shared memory and stops without sending
+pulses, which keeps its flight log intact.
+
+How long after the deadline the trip was detected and how long cutting the
+pulses took are stored with the trip, see WatchdogChannel.get_trip. Run
+``python -m drone.benchmarks.watchdog`` to measure them.
+"""
+import os
+import signal
+import time
+from collections import namedtuple
+
+from drone.flight_controller import backends
+from drone.flight_controller.command_channel import ALIVE
+from drone.flight_controller.seqlock import SeqlockBlock
+
+
+# Reasons of a trip.
+NOT_TRIPPED = 0
+HEARTBEAT = 1
+COMMAND = 2
+
+_REASONS = {HEARTBEAT: "flight loop heartbeat", COMMAND: "commands"}
+
+Trip = namedtuple("Trip", ["reason", "trip_ns", "stale_ns",
+                           "detection_latency_ns", "cut_latency_ns"])
+Trip.__doc__ = """A trip of the watchdog.
+
+reason : int
+    NOT_TRIPPED, HEARTBEAT or COMMAND.
+trip_ns : int
+    time.monotonic_ns when the trip was detected.
+stale_ns : int
+    Age of the stale heartbeat or command when the trip was detected.
+detection_latency_ns : int
+    Time from the deadline, i.e. the timeout after the latest heartbeat or
+    command, to the detection.
+cut_latency_ns : int
+    Time from the detection until the first failsafe pulses were sent.
+"""
+
+
+class WatchdogChannel:
+    """Shared memory between the flight loop and the watchdog.
+
+    Consists of two blocks, each with one writer. The flight loop writes the
+    heartbeat: a counter, its time, the process id of the loop, the throttle
+    and whether the watchdog is armed. The watchdog writes the trip.
+    """
+
+    _heartbeat_format = "<QQIf?"
+    _trip_format = "<bQQqq"
+
+    def __init__(self, names=None, create=False):
+        """Create or attach to the channel.
+
+        Parameters
+        ----------
+        names : tuple of str or None (default None)
+            The names attribute of an existing channel.
+        create : bool (default False)
+            Create a new channel. The creator is responsible for unlinking it.
+        """
+        heartbeat_name, trip_name = names if names is not None else (None,
+                                                                      None)
+        self._heartbeat = SeqlockBlock(self._heartbeat_format,
+                                       name=heartbeat_name, create=create)
+        self._trip = SeqlockBlock(self._trip_format, name=trip_name,
+                                  create=create)
+        self.names = (self._heartbeat.name, self._trip.name)
+        self._beats = 0
+        self._pid = 0
+        if create:
+            self._heartbeat.write(0, 0, 0, 1000.0, False)
+            self._trip.write(NOT_TRIPPED, 0, 0, 0, 0)
+
+    # The flight loop side
+
+    def arm(self, throttle=1000.0):
+        """Start watching the calling process. Beats once."""
+        self._pid = os.getpid()
+        self._beats += 1
+        self._heartbeat.write(self._beats, time.monotonic_ns(), self._pid,
+                              throttle, True)
+
+    def beat(self, throttle):
+        """Tell the watchdog that the flight loop is running.
+
+        Parameters
+        ----------
+        throttle : float
+            The throttle command, where a ramp down starts from.
+        """
+        self._beats += 1
+        self._heartbeat.write(self._beats, time.monotonic_ns(), self._pid,
+                              throttle, True)
+
+    def disarm(self):
+        """Stop watching, e.g. on a requested shutdown."""
+        self._heartbeat.write(self._beats, time.monotonic_ns(), self._pid,
+                              1000.0, False)
+
+    def tripped(self):
+        """Whether the watchdog has tripped."""
+        return self._trip.read()[0] != NOT_TRIPPED
+
+    # The watchdog side
+
+    def read_heartbeat(self):
+        """Get the latest heartbeat.
+
+        Returns
+        -------
+        tuple
+            Counter, time.monotonic_ns, process id, throttle and armed.
+        """
+        return self._heartbeat.read()
+
+    def set_trip(self, trip):
+        """Store a trip. Call only from the watchdog."""
+        self._trip.write(*trip)
+
+    def get_trip(self):
+        """Get the trip of the watchdog.
+
+        Returns
+        -------
+        Trip
+            The reason is NOT_TRIPPED if the watchdog has not tripped.
+        """
+        return Trip._make(self._trip.read())
+
+    def close(self):
+        """Detach from the channel."""
+        self._heartbeat.close()
+        self._trip.close()
+
+    def unlink(self):
+        """Remove the channel. Call only from the creator."""
+        self._heartbeat.unlink()
+        self._trip.unlink()
+
+
+def describe_trip(trip):
+    """Describe a trip for a log message."""
+    return ("Watchdog: {} stale for {:.1f} ms, detected {:.2f} ms after the "
+            "deadline, failsafe pulses sent in {:.2f} ms".format(
+                _REASONS.get(trip.reason, "nothing"), trip.stale_ns / 1e6,
+                trip.detection_latency_ns / 1e6, trip.cut_latency_ns / 1e6))
+
+
+class Watchdog:
+    """Watches the flight loop and the commands, see the module docstring.
+
+    Run it in its own process with run, which returns after the failsafe is
+    done.
+    """
+
+    def __init__(self, channel, command_channel=None, heartbeat_timeout=0.05,
+                 command_timeout=0.25, action="idle", heartbeat_action=None,
+                 ramp_time=3.0,
+                 poll_interval=0.001, gpio_pins=(13, 12, 24, 18),
+                 kill_flight_loop=True, pi=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        channel : WatchdogChannel
+        command_channel : CommandChannel or None (default None)
+            If None, only the heartbeat is watched.
+        heartbeat_timeout : float (default 0.05)
+            Seconds without a heartbeat. A trip kills the flight loop, so
+            this is well above its longest normal stall: up to 5 ms, the
+            switch interval of the interpreter, for each of the threads of
+            the recorder, the battery monitor and the i2c polls that holds
+            the GIL, and a few more for a flush to the SD card. That adds up
+            to about 20 ms, and 50 ms leaves a margin of more than two.
+        command_timeout : float (default 0.25)
+            Seconds without a command. The web client sends one every 20 ms
+            over its WebSocket, and every 100 ms over the HTTP fallback, so
+            0.25 s is at least two lost fallback messages in a row. A Wi-Fi
+            stall longer than that trips, so pair it with "ramp_down".
+        action : str (default "idle")
+            "idle" cuts the pulses to 1000 at once. "ramp_down" ramps them
+            from the latest throttle to 1000 in ramp_time, all motors
+            together. It is not a controlled descent: the attitude is not
+            controlled during the ramp.
+        heartbeat_action : str or None (default None)
+            The action on a stale heartbeat, if different from action.
+        ramp_time : float (default 3.0)
+            Seconds of the ramp down.
+        poll_interval : float (default 0.001)
+            Seconds between the checks.
+        gpio_pins : sequence of ints (default (13, 12, 24, 18))
+            The pins of the ESCs, as the esc_pins of FlightController.
+        kill_flight_loop : bool (default True)
+            Kill the process of the flight loop on a stale heartbeat.
+        pi : pigpio.pi or None (default None)
+            Connection to the pigpio daemon. If None, a new connection is
+            opened with the selected backend when run is called, i.e. in the
+            process of the watchdog.
+        """
+        if heartbeat_action is None:
+            heartbeat_action = action
+        for name in (action, heartbeat_action):
+            if name not in ("idle", "ramp_down"):
+                raise ValueError("Unknown failsafe action {}".format(name))
+        self.channel = channel
+        self.command_channel = command_channel
+        self.heartbeat_timeout_ns = int(heartbeat_timeout * 1e9)
+        self.command_timeout_ns = int(command_timeout * 1e9)
+        self.action = action
+        self.heartbeat_action = heartbeat_action
+        self.ramp_time = ramp_time
+        self.poll_interval = poll_interval
+        self.gpio_pins = list(gpio_pins)
+        self.kill_flight_loop = kill_flight_loop
+        self.pi = pi
+
+    def run(self):
+        """Watch until tripped, then do the failsafe action.
+
+        Returns
+        -------
+        Trip
+        """
+        if self.pi is None:
+            self.pi = backends.create("pwm")
+        trip, throttle, pid = self._watch()
+        cut_started_ns = time.monotonic_ns()
+        if trip.reason == HEARTBEAT and self.kill_flight_loop and pid:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        action = (self.heartbeat_action if trip.reason == HEARTBEAT
+                  else self.action)
+        if action == "idle":
+            throttle = 1000.0
+        self._send(throttle)
+        trip = trip._replace(cut_latency_ns=time.monotonic_ns()
+                             - cut_started_ns)
+        self.channel.set_trip(trip)
+        print(describe_trip(trip))
+        self._finish(throttle, action)
+        return trip
+
+    def _watch(self):
+        """Poll until a heartbeat or the commands are stale.
+
+        Returns
+        -------
+        tuple
+            The trip without the cut latency, the latest throttle and the
+            process id of the flight loop.
+        """
+        channel = self.channel
+        command_channel = self.command_channel
+        heartbeat_timeout_ns = self.heartbeat_timeout_ns
+        command_timeout_ns = self.command_timeout_ns
+        while True:
+            time.sleep(self.poll_interval)
+            _, beat_ns, pid, throttle, armed = channel.read_heartbeat()
+            if not armed:
+                continue
+            now = time.monotonic_ns()
+            stale_ns = now - beat_ns
+            if stale_ns > heartbeat_timeout_ns:
+                return (Trip(HEARTBEAT, now, stale_ns,
+                             stale_ns - heartbeat_timeout_ns, 0),
+                        throttle, pid)
+            if command_channel is None:
+                continue
+            command = command_channel.read()
+            stale_ns = now - command.timestamp_ns
+            if command.alive == ALIVE and stale_ns > command_timeout_ns:
+                return (Trip(COMMAND, now, stale_ns,
+                             stale_ns - command_timeout_ns, 0),
+                        throttle, pid)
+
+    def _send(self, pulsewidth):
+        pulsewidth = int(pulsewidth)
+        for pin in self.gpio_pins:
+            self.pi.set_servo_pulsewidth(pin, pulsewidth)
+
+    def _finish(self, throttle, action):
+        """Ramp down to idle, resending the pulses every poll interval.
+
+        The pulses are resent even when idle for a while, in case the flight
+        loop sent its own after it was tripped but before it noticed.
+        """
+        start = time.monotonic()
+        duration = self.ramp_time if action == "ramp_down" else 0.0
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= duration + 0.1:
+                break
+            if elapsed < duration:
+                self._send(throttle - (throttle - 1000) * elapsed / duration)
+            else:
+                self._send(1000)
+            time.sleep(self.poll_interval)
+        self._send(1000)
@@ -1,49 +1,132 @@
+import os
 import subprocess
 import re
 import multiprocessing as mp
 from time import sleep
-from drone.flight_controller.flight_controller import FlightController
+from drone.flight_controller.battery import BatteryMonitor
+from drone.flight_controller.command_channel import (CommandChannel, ALIVE,
+                                                     NOT_ALIVE)
+from drone.flight_controller.esc import start_pigpio_daemon
+from drone.flight_controller.flight_controller import (
+    DEFAULT_GAINS_PATH, FlightController, load_gains)
+from drone.flight_controller.i2c_bus import I2CBusManager
+from drone.flight_controller.metrics import LoopMetrics
+from drone.flight_controller.mixer import Mixer
+from drone.flight_controller.realtime import RealTime, exclude_cpu
+from drone.flight_controller.recorder import FlightRecorder, new_log_path
+from drone.flight_controller.startup import Startup, http_ready, wait_until
+from drone.flight_controller.telemetry import TelemetryChannel
+from drone.flight_controller.watchdog import (Watchdog, WatchdogChannel,
+                                              describe_trip)
+from drone.wifi_access_point import start_access_point
 import drone.web.server as server
 
 
+SERVER_PORT = 8080
+
+# The frame of the drone, see drone.flight_controller.mixer, and the gpio
+# pins of its ESCs in the motor order of the frame: back left, back right,
+# front right and front left for quad_x. The flight recorder, the telemetry
+# and the watchdog follow the number of motors. The simulator and the tuner
+# only model a quad_x, and a replay of another frame needs --frame.
+FRAME = "quad_x"
+ESC_PINS = (13, 12, 24, 18)
+
+
 class Drone:
     def __init__(self):
-        self.message_queue = mp.Queue()
-        self.flight_controller = FlightController()
+        self.command_channel = CommandChannel(create=True)
+        self.telemetry_channel = TelemetryChannel(create=True)
+        self.watchdog_channel = WatchdogChannel(create=True)
+        self.metrics = LoopMetrics(create=True)
+        self.realtime = RealTime()
+        gains = None
+        if os.path.exists(DEFAULT_GAINS_PATH):
+            gains = load_gains(DEFAULT_GAINS_PATH)
+            print("Using the gains in {}".format(DEFAULT_GAINS_PATH))
+        # Every start is recorded to its own log, see
+        # drone.simulation.replay for replaying it.
+        mixer = Mixer(FRAME)
+        self.recorder = FlightRecorder(new_log_path(), motors=mixer.motors)
+        print("Recording to {}".format(self.recorder.path))
+        self.flight_controller = FlightController(
+            recorder=self.recorder, telemetry=self.telemetry_channel,
+            gains=gains, battery=BatteryMonitor(),
+            watchdog=self.watchdog_channel,
+            realtime=self.realtime, metrics=self.metrics,
+            bus_manager=I2CBusManager(), mixer=mixer, esc_pins=ESC_PINS)
+        # On a hung flight loop, which is killed, or on commands lost for
+        # 0.25 s, e.g. in a long Wi-Fi stall, the watchdog ramps the
+        # throttle of all motors down to idle instead of cutting it. This is
+        # not a controlled descent, nothing holds the attitude during the
+        # ramp, but the drone comes down slower than with the motors cut.
+        self.watchdog = Watchdog(self.watchdog_channel,
+                                 command_channel=self.command_channel,
+                                 gpio_pins=ESC_PINS, action="ramp_down")
         self.server_process = None
         self.flight_controller_process = None
+        self.watchdog_process = None
 
     def setup(self):
         """Drone setup
 
-        Starts the web server and waits for the alive message from the client.
-        When client sends the alive message, the flight controller is started.
+        Brings up the access point, pigpiod, the flight controller hardware
+        and the web server concurrently and prints how long each took. Then
+        waits for the alive message from the client. When client sends the
+        alive message, the watchdog and the flight controller are started.
+
+        This process and so every process it starts is kept off the CPU of
+        the flight loop, see drone.flight_controller.realtime.
         """
-        server.QUEUE = self.message_queue
+        exclude_cpu(self.realtime.cpu)
+        startup = Startup()
+        startup.add("access point", start_access_point)
+        startup.add("pigpiod", start_pigpio_daemon)
+        startup.add("imu", self.flight_controller.setup_imu)
+        startup.add("escs", self.flight_controller.setup_escs,
+                    after=["pigpiod"])
+        startup.add("web server", self._start_server)
+        startup.run()
+
+        while True:
+            command = self.command_channel.read()
+            if command.alive == ALIVE:
+                self.watchdog_process = mp.Process(target=self.watchdog.run)
+                self.watchdog_process.start()
+                self.flight_controller_process = mp.Process(
+                    target=self.flight_controller.loop,
+                    args=(self.command_channel, ))
+                self.flight_controller_process.start()
+                return
+            elif command.alive == NOT_ALIVE:
+                print(command)
+                raise AssertionError("Got incorrect start message.")
+            sleep(0.05)
+
+    def _start_server(self):
+        """Start the web server and wait until it answers."""
+        server.CHANNEL = self.command_channel
+        server.TELEMETRY = self.telemetry_channel
+        server.METRICS = self.metrics
         self.server_process = mp.Process(target=server.APP.run,
-                                         args=("0.0.0.0", 8080))
+                                         args=("0.0.0.0", SERVER_PORT))
         self.server_process.start()
-        while True:
-            if not self.message_queue.empty():
-                message = self.message_queue.get()
-                if message["alive"] == True:
-                    fc = FlightController()
-                    fc.setup()
-                    self.flight_controller_process = mp.Process(
-                        target=fc.loop, args=(self.message_queue, ))
-                    self.flight_controller_process.start()
-                    return
-                else:
-                    print(message)
-                    raise AssertionError("Got incorrect start message.")
-            sleep(1)
+        wait_until(http_ready("http://localhost:{}/".format(SERVER_PORT)),
+                   10.0, description="web server")
 
     def monitor(self):
-        """Monitor the server and flight controller processes.
+        """Monitor the server, watchdog and flight controller processes.
 
-        Raises error if any of the processes is stopped.
+        Raises error if any of the processes is stopped. If the watchdog has
+        tripped, its failsafe is waited to finish first.
         """
         while True:
+            trip = self.watchdog_channel.get_trip()
+            if trip.reason:
+                self.watchdog_process.join()
+                raise AssertionError(describe_trip(trip))
+            elif not self.watchdog_process.is_alive():
+                raise AssertionError("Watchdog stopped")
             if not self.flight_controller_process.is_alive():
                 raise AssertionError("Flight controller stopped")
             elif not self.server_process.is_alive():
@@ -53,8 +136,8 @@ class Drone:
     def teardown(self):
         """Drone teardown
 
-        Kills the power to the ESCs and terminates the web server and flight
-        controller processes.
+        Kills the power to the ESCs and terminates the web server, watchdog
+        and flight controller processes.
         """
         output = str(subprocess.Popen("ps ax | grep pigpiod", shell=True, stdout=subprocess.PIPE).stdout.read())
         pid = re.search(r"[0-9]+", output).group(0)
@@ -67,13 +150,25 @@ class Drone:
             self.server_process.terminate()
         except Exception as e:
             print(e)
+        try:
+            self.watchdog_process.terminate()
+        except Exception as e:
+            print(e)
+        self.command_channel.close()
+        self.command_channel.unlink()
+        self.telemetry_channel.close()
+        self.telemetry_channel.unlink()
+        self.watchdog_channel.close()
+        self.watchdog_channel.unlink()
+        self.metrics.close()
+        self.metrics.unlink()
 
 
 if __name__ == "__main__":
     drone = Drone()
     try:
         drone.setup()
-        drone.loop()
+        drone.monitor()
     except Exception as e:
         print(e)
     finally:
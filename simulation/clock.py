@@ -0,0 +1,44 @@
+class SimulatedClock:
+    """Clock for running the flight code in simulated time.
+
+    Time only moves when somebody sleeps, so the simulation runs as fast as
+    the code allows instead of in real time. Every advance of the time is
+    passed to the listeners, which step the simulated world up to the new
+    time before the sleep returns.
+    """
+
+    def __init__(self, start=0.0):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        start : float (default 0.0)
+            Time in the beginning in seconds.
+        """
+        self._now_ns = int(start * 1e9)
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(now) with the time in seconds whenever time advances."""
+        self._listeners.append(listener)
+
+    def time(self):
+        """Get the current time in seconds, like time.time."""
+        return self._now_ns / 1e9
+
+    def monotonic_ns(self):
+        """Get the current time in nanoseconds, like time.monotonic_ns."""
+        return self._now_ns
+
+    def sleep(self, seconds):
+        """Advance the time, like time.sleep."""
+        self.advance_ns(int(seconds * 1e9))
+
+    def advance_ns(self, nanoseconds):
+        """Advance the time by the given amount of nanoseconds."""
+        if nanoseconds <= 0:
+            return
+        self._now_ns += nanoseconds
+        now = self._now_ns / 1e9
+        for listener in self._listeners:
+            listener(now)
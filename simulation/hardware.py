@@ -0,0 +1,335 @@
+import random
+import struct
+from math import pi
+
+
+class SimulatedI2CBus:
+    """i2c bus with simulated devices, with the smbus interface.
+
+    Devices are attached by their address and implement read_register and
+    write_register. Block reads read consecutive registers like the real bus
+    does, except for registers that the device marks as not incrementing
+    (e.g. a FIFO data register).
+
+    A transaction takes either a fixed time or, with bus_speed, the time of
+    its bits on the wire, e.g. 0.39 ms for a 14 byte block read at 400 kHz.
+    The time advances the simulated clock, or is slept with sleep to model a
+    bus shared by threads in wall clock time.
+    """
+
+    def __init__(self, clock=None, transaction_time=0.0, on_transaction=None,
+                 bus_speed=None, sleep=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        clock : SimulatedClock or None (default None)
+            Clock to advance by transaction_time on every transaction.
+        transaction_time : float (default 0.0)
+            Simulated duration of a transaction in seconds, for modelling the
+            time the flight loop spends waiting for the bus.
+        on_transaction : callable or None (default None)
+            Called without arguments before every transaction, e.g. to bring
+            the simulated world up to date.
+        bus_speed : float or None (default None)
+            Clock rate of the bus in Hz. If given, the duration of a
+            transaction is calculated from its length instead of being
+            transaction_time.
+        sleep : callable or None (default None)
+            If given, called with the duration of every transaction in
+            seconds, e.g. time.sleep.
+        """
+        self.devices = {}
+        self.transactions = 0
+        self.busy_time = 0.0
+        self._clock = clock
+        self._transaction_ns = int(transaction_time * 1e9)
+        self._on_transaction = on_transaction
+        self._bus_speed = bus_speed
+        self._sleep = sleep
+
+    def attach(self, address, device):
+        """Attach a device to the bus."""
+        self.devices[address] = device
+
+    def write_byte_data(self, address, register, value):
+        # Address, register and data bytes with a start and a stop.
+        self._transaction(3, 2)
+        self.devices[address].write_register(register, value)
+
+    def read_byte_data(self, address, register):
+        # Address and register, a repeated start, address and data.
+        self._transaction(4, 3)
+        return self.devices[address].read_register(register)
+
+    def read_i2c_block_data(self, address, register, length):
+        self._transaction(3 + length, 3)
+        device = self.devices[address]
+        if register in device.non_incrementing_registers:
+            return [device.read_register(register) for _ in range(length)]
+        return [device.read_register(register + i) for i in range(length)]
+
+    def _transaction(self, data_bytes, conditions):
+        """Account for a transaction.
+
+        Parameters
+        ----------
+        data_bytes : int
+            Bytes on the wire, each 8 bits and an acknowledge.
+        conditions : int
+            Start, repeated start and stop conditions, about a bit each.
+        """
+        if self._on_transaction is not None:
+            self._on_transaction()
+        self.transactions += 1
+        if self._bus_speed is not None:
+            duration_ns = int((data_bytes * 9 + conditions) * 1e9
+                              / self._bus_speed)
+        else:
+            duration_ns = self._transaction_ns
+        self.busy_time += duration_ns / 1e9
+        if self._clock is not None and duration_ns:
+            self._clock.advance_ns(duration_ns)
+        if self._sleep is not None and duration_ns:
+            self._sleep(duration_ns / 1e9)
+
+
+class SimulatedRegisterDevice:
+    """i2c device that is only a bank of registers, e.g. to stand in for a
+    magnetometer or a barometer on a simulated bus."""
+
+    non_incrementing_registers = ()
+
+    def __init__(self, address, registers=None):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        address : int
+        registers : dict or None (default None)
+            Initial values of the registers by their address, 0 otherwise.
+        """
+        self.address = address
+        self.registers = bytearray(256)
+        for register, value in (registers or {}).items():
+            self.registers[register] = value
+
+    def write_register(self, register, value):
+        self.registers[register] = value
+
+    def read_register(self, register):
+        return self.registers[register]
+
+
+class SimulatedMPU6050Device:
+    """Register level model of an MPU6050 mounted on a simulated quadcopter.
+
+    The module is mounted upside down, i.e. its x axis is the body x axis and
+    its y and z axes are the negated body y and z axes. The measurements have
+    gaussian noise and the gyroscope a constant bias, and they are quantised
+    like the real registers.
+    """
+
+    address = 0x68
+    non_incrementing_registers = (0x74, )
+
+    _SMPLRT_DIV = 0x19
+    _CONFIG = 0x1A
+    _GYRO_CONFIG = 0x1B
+    _ACCEL_CONFIG = 0x1C
+    _FIFO_EN = 0x23
+    _ACCEL_XOUT_H = 0x3B
+    _USER_CTRL = 0x6A
+    _FIFO_COUNT_H = 0x72
+    _FIFO_COUNT_L = 0x73
+    _FIFO_R_W = 0x74
+    _WHO_AM_I = 0x75
+    _FIFO_SIZE = 1024
+
+    def __init__(self, quadcopter, clock, accelerometer_noise=0.005,
+                 gyroscope_noise=0.05, gyroscope_bias=(0.8, -0.5, 0.3),
+                 temperature=30.0, seed=0):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        quadcopter : Quadcopter
+        clock : SimulatedClock
+        accelerometer_noise : float (default 0.005)
+            Standard deviation of the accelerometer noise in g.
+        gyroscope_noise : float (default 0.05)
+            Standard deviation of the gyroscope noise in degrees/sec.
+        gyroscope_bias : tuple of floats (default (0.8, -0.5, 0.3))
+            Gyroscope bias in degrees/sec.
+        temperature : float (default 30.0)
+            Temperature in degrees Celsius.
+        seed : int (default 0)
+            Seed for the noise.
+        """
+        self.quadcopter = quadcopter
+        self.clock = clock
+        self.accelerometer_noise = accelerometer_noise
+        self.gyroscope_noise = gyroscope_noise
+        self.gyroscope_bias = gyroscope_bias
+        self.temperature = temperature
+        self.registers = bytearray(128)
+        self.registers[self._WHO_AM_I] = self.address
+        self.fifo = bytearray()
+        self._random = random.Random(seed)
+        self._latched = b""
+        self._next_sample_time = None
+
+    def write_register(self, register, value):
+        self.registers[register] = value
+        if register == self._USER_CTRL and value & 0b00000100:
+            self.fifo = bytearray()
+            self.registers[register] = value & ~0b00000100
+
+    def read_register(self, register):
+        if register == self._ACCEL_XOUT_H:
+            # Latch a new sample on the first register of a burst read.
+            self._latched = self._sample()
+        if self._ACCEL_XOUT_H <= register < self._ACCEL_XOUT_H + 14:
+            if not self._latched:
+                self._latched = self._sample()
+            return self._latched[register - self._ACCEL_XOUT_H]
+        if register == self._FIFO_COUNT_H:
+            return len(self.fifo) >> 8
+        if register == self._FIFO_COUNT_L:
+            return len(self.fifo) & 0xFF
+        if register == self._FIFO_R_W:
+            if not self.fifo:
+                return 0
+            value = self.fifo[0]
+            del self.fifo[0]
+            return value
+        return self.registers[register]
+
+    def advance(self, now):
+        """Push the samples taken up to now to the FIFO."""
+        if not (self.registers[self._USER_CTRL] & 0b01000000
+                and self.registers[self._FIFO_EN]):
+            self._next_sample_time = None
+            return
+        if self._next_sample_time is None:
+            self._next_sample_time = now
+        while self._next_sample_time <= now:
+            sample = self._sample()
+            if len(self.fifo) + 12 <= self._FIFO_SIZE:
+                self.fifo += sample[:6] + sample[8:]
+            else:
+                self.fifo += sample[:self._FIFO_SIZE - len(self.fifo)]
+            self._next_sample_time += self.sample_period
+
+    @property
+    def sample_period(self):
+        dlpf = self.registers[self._CONFIG] & 0b111
+        rate = 8000.0 if dlpf in (0, 7) else 1000.0
+        return (1 + self.registers[self._SMPLRT_DIV]) / rate
+
+    def _sample(self):
+        """Encode the current state of the quadcopter as the data registers."""
+        gauss = self._random.gauss
+        accelerometer_scale = 16384.0 / (1 << ((self.registers[self._ACCEL_CONFIG] >> 3) & 0b11))
+        gyroscope_scale = 131.0 / (1 << ((self.registers[self._GYRO_CONFIG] >> 3) & 0b11))
+        fx, fy, fz = self.quadcopter.specific_force()
+        wx, wy, wz = self.quadcopter.angular_velocity
+        bx, by, bz = self.gyroscope_bias
+        accelerometer = (fx, -fy, -fz)
+        gyroscope = (wx * 180 / pi + bx, -wy * 180 / pi + by,
+                     -wz * 180 / pi + bz)
+        values = [_to_int16((a + gauss(0.0, self.accelerometer_noise))
+                            * accelerometer_scale) for a in accelerometer]
+        values.append(_to_int16((self.temperature - 36.53) * 340))
+        values += [_to_int16((g + gauss(0.0, self.gyroscope_noise))
+                             * gyroscope_scale) for g in gyroscope]
+        return struct.pack(">7h", *values)
+
+
+class SimulatedPigpio:
+    """Connection to a simulated pigpio daemon driving the motors.
+
+    Implements the parts of pigpio.pi the ESCs use, including scripts made
+    of servo commands. The pulsewidths are passed to the motors of a
+    simulated quadcopter. writes counts the requests to the daemon.
+    """
+
+    def __init__(self, quadcopter, pins):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        quadcopter : Quadcopter
+        pins : list of ints
+            The gpio pins of the motors in the motor order.
+        """
+        self.quadcopter = quadcopter
+        self.pins = {pin: i for i, pin in enumerate(pins)}
+        self.pulsewidths = {pin: 0 for pin in pins}
+        self.writes = 0
+        self.scripts = {}
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        self.writes += 1
+        self.pulsewidths[gpio] = pulsewidth
+        self.quadcopter.motor_commands[self.pins[gpio]] = pulsewidth
+
+    def store_script(self, script):
+        tokens = script.decode().split()
+        commands = []
+        for i in range(0, len(tokens), 3):
+            if tokens[i] != "servo" or not tokens[i + 2].startswith("p"):
+                raise ValueError("Unsupported script command: {}".format(
+                    " ".join(tokens[i:i + 3])))
+            commands.append((int(tokens[i + 1]), int(tokens[i + 2][1:])))
+        script_id = len(self.scripts)
+        self.scripts[script_id] = commands
+        return script_id
+
+    def script_status(self, script_id):
+        return 1, []
+
+    def run_script(self, script_id, params):
+        self.writes += 1
+        for gpio, param in self.scripts[script_id]:
+            self.pulsewidths[gpio] = params[param]
+            self.quadcopter.motor_commands[self.pins[gpio]] = params[param]
+        return 0
+
+    def delete_script(self, script_id):
+        del self.scripts[script_id]
+
+    def get_servo_pulsewidth(self, gpio):
+        return self.pulsewidths[gpio]
+
+    def stop(self):
+        pass
+
+
+class SimulatedADC:
+    """Channel of a simulated MCP3008 analog to digital converter.
+
+    Implements the parts of gpiozero.MCP3008 the voltage meter uses.
+    """
+
+    def __init__(self, voltage=0.0, reference_voltage=3.3):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        voltage : float (default 0.0)
+            Voltage at the input of the channel.
+        reference_voltage : float (default 3.3)
+        """
+        self.voltage = voltage
+        self.reference_voltage = reference_voltage
+
+    @property
+    def value(self):
+        """The voltage relative to the reference voltage, quantised to 10 bits."""
+        value = min(1.0, max(0.0, self.voltage / self.reference_voltage))
+        return round(value * 1023) / 1023
+
+
+def _to_int16(value):
+    return max(-32768, min(32767, int(round(value))))
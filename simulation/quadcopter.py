@@ -0,0 +1,168 @@
+from math import sqrt
+
+
+GRAVITY = 9.81
+
+
+class Quadcopter:
+    """Rigid body model of a quadcopter.
+
+    The body frame has x forward, y left and z up and the world frame has z
+    up. The orientation is a quaternion rotating vectors from the body frame
+    to the world frame.
+
+    The motors are placed so that the mixing in FlightController and the
+    euler angles of IMU have matching signs: a positive roll, pitch or yaw
+    output of a PID increases the corresponding IMU angle. In this frame that
+    puts motors 0 and 1 at the back and 2 and 3 at the front:
+        3   2
+         \\ /
+          |      -> forward is up
+         / \\
+        0   1
+    Motors 1 and 3 spin clockwise seen from above, so their reaction torque
+    yaws the body counterclockwise.
+
+    Each motor follows its pulsewidth command with a first order lag and its
+    thrust is a mix of a linear and a quadratic function of the lagged
+    command. The body stands on the ground at z = 0 until the thrust lifts it.
+    """
+
+    def __init__(self, mass=1.2, arm_length=0.16, inertia=(0.012, 0.012, 0.022),
+                 max_thrust=10.0, thrust_linearity=0.3, motor_time_constant=0.04,
+                 yaw_torque_coefficient=0.016, drag=0.3, angular_drag=0.02):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        mass : float (default 1.2)
+            Mass in kg.
+        arm_length : float (default 0.16)
+            Distance from the center to each motor in metres.
+        inertia : tuple of floats (default (0.012, 0.012, 0.022))
+            Moments of inertia around the body x, y and z axes in kg m^2.
+        max_thrust : float (default 10.0)
+            Thrust of one motor at full throttle in newtons.
+        thrust_linearity : float (default 0.3)
+            Share of the linear term in the thrust curve, the rest is
+            quadratic.
+        motor_time_constant : float (default 0.04)
+            Time constant of the motor lag in seconds.
+        yaw_torque_coefficient : float (default 0.016)
+            Reaction torque of a motor in Nm per newton of thrust.
+        drag : float (default 0.3)
+            Linear drag in N per m/s.
+        angular_drag : float (default 0.02)
+            Angular drag in Nm per rad/s.
+        """
+        self.mass = mass
+        self.inertia = inertia
+        self.max_thrust = max_thrust
+        self.thrust_linearity = thrust_linearity
+        self.motor_time_constant = motor_time_constant
+        self.yaw_torque_coefficient = yaw_torque_coefficient
+        self.drag = drag
+        self.angular_drag = angular_drag
+        d = arm_length / sqrt(2)
+        self.motor_positions = [(-d, d), (-d, -d), (d, -d), (d, d)]
+        self.motor_directions = [-1.0, 1.0, -1.0, 1.0]
+
+        self.position = [0.0, 0.0, 0.0]
+        self.velocity = [0.0, 0.0, 0.0]
+        self.orientation = [1.0, 0.0, 0.0, 0.0]
+        self.angular_velocity = [0.0, 0.0, 0.0]
+        self.acceleration = [0.0, 0.0, 0.0]
+        self.motor_commands = [1000, 1000, 1000, 1000]
+        self.motor_outputs = [0.0, 0.0, 0.0, 0.0]
+        self.on_ground = True
+        self.time = 0.0
+
+    def step(self, dt):
+        """Integrate the state over dt seconds."""
+        # Motors
+        thrusts = []
+        alpha = min(1.0, dt / self.motor_time_constant)
+        for i in range(4):
+            command = (self.motor_commands[i] - 1000) / 1000
+            command = min(1.0, max(0.0, command))
+            self.motor_outputs[i] += alpha * (command - self.motor_outputs[i])
+            u = self.motor_outputs[i]
+            thrusts.append(self.max_thrust * (self.thrust_linearity * u
+                                              + (1 - self.thrust_linearity) * u * u))
+        thrust = sum(thrusts)
+
+        # Torques in the body frame
+        tx = sum(y * t for (_, y), t in zip(self.motor_positions, thrusts))
+        ty = -sum(x * t for (x, _), t in zip(self.motor_positions, thrusts))
+        tz = self.yaw_torque_coefficient * sum(
+            s * t for s, t in zip(self.motor_directions, thrusts))
+
+        # Linear motion
+        fx, fy, fz = self.body_to_world((0.0, 0.0, thrust))
+        vx, vy, vz = self.velocity
+        ax = (fx - self.drag * vx) / self.mass
+        ay = (fy - self.drag * vy) / self.mass
+        az = (fz - self.drag * vz) / self.mass - GRAVITY
+
+        self.on_ground = self.position[2] <= 0.0 and az <= 0.0
+        if self.on_ground:
+            self.acceleration = [0.0, 0.0, 0.0]
+            self.velocity = [0.0, 0.0, 0.0]
+            self.angular_velocity = [0.0, 0.0, 0.0]
+            self.position[2] = 0.0
+        else:
+            self.acceleration = [ax, ay, az]
+            self.velocity = [vx + ax * dt, vy + ay * dt, vz + az * dt]
+            self.position = [p + v * dt for p, v in zip(self.position,
+                                                        self.velocity)]
+
+            # Angular motion, Euler's equations
+            wx, wy, wz = self.angular_velocity
+            ix, iy, iz = self.inertia
+            dwx = (tx - self.angular_drag * wx - (iz - iy) * wy * wz) / ix
+            dwy = (ty - self.angular_drag * wy - (ix - iz) * wz * wx) / iy
+            dwz = (tz - self.angular_drag * wz - (iy - ix) * wx * wy) / iz
+            self.angular_velocity = [wx + dwx * dt, wy + dwy * dt, wz + dwz * dt]
+
+            wx, wy, wz = self.angular_velocity
+            q0, q1, q2, q3 = self.orientation
+            q0, q1, q2, q3 = (q0 + 0.5 * dt * (-q1 * wx - q2 * wy - q3 * wz),
+                              q1 + 0.5 * dt * (q0 * wx + q2 * wz - q3 * wy),
+                              q2 + 0.5 * dt * (q0 * wy - q1 * wz + q3 * wx),
+                              q3 + 0.5 * dt * (q0 * wz + q1 * wy - q2 * wx))
+            norm = sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            self.orientation = [q0 / norm, q1 / norm, q2 / norm, q3 / norm]
+        self.time += dt
+
+    def body_to_world(self, vector):
+        """Rotate a vector from the body frame to the world frame."""
+        return _rotate(self.orientation, vector)
+
+    def world_to_body(self, vector):
+        """Rotate a vector from the world frame to the body frame."""
+        q0, q1, q2, q3 = self.orientation
+        return _rotate((q0, -q1, -q2, -q3), vector)
+
+    def specific_force(self):
+        """Get the acceleration an accelerometer measures in the body frame.
+
+        Returns
+        -------
+        tuple of floats
+            Acceleration in g for the body x, y and z axes.
+        """
+        ax, ay, az = self.acceleration
+        fx, fy, fz = self.world_to_body((ax, ay, az + GRAVITY))
+        return fx / GRAVITY, fy / GRAVITY, fz / GRAVITY
+
+
+def _rotate(q, vector):
+    q0, q1, q2, q3 = q
+    x, y, z = vector
+    # v + 2 * r x (r x v + q0 * v), where r is the vector part of q
+    cx = q2 * z - q3 * y + q0 * x
+    cy = q3 * x - q1 * z + q0 * y
+    cz = q1 * y - q2 * x + q0 * z
+    return (x + 2.0 * (q2 * cz - q3 * cy),
+            y + 2.0 * (q3 * cx - q1 * cz),
+            z + 2.0 * (q1 * cy - q2 * cx))
@@ -0,0 +1,378 @@
+"""Replay of recorded flights.
+
+The replay backends play back the MPU6050 samples of a flight log from
+FlightRecorder. FlightReplay feeds a whole log, the samples, the commands
+and the timing, through the unmodified FlightController.loop on a virtual
+clock and collects the pulses the flight controller outputs on every
+iteration. Run
+
+    python -m drone.simulation.replay flight.log --golden golden/
+
+to check that the pulses of every log still match the stored golden run of
+it, or add --update-golden to store the current pulses as the golden runs.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+from drone.flight_controller.command_channel import ALIVE, UNKNOWN, Command
+from drone.flight_controller.esc import ESCGroup
+from drone.flight_controller.estimators import MadgwickEstimator
+from drone.flight_controller.flight_controller import (DEFAULT_GAINS,
+                                                       FlightController,
+                                                       load_gains)
+from drone.flight_controller.imu import IMU
+from drone.flight_controller.mixer import FRAMES, Mixer
+from drone.flight_controller.mpu6050 import MPU6050
+from drone.flight_controller.recorder import (read_flight_log,
+                                              read_flight_log_header)
+from drone.simulation.clock import SimulatedClock
+from drone.simulation.world import ESC_PINS
+
+
+class ReplayI2CBus:
+    """i2c bus that plays back the MPU6050 samples of a flight log.
+
+    Every burst read of the sensor registers returns the next recorded
+    sample, with the smbus interface. Other reads return the WHO_AM_I of a
+    MPU6050 or zeros, e.g. an empty FIFO, and writes are ignored, so only the
+    polling mode of IMU can be replayed.
+    """
+
+    _ACCEL_XOUT_H = 0x3B
+    _WHO_AM_I = 0x75
+    _SENSOR_REGISTERS = struct.Struct(">7h")
+
+    def __init__(self, path, records=None):
+        """Load the flight log.
+
+        Parameters
+        ----------
+        path : str
+            Path of a log written by FlightRecorder.
+        records : list of tuples or None (default None)
+            The records of the log from read_flight_log, if already read.
+        """
+        if records is None:
+            records = read_flight_log(path)
+        # The raw sample of a record is the accelerometer, temperature and
+        # gyroscope fields following the timestamp.
+        self.samples = [list(self._SENSOR_REGISTERS.pack(*record[1:8]))
+                        for record in records]
+        self.index = 0
+
+    def write_byte_data(self, address, register, value):
+        pass
+
+    def read_byte_data(self, address, register):
+        if register == self._WHO_AM_I:
+            return 0x68
+        return 0
+
+    def read_i2c_block_data(self, address, register, length):
+        if register != self._ACCEL_XOUT_H:
+            return [0] * length
+        if self.index >= len(self.samples):
+            raise EOFError("The flight log has no more samples")
+        sample = self.samples[self.index]
+        self.index += 1
+        return sample[:length]
+
+
+class ReplayPigpio:
+    """pigpio connection that stores the pulsewidths instead of driving ESCs.
+
+    Implements the parts of pigpio.pi the ESCs use. Every change is appended
+    to writes as (gpio, pulsewidth) for comparing with the recorded pulses.
+    """
+
+    def __init__(self):
+        self.pulsewidths = {}
+        self.writes = []
+        self._scripts = {}
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        self.pulsewidths[gpio] = pulsewidth
+        self.writes.append((gpio, pulsewidth))
+
+    def get_servo_pulsewidth(self, gpio):
+        return self.pulsewidths.get(gpio, 0)
+
+    def store_script(self, script):
+        # Scripts of ESCGroup: "servo <gpio> p<parameter> ...".
+        tokens = script.decode().split()
+        script_id = len(self._scripts)
+        self._scripts[script_id] = [int(gpio) for gpio in tokens[1::3]]
+        return script_id
+
+    def script_status(self, script_id):
+        return 1, []
+
+    def run_script(self, script_id, params):
+        for gpio, pulsewidth in zip(self._scripts[script_id], params):
+            self.set_servo_pulsewidth(gpio, pulsewidth)
+        return 0
+
+    def delete_script(self, script_id):
+        del self._scripts[script_id]
+
+    def stop(self):
+        pass
+
+
+class ReplayADC:
+    """ADC channel for replays. The flight logs have no voltages, so it reads 0."""
+
+    value = 0.0
+
+
+# Indices of the fields in the flattened records of read_flight_log.
+_TIMESTAMP = 0
+_COMMANDS = slice(12, 16)
+_PULSES = slice(22, None)
+
+
+class FlightReplay:
+    """Replays a flight log through the flight controller.
+
+    The flight controller runs its own loop, with this object as both its
+    command channel and its scheduler. Every iteration of the loop replays
+    one record: the IMU reads the raw sample of the record from a
+    ReplayI2CBus, the commands of the record are the latest message of the
+    channel, and the virtual clock shows the timestamp of the record until
+    the wait of the iteration moves it to the next one. The replay ends when
+    the samples run out.
+
+    The loop rate, the gyroscope offsets, the orientation and the time of the
+    previous IMU measurement at the start come from the header of the log.
+    Within an iteration all the times are the timestamp of the record,
+    whereas on the drone the IMU and the controllers read their clocks a few
+    microseconds apart, so a log recorded on the drone is reproduced up to
+    those differences. A log recorded in the simulator is reproduced exactly.
+    """
+
+    def __init__(self, path, gains=None, rate_loop=False,
+                 angle_loop_interval=2, estimator=None,
+                 track_gyroscope_bias=True, loop_rate=500, frame="quad_x"):
+        """Load the flight log and set up the flight controller.
+
+        Parameters
+        ----------
+        path : str
+            Path of a log written by FlightRecorder.
+        gains, rate_loop, angle_loop_interval
+            Passed to FlightController. Need to be the ones the log was
+            recorded with, e.g. the gains in ~/.drone/gains.json of the
+            drone.
+        estimator : estimator or None (default None)
+            Passed to IMU. If None, Madgwick's filter with the beta of the
+            gains, like on the drone.
+        track_gyroscope_bias : bool (default True)
+            Passed to IMU, True like on the drone.
+        loop_rate : float (default 500)
+            Rate of the flight loop in Hz for logs recorded without it.
+        frame : str or sequence of tuples (default "quad_x")
+            The frame of the Mixer, see drone.flight_controller.mixer. Needs
+            to have the motors of the log.
+        """
+        header = read_flight_log_header(path)
+        records = read_flight_log(path)
+        if not records:
+            raise ValueError("{} has no records".format(path))
+        mixer = Mixer(frame)
+        if mixer.motors != header["motors"]:
+            raise ValueError("{} has {} motors, the frame {}".format(
+                path, header["motors"], mixer.motors))
+        self.path = path
+        self.records = records
+        self.rate = header["loop_rate"] or loop_rate
+        self.period_ns = int(round(1e9 / self.rate))
+        self.clock = SimulatedClock()
+        self.clock.advance_ns(records[0][_TIMESTAMP])
+        self.index = 0
+        self.pulses = []
+        self.iterations = 0
+        self.missed_deadlines = 0
+        self.last_period = None
+        self._started = False
+
+        self.bus = ReplayI2CBus(path, records)
+        if estimator is None:
+            beta = (gains or DEFAULT_GAINS).get("beta", DEFAULT_GAINS["beta"])
+            estimator = MadgwickEstimator(beta=beta)
+        self.imu = IMU(mpu6050=MPU6050(self.bus), clock=self.clock.time,
+                       track_gyroscope_bias=track_gyroscope_bias,
+                       estimator=estimator)
+        offsets = header["gyroscope_offsets"]
+        self.imu.gyroscope_offsets["x"] = offsets[0]
+        self.imu.gyroscope_offsets["y"] = offsets[1]
+        self.imu.gyroscope_offsets["z"] = offsets[2]
+        estimator = self.imu.estimator
+        (estimator.q0, estimator.q1, estimator.q2,
+         estimator.q3) = header["quaternion"]
+        self.imu.time_of_previous_measurement = (self.clock.time()
+                                                 - header["measurement_age"])
+        self.pi = ReplayPigpio()
+        self.flight_controller = FlightController(
+            self.rate, scheduler=self, gains=gains, rate_loop=rate_loop,
+            angle_loop_interval=angle_loop_interval, mixer=mixer)
+        # The pins only tell the ESCs apart in the pulses of ReplayPigpio.
+        pins = ESC_PINS if mixer.motors == len(ESC_PINS) \
+            else list(range(mixer.motors))
+        self.flight_controller.setup(imu=self.imu,
+                                     escs=ESCGroup(pins, pi=self.pi))
+
+    def run(self):
+        """Replay the whole log.
+
+        Returns
+        -------
+        list of tuples
+            The pulses of every iteration.
+        """
+        try:
+            self.flight_controller.loop(self)
+        except EOFError:
+            pass
+        return self.pulses
+
+    def recorded_pulses(self):
+        """Get the pulses the log recorded for every iteration."""
+        return [tuple(record[_PULSES]) for record in self.records]
+
+    # The command channel interface
+
+    def read(self):
+        if not self._started:
+            return Command(0, UNKNOWN, 1000, 1500, 1500, 1500, 0)
+        # The commands are recorded as parsed by FlightController, so they
+        # are converted back to the values the web client sent.
+        throttle, yaw, pitch, roll = self.records[self.index][_COMMANDS]
+        return Command(self.index + 1, ALIVE, int(round(throttle)),
+                       int(round(1000 + (yaw + 90) * 1000 / 180)),
+                       int(round(1000 + (pitch + 30) * 1000 / 60)),
+                       int(round(1000 + (roll + 30) * 1000 / 60)),
+                       self.clock.monotonic_ns())
+
+    # The scheduler interface
+
+    def now(self):
+        return self.clock.monotonic_ns()
+
+    def start(self):
+        self._started = True
+
+    def wait(self):
+        self.pulses.append(tuple(self.flight_controller._pulses))
+        self.iterations += 1
+        self.index += 1
+        if self.index < len(self.records):
+            period = (self.records[self.index][_TIMESTAMP]
+                      - self.records[self.index - 1][_TIMESTAMP])
+            self.last_period = period
+            self.clock.advance_ns(period)
+
+    def get_statistics(self):
+        return {"iterations": self.iterations,
+                "missed_deadlines": self.missed_deadlines}
+
+
+def diff_pulses(pulses, golden):
+    """Compare the pulses of a replay with a golden run.
+
+    Parameters
+    ----------
+    pulses, golden : list of sequences of ints
+
+    Returns
+    -------
+    dict
+        The numbers of iterations in both, the number of iterations whose
+        pulses differ, the first of them or None, and the largest difference
+        of a pulse in microseconds.
+    """
+    different = 0
+    first = None
+    max_difference = 0
+    for i, (a, b) in enumerate(zip(pulses, golden)):
+        if tuple(a) != tuple(b):
+            different += 1
+            if first is None:
+                first = i
+            max_difference = max(max_difference, max(
+                abs(x - y) for x, y in zip(a, b)))
+    if len(pulses) != len(golden) and first is None:
+        first = min(len(pulses), len(golden))
+    return {"iterations": len(pulses), "golden_iterations": len(golden),
+            "different": different, "first": first,
+            "max_difference": max_difference}
+
+
+def _golden_path(golden_directory, path):
+    return os.path.join(golden_directory,
+                        os.path.basename(path) + ".pulses.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay flight logs through the flight controller.")
+    parser.add_argument("logs", nargs="+", metavar="LOG")
+    parser.add_argument("--golden", metavar="DIRECTORY",
+                        help="directory of the golden runs to compare with")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="store the pulses as the golden runs")
+    parser.add_argument("--gains", metavar="PATH",
+                        help="gains file the logs were recorded with, e.g. "
+                             "~/.drone/gains.json of the drone")
+    parser.add_argument("--rate-loop", action="store_true")
+    parser.add_argument("--frame", default="quad_x", choices=sorted(FRAMES),
+                        help="frame the logs were recorded with")
+    parser.add_argument("--no-bias-tracking", action="store_true",
+                        help="do not refine the gyroscope offsets, e.g. for "
+                             "logs recorded in the simulator")
+    args = parser.parse_args()
+    gains = load_gains(args.gains) if args.gains is not None else None
+
+    failed = False
+    for path in args.logs:
+        wall_start = time.perf_counter()
+        replay = FlightReplay(path, gains=gains, rate_loop=args.rate_loop,
+                              track_gyroscope_bias=not args.no_bias_tracking,
+                              frame=args.frame)
+        pulses = replay.run()
+        wall_time = time.perf_counter() - wall_start
+        flight_time = (replay.records[-1][_TIMESTAMP]
+                       - replay.records[0][_TIMESTAMP]) / 1e9
+        recorded = diff_pulses(pulses, replay.recorded_pulses())
+        print("{}: {} iterations in {:.2f} s ({:.0f}x real time), {} differ "
+              "from the recorded pulses".format(
+                  path, len(pulses), wall_time,
+                  flight_time / wall_time if wall_time else 0.0,
+                  recorded["different"]))
+        if args.golden is None:
+            continue
+        golden_path = _golden_path(args.golden, path)
+        if args.update_golden:
+            os.makedirs(args.golden, exist_ok=True)
+            with open(golden_path, "w") as f:
+                json.dump({"pulses": pulses}, f)
+            continue
+        with open(golden_path) as f:
+            golden = json.load(f)["pulses"]
+        result = diff_pulses(pulses, golden)
+        if result["first"] is not None:
+            failed = True
+            print("  DIFFERS from {}: {} of {} iterations, first at {}, by "
+                  "up to {} us".format(golden_path, result["different"],
+                                       result["golden_iterations"],
+                                       result["first"],
+                                       result["max_difference"]))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Software-in-the-loop simulation of the drone.
+
+Runs the unmodified FlightController, IMU and PID code against a simulated
+quadcopter on a simulated clock, much faster than real time. Run
+``python -m drone.simulation.simulator`` for a short scripted flight.
+"""
+import argparse
+import time
+from math import pi
+
+from drone.flight_controller.command_channel import (Command, UNKNOWN, ALIVE,
+                                                     NOT_ALIVE)
+from drone.flight_controller.esc import ESCGroup
+from drone.flight_controller.estimators import MadgwickEstimator
+from drone.flight_controller.flight_controller import (DEFAULT_GAINS,
+                                                       FlightController)
+from drone.flight_controller.imu import IMU
+from drone.flight_controller.madgwick import quaternion_to_euler
+from drone.flight_controller.mpu6050 import MPU6050
+from drone.flight_controller.scheduler import RateScheduler
+from drone.simulation.clock import SimulatedClock
+from drone.simulation.hardware import (SimulatedI2CBus, SimulatedMPU6050Device,
+                                       SimulatedPigpio)
+from drone.simulation.quadcopter import Quadcopter
+from drone.simulation.world import ESC_PINS
+
+
+class ScriptedCommandChannel:
+    """Command channel that plays back scripted stick inputs.
+
+    Has the read interface of CommandChannel. The client is alive from the
+    start, sends a heartbeat message every heartbeat_interval seconds like
+    the web client does, and says it is not alive at end_time.
+    """
+
+    def __init__(self, clock, script, end_time, heartbeat_interval=0.5):
+        """Initialize variables.
+
+        Parameters
+        ----------
+        clock : SimulatedClock
+        script : list of (float, dict)
+            Times in seconds and the commands sent at them, e.g.
+            ``[(1.0, {"throttle": 1600}), (3.0, {"roll": 1600})]``. See
+            CommandChannel.write for the commands.
+        end_time : float
+            Time in seconds at which the flight is ended.
+        heartbeat_interval : float (default 0.5)
+        """
+        self._clock = clock
+        self._script = sorted(script, key=lambda entry: entry[0])
+        self._index = 0
+        self._end_time = end_time
+        self._heartbeat_interval = heartbeat_interval
+        self._next_heartbeat = 0.0
+        self._state = {"throttle": 1000, "yaw": 1500, "pitch": 1500,
+                       "roll": 1500}
+        self._sequence = 0
+        self._alive = UNKNOWN
+        self._timestamp_ns = 0
+
+    def read(self):
+        now = self._clock.time()
+        if self._alive != NOT_ALIVE:
+            if now >= self._end_time:
+                self._message(NOT_ALIVE)
+            while (self._index < len(self._script)
+                   and self._script[self._index][0] <= now):
+                self._state.update(self._script[self._index][1])
+                self._index += 1
+                self._message(ALIVE)
+            if now >= self._next_heartbeat:
+                self._next_heartbeat = now + self._heartbeat_interval
+                self._message(ALIVE)
+        state = self._state
+        return Command(self._sequence, self._alive, state["throttle"],
+                       state["yaw"], state["pitch"], state["roll"],
+                       self._timestamp_ns)
+
+    def _message(self, alive):
+        if self._alive != NOT_ALIVE:
+            self._alive = alive
+        self._sequence += 1
+        self._timestamp_ns = self._clock.monotonic_ns()
+
+
+class Simulator:
+    """Simulated drone running the flight controller code.
+
+    The quadcopter is stepped with a fixed physics time step whenever the
+    flight loop sleeps, so the flight loop sees the same timing it would see
+    on the real drone, just without waiting for it.
+    """
+
+    def __init__(self, loop_rate=500, physics_rate=2000, use_fifo=False,
+                 transaction_time=0.0, quadcopter=None, seed=0,
+                 history_interval=0.01, recorder=None, gains=None,
+                 rate_loop=False):
+        """Initialize the simulated hardware and the flight controller.
+
+        Parameters
+        ----------
+        loop_rate : float (default 500)
+            Rate of the flight loop in Hz.
+        physics_rate : float (default 2000)
+            Rate of the physics steps in Hz.
+        use_fifo : bool (default False)
+            Use the FIFO mode of the IMU.
+        transaction_time : float (default 0.0)
+            Simulated duration of each i2c transaction in seconds.
+        quadcopter : Quadcopter or None (default None)
+            Quadcopter model. If None, the default model is used.
+        seed : int (default 0)
+            Seed for the sensor noise.
+        history_interval : float (default 0.01)
+            Interval in seconds in which the state is stored to history.
+        recorder : FlightRecorder or None (default None)
+            Recorder for the flight controller.
+        gains : dict or None (default None)
+            Gains for the flight controller and the IMU, see DEFAULT_GAINS.
+        rate_loop : bool (default False)
+            Passed to FlightController.
+        """
+        self.clock = SimulatedClock()
+        self.quadcopter = quadcopter if quadcopter is not None else Quadcopter()
+        self.bus = SimulatedI2CBus(self.clock, transaction_time)
+        self.mpu6050_device = SimulatedMPU6050Device(self.quadcopter,
+                                                     self.clock, seed=seed)
+        self.bus.attach(self.mpu6050_device.address, self.mpu6050_device)
+        self.pi = SimulatedPigpio(self.quadcopter, ESC_PINS)
+        self.history = []
+        self._physics_dt = 1.0 / physics_rate
+        self._history_interval = history_interval
+        self._next_history = 0.0
+        self.clock.add_listener(self._advance)
+
+        if gains is None:
+            gains = DEFAULT_GAINS
+        self.imu = IMU(use_fifo=use_fifo, mpu6050=MPU6050(self.bus),
+                       clock=self.clock.time,
+                       estimator=MadgwickEstimator(beta=gains.get(
+                           "beta", DEFAULT_GAINS["beta"])))
+        self.imu.calibrate()
+        self.escs = ESCGroup(ESC_PINS, pi=self.pi)
+        scheduler = RateScheduler(loop_rate, spin_threshold=0.0,
+                                  clock=self.clock.monotonic_ns,
+                                  sleep=self.clock.sleep)
+        self.flight_controller = FlightController(loop_rate, recorder=recorder,
+                                                  scheduler=scheduler,
+                                                  gains=gains,
+                                                  rate_loop=rate_loop)
+        self.flight_controller.setup(imu=self.imu, escs=self.escs)
+
+    def run(self, script, duration):
+        """Fly the scripted commands.
+
+        Parameters
+        ----------
+        script : list of (float, dict)
+            See ScriptedCommandChannel.
+        duration : float
+            Length of the flight in simulated seconds.
+
+        Returns
+        -------
+        dict
+            The simulated and wall clock durations and the loop statistics.
+        """
+        start = self.clock.time()
+        channel = ScriptedCommandChannel(self.clock, [
+            (start + t, command) for t, command in script], start + duration)
+        wall_start = time.perf_counter()
+        self.flight_controller.loop(channel)
+        wall_time = time.perf_counter() - wall_start
+        simulated_time = self.clock.time() - start
+        return {"simulated_time": simulated_time,
+                "wall_time": wall_time,
+                "speedup": simulated_time / wall_time,
+                "loop": self.flight_controller.get_loop_statistics()}
+
+    def _advance(self, now):
+        quadcopter = self.quadcopter
+        while quadcopter.time + self._physics_dt <= now:
+            quadcopter.step(self._physics_dt)
+            self.mpu6050_device.advance(quadcopter.time)
+            if quadcopter.time >= self._next_history:
+                self._next_history += self._history_interval
+                self.history.append(self.state())
+
+    def state(self):
+        """Get the true state of the quadcopter.
+
+        Returns
+        -------
+        dict
+            Time, position, velocity, yaw, pitch and roll in degrees in the
+            conventions of IMU and the motor commands.
+        """
+        quadcopter = self.quadcopter
+        # The euler angles of the body are the ones IMU reports for a module
+        # mounted upside down.
+        q0, q1, q2, q3 = quadcopter.orientation
+        yaw, pitch, roll = quaternion_to_euler(-q1, q0, q3, -q2)
+        return {"time": quadcopter.time,
+                "position": tuple(quadcopter.position),
+                "velocity": tuple(quadcopter.velocity),
+                "yaw": yaw * 180 / pi,
+                "pitch": pitch * 180 / pi,
+                "roll": roll * 180 / pi,
+                "motor_commands": tuple(quadcopter.motor_commands)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--loop-rate", type=float, default=500)
+    parser.add_argument("--fifo", action="store_true")
+    args = parser.parse_args()
+
+    script = [(1.0, {"throttle": 1500}),
+              (3.0, {"roll": 1600}),
+              (4.0, {"roll": 1500}),
+              (5.0, {"pitch": 1600}),
+              (6.0, {"pitch": 1500}),
+              (args.duration - 2.0, {"throttle": 1000})]
+    simulator = Simulator(loop_rate=args.loop_rate, use_fifo=args.fifo)
+    result = simulator.run(script, args.duration)
+    print("Simulated {simulated_time:.2f} s in {wall_time:.2f} s "
+          "({speedup:.1f}x real time)".format(**result))
+    print(result["loop"])
+    state = simulator.state()
+    print("Final position {}, yaw {:.1f}, pitch {:.1f}, roll {:.1f}".format(
+        tuple(round(p, 2) for p in state["position"]), state["yaw"],
+        state["pitch"], state["roll"]))
+
+
+if __name__ == "__main__":
+    main()
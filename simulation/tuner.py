@@ -0,0 +1,324 @@
+"""Automatic tuning of the flight controller gains in the simulator.
+
+Every candidate set of gains flies the same scripted steps of roll, pitch
+and yaw in Simulator, running the unmodified flight controller code, and is
+scored by its step responses: the overshoot, the settling time and the
+remaining error of every step, and the share of time the motors spend
+saturated. A candidate that tips over more than max_tilt degrees fails and
+is scored by how long it stayed up.
+
+The search is the cross-entropy method: candidates are drawn from a normal
+distribution over the logarithms of the gains, the distribution is moved to
+the best candidates of each generation, and the spread shrinks as the
+candidates agree. The candidates of a generation are flown in parallel on
+all cores. Run
+
+    python -m drone.simulation.tuner --output gains.json
+
+and load the result with drone.flight_controller.flight_controller.
+load_gains, or copy it to DEFAULT_GAINS_PATH for the drone to use.
+"""
+import argparse
+import contextlib
+import copy
+import io
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import exp, log, sqrt
+
+from drone.flight_controller.flight_controller import (DEFAULT_GAINS,
+                                                       save_gains)
+from drone.simulation.simulator import Simulator
+
+
+# Steps as (time, axis, target), the targets being angles in degrees for
+# roll and pitch and the rate in degrees/sec for yaw. Each step lasts until
+# the next one.
+STEPS = [
+    (2.0, "roll", 9.0),
+    (3.5, "roll", 0.0),
+    (5.0, "pitch", -9.0),
+    (6.5, "pitch", 0.0),
+    (8.0, "yaw", 45.0),
+    (9.5, "yaw", 0.0),
+]
+TAKEOFF_TIME = 0.5
+DURATION = 11.0
+THROTTLE = 1500
+
+# The tuned gains as (name, controller, gain, axes, low, high). The axes are
+# indices of yaw, pitch and roll in the lists of DEFAULT_GAINS. Pitch and roll
+# share their gains, because the frame is symmetric.
+ANGLE_PARAMETERS = [
+    ("yaw_p", "angle", "p", (0, ), 0.1, 20.0),
+    ("yaw_i", "angle", "i", (0, ), 0.001, 10.0),
+    ("yaw_d", "angle", "d", (0, ), 0.001, 1.0),
+    ("tilt_p", "angle", "p", (1, 2), 0.1, 30.0),
+    ("tilt_i", "angle", "i", (1, 2), 0.001, 20.0),
+    ("tilt_d", "angle", "d", (1, 2), 0.001, 5.0),
+]
+RATE_PARAMETERS = [
+    ("yaw_rate_p", "rate", "p", (0, ), 0.01, 20.0),
+    ("yaw_rate_i", "rate", "i", (0, ), 0.001, 10.0),
+    ("yaw_rate_d", "rate", "d", (0, ), 0.001, 1.0),
+    ("tilt_rate_p", "rate", "p", (1, 2), 0.01, 20.0),
+    ("tilt_rate_i", "rate", "i", (1, 2), 0.001, 10.0),
+    ("tilt_rate_d", "rate", "d", (1, 2), 0.001, 1.0),
+]
+BETA_PARAMETER = ("beta", None, "beta", (), 0.0005, 5.0)
+
+# Pulsewidths at which a motor is saturated.
+_MIN_PULSE = 1000
+_MAX_PULSE = 1900
+_STICK_SCALE = {"roll": 1000 / 60, "pitch": 1000 / 60, "yaw": 1000 / 180}
+
+
+def parameters(rate_loop=False):
+    """Get the tuned parameters, see ANGLE_PARAMETERS."""
+    if rate_loop:
+        # The yaw command is a rate, so with the rate controller it has no
+        # angle controller to tune.
+        return ANGLE_PARAMETERS[3:] + RATE_PARAMETERS + [BETA_PARAMETER]
+    return ANGLE_PARAMETERS + [BETA_PARAMETER]
+
+
+def candidate_gains(values, rate_loop=False):
+    """Build the gains of a candidate.
+
+    Parameters
+    ----------
+    values : dict
+        Value of every parameter by name.
+    rate_loop : bool (default False)
+
+    Returns
+    -------
+    dict
+        The gains for FlightController, see DEFAULT_GAINS.
+    """
+    gains = copy.deepcopy(DEFAULT_GAINS)
+    for name, controller, gain, axes, _, _ in parameters(rate_loop):
+        if controller is None:
+            gains[gain] = values[name]
+        for axis in axes:
+            gains[controller][gain][axis] = values[name]
+    if rate_loop:
+        # The angle controller of yaw passes the rate error through.
+        gains["angle"]["p"][0] = 1.0
+    return gains
+
+
+def _script():
+    script = [(TAKEOFF_TIME, {"throttle": THROTTLE})]
+    for t, axis, target in STEPS:
+        script.append((t, {axis: int(round(1500 + target
+                                           * _STICK_SCALE[axis]))}))
+    script.append((DURATION - 0.5, {"throttle": 1000}))
+    return script
+
+
+def _responses(history):
+    """Get the time, roll, pitch and yaw rate of every history entry."""
+    times = [state["time"] for state in history]
+    responses = {"roll": [state["roll"] for state in history],
+                 "pitch": [state["pitch"] for state in history]}
+    yaw_rates = [0.0]
+    for previous, state in zip(history, history[1:]):
+        difference = (state["yaw"] - previous["yaw"] + 180) % 360 - 180
+        yaw_rates.append(difference / (state["time"] - previous["time"]))
+    responses["yaw"] = yaw_rates
+    return times, responses
+
+
+def score_flight(history, max_tilt=45.0, saturation_weight=5.0):
+    """Score a flight of the step script.
+
+    Parameters
+    ----------
+    history : list of dicts
+        Simulator.history of the flight.
+    max_tilt : float (default 45.0)
+        Largest roll or pitch in degrees before the flight counts as failed.
+    saturation_weight : float (default 5.0)
+        Weight of the saturated share of the time in the score.
+
+    Returns
+    -------
+    dict
+        The score, lower being better, and the metrics of every step.
+    """
+    times, responses = _responses(history)
+    start = STEPS[0][0]
+    end = DURATION - 0.5
+    for t, state in zip(times, history):
+        if t < start or t > end:
+            continue
+        if abs(state["roll"]) > max_tilt or abs(state["pitch"]) > max_tilt:
+            return {"score": 1000.0 + end - t, "failed": True, "steps": []}
+
+    previous_targets = {"roll": 0.0, "pitch": 0.0, "yaw": 0.0}
+    score = 0.0
+    steps = []
+    for k, (t0, axis, target) in enumerate(STEPS):
+        t1 = STEPS[k + 1][0] if k + 1 < len(STEPS) else end
+        size = target - previous_targets[axis]
+        previous_targets[axis] = target
+        window = [(t, value) for t, value in zip(times, responses[axis])
+                  if t0 <= t < t1]
+        direction = 1.0 if size > 0 else -1.0
+        overshoot = max(0.0, max((value - target) * direction
+                                 for _, value in window)) / abs(size)
+        band = max(0.1 * abs(size), 0.5)
+        settling_time = 0.0
+        for t, value in window:
+            if abs(value - target) > band:
+                settling_time = t - t0
+        tail = window[int(0.8 * len(window)):]
+        steady_error = sum(abs(value - target) for _, value in tail) / len(
+            tail) / abs(size)
+        score += overshoot + settling_time / (t1 - t0) + steady_error
+        steps.append({"axis": axis, "target": target, "overshoot": overshoot,
+                      "settling_time": settling_time,
+                      "steady_error": steady_error})
+
+    flying = [state["motor_commands"] for t, state in zip(times, history)
+              if start <= t <= end]
+    saturation = sum(1 for commands in flying
+                     if max(commands) >= _MAX_PULSE
+                     or min(commands) <= _MIN_PULSE) / len(flying)
+    score += saturation_weight * saturation
+    return {"score": score, "failed": False, "saturation": saturation,
+            "steps": steps}
+
+
+def evaluate(gains, rate_loop=False, seed=0, loop_rate=500):
+    """Fly the step script with the given gains and score it.
+
+    Returns
+    -------
+    dict
+        See score_flight. A flight that raises is failed with a score of
+        2000.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            simulator = Simulator(loop_rate=loop_rate, seed=seed,
+                                  gains=gains, rate_loop=rate_loop)
+            simulator.run(_script(), DURATION)
+    except (ArithmeticError, ValueError) as e:
+        return {"score": 2000.0, "failed": True, "steps": [],
+                "error": repr(e)}
+    return score_flight(simulator.history)
+
+
+def _evaluate_candidate(arguments):
+    values, rate_loop, seed = arguments
+    return evaluate(candidate_gains(values, rate_loop), rate_loop, seed)
+
+
+def tune(generations=15, population=32, elites=8, rate_loop=False, seed=0,
+         workers=None, smoothing=0.7, report=print):
+    """Search for the gains with the cross-entropy method.
+
+    Parameters
+    ----------
+    generations : int (default 15)
+    population : int (default 32)
+        Candidates flown per generation.
+    elites : int (default 8)
+        Best candidates the distribution is fitted to.
+    rate_loop : bool (default False)
+        Tune the gains of the rate controller too.
+    seed : int (default 0)
+        Seed of the search and of the sensor noise.
+    workers : int or None (default None)
+        Processes flying the candidates. None for one per core.
+    smoothing : float (default 0.7)
+        Weight of the elites in the new distribution against the old one.
+    report : callable (default print)
+        Called with a progress line after every generation.
+
+    Returns
+    -------
+    tuple
+        The gains of the best candidate and its result of score_flight.
+    """
+    tuned = parameters(rate_loop)
+    lows = [log(low) for _, _, _, _, low, _ in tuned]
+    highs = [log(high) for _, _, _, _, _, high in tuned]
+    means = [(low + high) / 2 for low, high in zip(lows, highs)]
+    deviations = [(high - low) / 4 for low, high in zip(lows, highs)]
+    min_deviations = [(high - low) / 100 for low, high in zip(lows, highs)]
+    rng = random.Random(seed)
+    best = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for generation in range(generations):
+            start = time.perf_counter()
+            samples = []
+            for _ in range(population):
+                samples.append([min(high, max(low, rng.gauss(mean, deviation)))
+                                for mean, deviation, low, high in zip(
+                                    means, deviations, lows, highs)])
+            candidates = [{name: exp(x) for (name, *_), x in zip(tuned, sample)}
+                          for sample in samples]
+            results = list(executor.map(_evaluate_candidate, [
+                (values, rate_loop, seed) for values in candidates]))
+            ranked = sorted(range(population),
+                            key=lambda i: results[i]["score"])
+            if best is None or results[ranked[0]]["score"] < best[1]["score"]:
+                best = (candidates[ranked[0]], results[ranked[0]])
+
+            elite_samples = [samples[i] for i in ranked[:elites]]
+            for j in range(len(tuned)):
+                values = [sample[j] for sample in elite_samples]
+                mean = sum(values) / elites
+                deviation = sqrt(sum((v - mean) ** 2 for v in values) / elites)
+                means[j] = smoothing * mean + (1 - smoothing) * means[j]
+                deviations[j] = max(min_deviations[j], smoothing * deviation
+                                    + (1 - smoothing) * deviations[j])
+            failed = sum(1 for result in results if result["failed"])
+            report("generation {:>3}: best {:.3f}, generation best {:.3f}, "
+                "{} of {} failed, {:.1f} s".format(
+                    generation, best[1]["score"],
+                    results[ranked[0]]["score"], failed, population,
+                    time.perf_counter() - start))
+    return candidate_gains(best[0], rate_loop), best[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="gains.json",
+                        help="path of the gains file to write")
+    parser.add_argument("--generations", type=int, default=15)
+    parser.add_argument("--population", type=int, default=32)
+    parser.add_argument("--elites", type=int, default=8)
+    parser.add_argument("--rate-loop", action="store_true",
+                        help="tune the rate controller too")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes to use, one per core by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    gains, result = tune(args.generations, args.population, args.elites,
+                         args.rate_loop, args.seed, args.workers)
+    print("Tuned in {:.0f} s on {} cores".format(
+        time.perf_counter() - start, args.workers or os.cpu_count()))
+    if result["failed"]:
+        print("No candidate flew the steps, not writing {}".format(
+            args.output))
+        return
+    for step in result["steps"]:
+        print("{axis:<6}{target:>7.1f}  overshoot {overshoot:6.1%}  "
+              "settling {settling_time:5.2f} s  error {steady_error:6.1%}"
+              .format(**step))
+    print("Saturated {:.1%} of the time, score {:.3f}".format(
+        result["saturation"], result["score"]))
+    save_gains(gains, args.output)
+    print("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
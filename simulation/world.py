@@ -0,0 +1,72 @@
+import threading
+import time
+
+from drone.simulation.clock import SimulatedClock
+from drone.simulation.hardware import (SimulatedADC, SimulatedI2CBus,
+                                       SimulatedMPU6050Device, SimulatedPigpio)
+from drone.simulation.quadcopter import Quadcopter
+
+
+# The gpio pins of the motors in the motor order, as in
+# the default esc_pins of FlightController.
+ESC_PINS = [13, 12, 24, 18]
+
+_world = None
+_world_lock = threading.Lock()
+
+
+class RealTimeWorld:
+    """Simulated quadcopter that runs in wall clock time.
+
+    Provides the simulated hardware for the simulated backend, see
+    drone.flight_controller.backends. Unlike Simulator, nothing drives the
+    simulated clock: the world is brought up to the wall clock time whenever
+    the i2c bus is used, so the unmodified flight code with its real-time
+    scheduler flies the simulated quadcopter.
+    """
+
+    def __init__(self, quadcopter=None, physics_rate=2000, seed=0):
+        """Initialize the simulated hardware.
+
+        Parameters
+        ----------
+        quadcopter : Quadcopter or None (default None)
+            Quadcopter model. If None, the default model is used.
+        physics_rate : float (default 2000)
+            Rate of the physics steps in Hz.
+        seed : int (default 0)
+            Seed for the sensor noise.
+        """
+        self.clock = SimulatedClock()
+        self.quadcopter = quadcopter if quadcopter is not None else Quadcopter()
+        self.mpu6050_device = SimulatedMPU6050Device(self.quadcopter,
+                                                     self.clock, seed=seed)
+        self.bus = SimulatedI2CBus(on_transaction=self.sync)
+        self.bus.attach(self.mpu6050_device.address, self.mpu6050_device)
+        self.pi = SimulatedPigpio(self.quadcopter, ESC_PINS)
+        self.adc = SimulatedADC()
+        self._physics_dt = 1.0 / physics_rate
+        self._start_ns = time.monotonic_ns()
+        self._lock = threading.Lock()
+        self.clock.add_listener(self._advance)
+
+    def sync(self):
+        """Advance the simulated world to the current wall clock time."""
+        with self._lock:
+            self.clock.advance_ns(time.monotonic_ns() - self._start_ns
+                                  - self.clock.monotonic_ns())
+
+    def _advance(self, now):
+        quadcopter = self.quadcopter
+        while quadcopter.time + self._physics_dt <= now:
+            quadcopter.step(self._physics_dt)
+            self.mpu6050_device.advance(quadcopter.time)
+
+
+def get_world():
+    """Get the world shared by all the devices of the simulated backend."""
+    global _world
+    with _world_lock:
+        if _world is None:
+            _world = RealTimeWorld()
+        return _world
@@ -0,0 +1,56 @@
+import pytest
+
+from drone.flight_controller.command_channel import (ALIVE, NOT_ALIVE,
+                                                     UNKNOWN, CommandChannel)
+
+
+@pytest.fixture
+def channel():
+    channel = CommandChannel(create=True)
+    yield channel
+    channel.close()
+    channel.unlink()
+
+
+def test_initial_state(channel):
+    command = channel.read()
+    assert command.sequence == 0
+    assert command.alive == UNKNOWN
+    assert (command.throttle, command.yaw, command.pitch,
+            command.roll) == (1000, 1500, 1500, 1500)
+
+
+def test_write_merges_the_keys(channel):
+    channel.write(alive=True, command={"throttle": 1400, "roll": 1600})
+    channel.write(command={"yaw": 1200})
+    command = channel.read()
+    assert command.sequence == 2
+    assert command.alive == ALIVE
+    assert (command.throttle, command.yaw, command.pitch,
+            command.roll) == (1400, 1200, 1500, 1600)
+    channel.write(alive=False)
+    assert channel.read().alive == NOT_ALIVE
+
+
+@pytest.mark.parametrize("value", [999, 2001, 40000, -40000, None,
+                                   float("inf"), float("nan"), "high"])
+def test_out_of_range_value_is_rejected(channel, value):
+    channel.write(alive=True, command={"throttle": 1300})
+    with pytest.raises(ValueError):
+        channel.write(alive=False, command={"yaw": 1700, "throttle": value})
+    command = channel.read()
+    assert command.sequence == 1
+    assert command.alive == ALIVE
+    assert command.throttle == 1300
+    assert command.yaw == 1500
+    # The rejected message did not stay in the state of the channel.
+    channel.write(command={"pitch": 1550})
+    command = channel.read()
+    assert (command.throttle, command.yaw, command.pitch) == (1300, 1500,
+                                                              1550)
+
+
+def test_range_limits_are_accepted(channel):
+    channel.write(command={"throttle": 1000, "yaw": 2000})
+    command = channel.read()
+    assert (command.throttle, command.yaw) == (1000, 2000)
@@ -0,0 +1,107 @@
+import random
+
+import pytest
+
+from drone.flight_controller.mixer import FRAMES, Mixer
+
+
+def old_mix(throttle, roll, pitch, yaw):
+    """The quad_x mix FlightController had written out before Mixer."""
+    return [int(throttle + roll + pitch - yaw),
+            int(throttle - roll + pitch + yaw),
+            int(throttle - roll - pitch - yaw),
+            int(throttle + roll - pitch + yaw)]
+
+
+def test_quad_x_matrix_is_the_old_mix():
+    assert Mixer("quad_x").matrix == ((1.0, 1.0, -1.0), (-1.0, 1.0, 1.0),
+                                      (-1.0, -1.0, -1.0), (1.0, -1.0, 1.0))
+
+
+def test_quad_x_pulses_are_the_old_mix():
+    mixer = Mixer("quad_x", airmode=False)
+    pulses = [0] * 4
+    rng = random.Random(0)
+    for _ in range(10000):
+        throttle = rng.uniform(1000, 2000)
+        roll, pitch, yaw = (rng.uniform(-300, 300) for _ in range(3))
+        mixer.mix(throttle, roll, pitch, yaw, pulses)
+        assert pulses == old_mix(throttle, roll, pitch, yaw)
+
+
+def test_airmode_keeps_the_old_mix_within_the_range():
+    mixer = Mixer("quad_x")
+    pulses = [0] * 4
+    mixer.mix(1400, 50.0, -30.0, 20.0, pulses)
+    assert pulses == old_mix(1400, 50.0, -30.0, 20.0)
+    assert mixer.saturations == 0
+
+
+def test_quad_plus_matrix():
+    assert Mixer("quad_plus").matrix == ((0.0, 1.0, -1.0), (-1.0, 0.0, 1.0),
+                                         (0.0, -1.0, -1.0), (1.0, 0.0, 1.0))
+
+
+def test_hexa_matrix():
+    assert Mixer("hexa").matrix == ((0.5, 1.0, -1.0), (-0.5, 1.0, 1.0),
+                                    (-1.0, 0.0, -1.0), (-0.5, -1.0, 1.0),
+                                    (0.5, -1.0, -1.0), (1.0, 0.0, 1.0))
+
+
+@pytest.mark.parametrize("frame", sorted(FRAMES))
+def test_matrix_is_balanced(frame):
+    matrix = Mixer(frame).matrix
+    assert len(matrix) == len(FRAMES[frame])
+    for axis in range(3):
+        column = [row[axis] for row in matrix]
+        assert abs(sum(column)) < 1e-9
+        assert max(abs(value) for value in column) == 1.0
+    # Left motors take a positive roll and back motors a positive pitch.
+    for (angle, direction), (roll, pitch, yaw) in zip(FRAMES[frame], matrix):
+        assert (roll > 0) == (0 < angle < 180) or roll == 0
+        assert (pitch > 0) == (90 < angle < 270) or pitch == 0
+        assert yaw == direction
+
+
+def test_airmode_raises_the_throttle_for_the_corrections():
+    mixer = Mixer("quad_x")
+    pulses = [0] * 4
+    mixer.mix(1000, 100.0, 0.0, 0.0, pulses)
+    assert min(pulses) == 1000
+    assert pulses == [1200, 1000, 1000, 1200]
+    assert mixer.saturations == 1
+
+
+def test_airmode_gives_up_yaw_before_roll():
+    mixer = Mixer("quad_x")
+    pulses = [0] * 4
+    mixer.mix(1450, 400.0, 0.0, 300.0, pulses)
+    assert min(pulses) >= 1000 and max(pulses) <= 1900
+    # The whole roll is kept, so the left motors are 800 above the right.
+    assert pulses[0] + pulses[3] - pulses[1] - pulses[2] == 1600
+    # The remaining room is used for yaw.
+    assert pulses[1] > pulses[2] and pulses[3] > pulses[0]
+
+
+def test_airmode_scales_roll_and_pitch_that_do_not_fit():
+    mixer = Mixer("quad_x")
+    pulses = [0] * 4
+    mixer.mix(1450, 1000.0, 500.0, 200.0, pulses)
+    assert min(pulses) == 1000 and max(pulses) == 1900
+    # Scaled together, roll stays twice pitch and yaw is dropped.
+    roll = (pulses[0] + pulses[3] - pulses[1] - pulses[2]) / 4
+    pitch = (pulses[0] + pulses[1] - pulses[2] - pulses[3]) / 4
+    yaw = (pulses[1] + pulses[3] - pulses[0] - pulses[2]) / 4
+    assert roll == pytest.approx(2 * pitch, abs=1)
+    assert yaw == pytest.approx(0, abs=1)
+
+
+@pytest.mark.parametrize("frame", sorted(FRAMES))
+def test_airmode_keeps_every_frame_in_range(frame):
+    mixer = Mixer(frame)
+    pulses = [0] * mixer.motors
+    rng = random.Random(1)
+    for _ in range(2000):
+        mixer.mix(rng.uniform(900, 2100), rng.uniform(-1000, 1000),
+                  rng.uniform(-1000, 1000), rng.uniform(-1000, 1000), pulses)
+        assert min(pulses) >= 1000 and max(pulses) <= 1900
@@ -0,0 +1,64 @@
+import struct
+
+import pytest
+
+from drone.flight_controller.seqlock import SeqlockBlock
+
+
+@pytest.fixture
+def block():
+    block = SeqlockBlock("<Qhd", create=True)
+    yield block
+    block.close()
+    block.unlink()
+
+
+def test_read_returns_the_latest_write(block):
+    block.write(1, -2, 3.5)
+    block.write(2, 7, 0.25)
+    assert block.read() == (2, 7, 0.25)
+
+
+def test_reader_attached_by_name_reads_the_writes(block):
+    reader = SeqlockBlock("<Qhd", name=block.name)
+    try:
+        block.write(5, 6, 7.0)
+        assert reader.read() == (5, 6, 7.0)
+    finally:
+        reader.close()
+
+
+def test_failed_write_keeps_the_previous_record(block):
+    block.write(1, 2, 3.0)
+    with pytest.raises(struct.error):
+        block.write(2, 40000, 4.0)
+    counter = struct.unpack_from("<Q", block._buffer, 0)[0]
+    assert counter % 2 == 0
+    assert block.read() == (1, 2, 3.0)
+    assert block.stale_reads == 0
+    block.write(3, 4, 5.0)
+    assert block.read() == (3, 4, 5.0)
+
+
+def test_dead_writer_gives_stale_record(block):
+    block.write(1, 2, 3.0)
+    reader = SeqlockBlock("<Qhd", name=block.name, read_timeout=0.001)
+    try:
+        assert reader.read() == (1, 2, 3.0)
+        # A writer that died in the middle of a write leaves it odd.
+        struct.pack_into("<Q", block._buffer, 0, 3)
+        assert reader.read() == (1, 2, 3.0)
+        assert reader.read() == (1, 2, 3.0)
+        assert reader.stale_reads == 2
+    finally:
+        reader.close()
+
+
+def test_dead_writer_before_any_read_raises(block):
+    struct.pack_into("<Q", block._buffer, 0, 1)
+    reader = SeqlockBlock("<Qhd", name=block.name, read_timeout=0.001)
+    try:
+        with pytest.raises(RuntimeError):
+            reader.read()
+    finally:
+        reader.close()
@@ -0,0 +1,49 @@
+from drone.simulation.tuner import DURATION, STEPS, score_flight
+
+
+def _history(response=1.0, roll_offset=0.0, motor_commands=(1500,) * 4,
+             interval=0.01):
+    """History of a flight that follows the steps with the given share of
+    each target."""
+    history = []
+    targets = {"roll": 0.0, "pitch": 0.0, "yaw": 0.0}
+    yaw = 0.0
+    steps = list(STEPS)
+    for i in range(int(DURATION / interval) + 1):
+        t = i * interval
+        while steps and steps[0][0] <= t:
+            _, axis, target = steps.pop(0)
+            targets[axis] = target
+        yaw += response * targets["yaw"] * interval
+        history.append({"time": t,
+                        "roll": response * targets["roll"] + roll_offset,
+                        "pitch": response * targets["pitch"],
+                        "yaw": (yaw + 180) % 360 - 180,
+                        "motor_commands": list(motor_commands)})
+    return history
+
+
+def test_perfect_flight_scores_zero():
+    result = score_flight(_history())
+    assert not result.get("failed")
+    assert len(result["steps"]) == len(STEPS)
+    assert result["score"] < 0.05
+    assert result["saturation"] == 0.0
+
+
+def test_sluggish_flight_scores_worse():
+    assert (score_flight(_history(response=0.5))["score"]
+            > score_flight(_history())["score"] + 1.0)
+
+
+def test_saturated_flight_scores_worse():
+    result = score_flight(_history(motor_commands=(1000, 1900, 1500, 1500)),
+                          saturation_weight=5.0)
+    assert result["saturation"] == 1.0
+    assert result["score"] >= 5.0
+
+
+def test_tilted_flight_fails():
+    result = score_flight(_history(roll_offset=60.0))
+    assert result["failed"]
+    assert result["score"] >= 1000.0
@@ -0,0 +1,119 @@
+"""Static assets of the control UI, cached in memory.
+
+The access point link is weak and shared with the control traffic, so the
+assets are read once at startup and kept compressed with gzip, and with
+brotli if the brotli package is installed. Each asset has a strong ETag from
+the hash of its content, so a client revalidating it gets a 304 without the
+body.
+
+The stylesheets and scripts are referenced from index.html with their hash
+in the query string, e.g. static/index.js?v=1f2e3d4c5b6a7980. They can
+therefore be cached by the client for a year: a changed file gets a new URL.
+index.html itself is always revalidated, which costs one round trip and no
+body when nothing has changed.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from collections import namedtuple
+
+
+# Cache lifetime in seconds of the assets referenced with their hash.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Links to the other assets in the pages, e.g. href="static/index.css".
+_LINK = re.compile(r'((?:href|src)=")static/([^"?]+)(")')
+
+Asset = namedtuple("Asset", ["content_type", "etag", "bodies"])
+Asset.__doc__ = """An asset held in memory.
+
+content_type : str
+etag : str
+    Hash of the uncompressed content, without quotes.
+bodies : dict
+    The content by content coding: "identity", "gzip" and, if the brotli
+    package is installed, "br". A compressed body is only kept if it is
+    smaller.
+"""
+
+
+class AssetCache:
+    """The assets of a directory in memory, see the module docstring."""
+
+    def __init__(self, directory, pages=("index.html",)):
+        """Read and compress the assets.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the assets, not including subdirectories.
+        pages : sequence of str (default ("index.html",))
+            Assets whose links to the other assets are versioned with their
+            hashes. These are always revalidated.
+        """
+        self.directory = directory
+        self.pages = frozenset(pages)
+        self._assets = {}
+        contents = {}
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    contents[filename] = f.read()
+        for filename, content in contents.items():
+            if filename not in self.pages:
+                self._assets[filename] = self._make_asset(filename, content)
+        for filename in self.pages & contents.keys():
+            content = _LINK.sub(self._versioned_link,
+                                contents[filename].decode("utf-8"))
+            self._assets[filename] = self._make_asset(filename,
+                                                      content.encode("utf-8"))
+
+    def get(self, filename):
+        """Get an asset.
+
+        Returns
+        -------
+        Asset or None
+            None if there is no such asset.
+        """
+        return self._assets.get(filename)
+
+    def url(self, filename):
+        """Get the versioned URL of an asset, relative to the page."""
+        return "static/{}?v={}".format(filename, self._assets[filename].etag)
+
+    def max_age(self, filename):
+        """Get how long a client may cache an asset, in seconds."""
+        return 0 if filename in self.pages else IMMUTABLE_MAX_AGE
+
+    def _versioned_link(self, match):
+        filename = match.group(2)
+        if filename not in self._assets:
+            return match.group(0)
+        return match.group(1) + self.url(filename) + match.group(3)
+
+    @staticmethod
+    def _make_asset(filename, content):
+        content_type, _ = mimetypes.guess_type(filename)
+        if content_type is None:
+            content_type = "application/octet-stream"
+        elif content_type.startswith("text/") \
+                or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        bodies = {"identity": content}
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            bodies["gzip"] = compressed
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < len(content):
+                bodies["br"] = compressed
+        etag = hashlib.sha256(content).hexdigest()[:16]
+        return Asset(content_type, etag, bodies)
@@ -1,37 +1,204 @@
-from flask import Flask, render_template, send_file, request, make_response
+from flask import Flask, Response, abort, request, make_response
+from flask_sock import Sock
+import json
 import os
-import multiprocessing as mp
+import struct
+import time
+from math import isnan
+
+from drone.flight_controller.command_channel import (MAX_VALUE, MIN_VALUE,
+                                                     CommandChannel)
+from drone.flight_controller.metrics import LoopMetrics, format_prometheus
+from drone.flight_controller.telemetry import TelemetryChannel
+from drone.web.assets import AssetCache
 
 
 _DIRPATH = os.path.dirname(os.path.abspath(__file__))
 
 
-APP = Flask("__main__", template_folder=os.path.join(_DIRPATH, "static"))
-APP.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+APP = Flask("__main__", static_folder=None)
+SOCK = Sock(APP)
+
+ASSETS = AssetCache(os.path.join(_DIRPATH, "static"))
+
+
+# Set to a CommandChannel, a TelemetryChannel and LoopMetrics before the
+# server is started.
+CHANNEL = None
+TELEMETRY = None
+METRICS = None
+
+# Telemetry rates a client can ask for, in Hz.
+TELEMETRY_DEFAULT_RATE = 10.0
+TELEMETRY_MAX_RATE = 50.0
+
+# Binary control frame sent by the client over the /control WebSocket:
+# sequence number, client timestamp in ms, alive flag (0 or 1) and the
+# throttle, yaw, pitch and roll stick values in range 1000-2000.
+CONTROL_FRAME = struct.Struct("<IdB4H")
 
 
-QUEUE = mp.Queue()
+def _is_valid(alive, command):
+    """Check a message of a client before it is written to CHANNEL.
+
+    Parameters
+    ----------
+    alive : bool, int or None
+        Needs to be 0 or 1, or None if the message does not say.
+    command : dict or None
+        The throttle, yaw, pitch and roll in it need to be numbers in range
+        1000-2000, see CommandChannel.write.
+    """
+    if alive is not None and alive not in (0, 1):
+        return False
+    if command is None:
+        return True
+    if not isinstance(command, dict):
+        return False
+    for key in ("throttle", "yaw", "pitch", "roll"):
+        if key in command:
+            value = command[key]
+            if (not isinstance(value, (int, float)) or isinstance(value, bool)
+                    or not MIN_VALUE <= value <= MAX_VALUE):
+                return False
+    return True
+
+
+def _send_asset(filename):
+    """Send an asset from ASSETS in the best encoding the client accepts.
+
+    Answers with 304 and no body if the client has it already, see
+    drone.web.assets.
+    """
+    asset = ASSETS.get(filename)
+    if asset is None:
+        abort(404)
+    coding = request.accept_encodings.best_match(
+        [coding for coding in ("br", "gzip") if coding in asset.bodies],
+        default="identity")
+    response = Response(asset.bodies[coding], content_type=asset.content_type)
+    if coding == "identity":
+        response.set_etag(asset.etag)
+    else:
+        response.content_encoding = coding
+        response.set_etag("{}-{}".format(asset.etag, coding))
+    response.vary.add("Accept-Encoding")
+    max_age = ASSETS.max_age(filename)
+    if max_age:
+        response.headers["Cache-Control"] = \
+            "public, max-age={}, immutable".format(max_age)
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 
 @APP.route("/")
 def index():
-    return render_template("index.html")
+    return _send_asset("index.html")
 
 
 @APP.route("/static/<string:filename>")
 def static_file(filename):
-    filepath = os.path.join(_DIRPATH, "static", filename)
-    if os.path.exists(filepath):
-        return send_file(filepath)
+    return _send_asset(filename)
 
 
 @APP.route("/api", methods=["POST"])
 def alive():
-    body = request.get_json()
+    body = request.get_json(silent=True)
     print(body)
-    QUEUE.put(body)
+    if not isinstance(body, dict) \
+            or not _is_valid(body.get("alive"), body.get("command")):
+        abort(400)
+    CHANNEL.write(alive=body.get("alive"), command=body.get("command"))
     return make_response()
 
 
+@SOCK.route("/control")
+def control(ws):
+    """Receive control frames and forward the newest state to the channel.
+
+    The client sends the whole state of the sticks at a fixed rate. If frames
+    have queued up, e.g. after a stall of the access point, only the newest
+    one is forwarded. Frames that are not newer than the previous forwarded
+    one are dropped, and so are frames with values out of range.
+    """
+    previous_sequence = 0
+    while True:
+        frame = ws.receive()
+        while True:
+            newer = ws.receive(timeout=0)
+            if newer is None:
+                break
+            frame = newer
+        if not isinstance(frame, bytes) or len(frame) != CONTROL_FRAME.size:
+            continue
+        sequence, _, alive, throttle, yaw, pitch, roll = \
+            CONTROL_FRAME.unpack(frame)
+        command = {"throttle": throttle, "yaw": yaw, "pitch": pitch,
+                   "roll": roll}
+        if sequence <= previous_sequence or not _is_valid(alive, command):
+            continue
+        previous_sequence = sequence
+        CHANNEL.write(alive=alive == 1, command=command)
+
+
+@APP.route("/telemetry")
+def telemetry():
+    """Stream the telemetry as server-sent events.
+
+    Every client gets its own stream at the rate it asks for with the rate
+    query parameter, capped to TELEMETRY_MAX_RATE. A snapshot is sent only if
+    the flight controller has published a new one since the previous event.
+    A slow client only holds up its own stream, the flight controller never
+    waits for the server.
+    """
+    rate = request.args.get("rate", TELEMETRY_DEFAULT_RATE, type=float)
+    interval = 1.0 / min(max(rate, 0.1), TELEMETRY_MAX_RATE)
+
+    def stream():
+        previous_sequence = None
+        next_time = time.monotonic()
+        while True:
+            snapshot = TELEMETRY.read()
+            if snapshot.sequence != previous_sequence:
+                previous_sequence = snapshot.sequence
+                # JSON has no NaN, e.g. for a battery that is not measured.
+                data = {key: None if isinstance(value, float) and isnan(value)
+                        else value
+                        for key, value in snapshot._asdict().items()}
+                yield "data: {}\n\n".format(json.dumps(data))
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Skip the events the client was too slow to take.
+                next_time = time.monotonic()
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+@APP.route("/metrics")
+def metrics():
+    """Expose the metrics of the flight loop in the Prometheus text format.
+
+    See drone.flight_controller.metrics for the metrics.
+    """
+    return Response(format_prometheus(METRICS.read(), CHANNEL.read().sequence),
+                    mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
-    APP.run("0.0.0.0", 5000)
+    CHANNEL = CommandChannel(create=True)
+    TELEMETRY = TelemetryChannel(create=True)
+    METRICS = LoopMetrics(create=True)
+    try:
+        APP.run("0.0.0.0", 5000)
+    finally:
+        CHANNEL.close()
+        CHANNEL.unlink()
+        TELEMETRY.close()
+        TELEMETRY.unlink()
+        METRICS.close()
+        METRICS.unlink()
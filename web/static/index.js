@@ -10,41 +10,102 @@ var rightY = null;
 
 
 var connectionIntervalId = null;
+var socket = null;
+var sequence = 0;
+
+// Control frames are sent at a fixed rate. Every frame carries the whole
+// state of the sticks, so it doubles as the heartbeat.
+var frameInterval = 20;  // ms
+// The HTTP fallback is much slower per message, so it sends less often.
+var fallbackInterval = 100;  // ms
+
+// Little-endian uint32 sequence number, float64 timestamp in ms, uint8 alive
+// and uint16 throttle, yaw, pitch and roll. See CONTROL_FRAME in server.py.
+var frameSize = 21;
+
+
+var sendFrame = function(alive){
+    var frame = new DataView(new ArrayBuffer(frameSize));
+    sequence += 1;
+    frame.setUint32(0, sequence, true);
+    frame.setFloat64(4, performance.now(), true);
+    frame.setUint8(12, alive ? 1 : 0);
+    frame.setUint16(13, throttle, true);
+    frame.setUint16(15, yaw, true);
+    frame.setUint16(17, pitch, true);
+    frame.setUint16(19, roll, true);
+    socket.send(frame.buffer);
+}
 
 
-var disconnect = function(e){
-    clearInterval(connectionIntervalId);
+// The whole state over HTTP, for the fallback and for disconnecting without
+// an open socket.
+var postState = function(alive){
     fetch(
         '/api',
         {
             method: 'POST',
-            body: JSON.stringify({"alive": false}),
+            body: JSON.stringify({
+                "alive": alive,
+                "command": {
+                    "throttle": throttle,
+                    "yaw": yaw,
+                    "pitch": pitch,
+                    "roll": roll
+                }
+            }),
             cache: 'no-cache',
             headers: new Headers({
                 'content-type': 'application/json'
             })
         }
     );
+}
+
+
+var disconnect = function(e){
+    clearInterval(connectionIntervalId);
+    if (socket !== null && socket.readyState === WebSocket.OPEN) {
+        sendFrame(false);
+        socket.close();
+    } else {
+        postState(false);
+    }
+    socket = null;
     e.innerText = "Disconnected";
 }
 
 
+var connectWithHttp = function(){
+    clearInterval(connectionIntervalId);
+    socket = null;
+    connectionIntervalId = setInterval(function(){
+        postState(true);
+    }, fallbackInterval);
+}
+
+
 var connect = function(e){
     e.innerText = "Disconnect";
-    e.onclick = disconnect;
-    connectionIntervalId = setInterval(function(){
-        fetch(
-                '/api',
-                {
-                    method: 'POST',
-                    body: JSON.stringify({"alive": true}),
-                    cache: 'no-cache',
-                    headers: new Headers({
-                        'content-type': 'application/json'
-                    })
-                }
-            );
-    }, 1000);
+    e.onclick = function(){ disconnect(e); };
+    if (!("WebSocket" in window)) {
+        connectWithHttp();
+        return;
+    }
+    var scheme = location.protocol === "https:" ? "wss://" : "ws://";
+    socket = new WebSocket(scheme + location.host + "/control");
+    socket.binaryType = "arraybuffer";
+    socket.onopen = function(){
+        connectionIntervalId = setInterval(function(){
+            sendFrame(true);
+        }, frameInterval);
+    };
+    socket.onclose = function(){
+        // Keep the drone alive over HTTP if the socket breaks mid-flight.
+        if (socket !== null) {
+            connectWithHttp();
+        }
+    };
 }
 
 
@@ -77,22 +138,6 @@ lc.addEventListener("touchend", e => {
     lctx.stroke();
     throttle = throttle < 1500 ? throttle : 1500;
     yaw = 1500;
-    fetch(
-        '/api',
-        {
-            method: 'POST',
-            body: JSON.stringify({
-                'command' : {
-                    'throttle': throttle,
-                    'yaw': yaw
-                }
-            }),
-            cache: 'no-cache',
-            headers: new Headers({
-                'content-type': 'application/json'
-            })
-        }
-    );
 });
 
 lc.addEventListener("touchmove", e => {
@@ -117,25 +162,8 @@ lc.addEventListener("touchmove", e => {
         lctx.beginPath();
         lctx.arc(leftX, leftY, 50, 0, 2 * Math.PI);
         lctx.stroke();
-        console.log(leftX);
         throttle = Math.round(2000 - leftY * 1000 / coords.height);
         yaw = Math.round(1000 + leftX * 1000 / coords.width);
-        fetch(
-            '/api',
-            {
-                method: 'POST',
-                body: JSON.stringify({
-                    'command' : {
-                        'throttle': throttle,
-                        'yaw': yaw
-                    }
-                }),
-                cache: 'no-cache',
-                headers: new Headers({
-                    'content-type': 'application/json'
-                })
-            }
-        );
     }
 });
 
@@ -153,22 +181,6 @@ rc.addEventListener("touchend", e => {
     rctx.stroke();
     pitch = 1500;
     roll = 1500;
-    fetch(
-        '/api',
-        {
-            method: 'POST',
-            body: JSON.stringify({
-                'command': {
-                    'pitch': pitch,
-                    'roll': roll
-                }
-            }),
-            cache: 'no-cache',
-            headers: new Headers({
-                'content-type': 'application/json'
-            })
-        }
-    );
 });
 
 rc.addEventListener("touchmove", e => {
@@ -195,21 +207,34 @@ rc.addEventListener("touchmove", e => {
         rctx.stroke();
         pitch = Math.round(2000 - rightY * 1000 / coords.height);
         roll = Math.round(1000 + rightX * 1000 / coords.width);
-        fetch(
-            '/api',
-            {
-                method: 'POST',
-                body: JSON.stringify({
-                    'command': {
-                        'pitch': pitch,
-                        'roll': roll
-                    }
-                }),
-                cache: 'no-cache',
-                headers: new Headers({
-                    'content-type': 'application/json'
-                })
-            }
-        );
     }
 });
+
+
+// Telemetry from the flight controller, as server-sent events at a rate
+// chosen by this client.
+var telemetryRate = 10;  // Hz
+var telemetryTimeoutId = null;
+var telemetryElement = document.getElementById("telemetry");
+
+var formatNumber = function(value, digits){
+    return value === null ? "--" : value.toFixed(digits);
+}
+
+var telemetrySource = new EventSource("/telemetry?rate=" + telemetryRate);
+telemetrySource.onmessage = function(e){
+    var t = JSON.parse(e.data);
+    telemetryElement.innerText =
+        (t.flying ? "FLYING" : "landed") +
+        " yaw " + formatNumber(t.yaw, 1) +
+        " pitch " + formatNumber(t.pitch, 1) +
+        " roll " + formatNumber(t.roll, 1) +
+        " | motors " + t.pulses.join(" ") +
+        " | battery " + formatNumber(t.battery_voltage, 2) + " V" +
+        " | loop " + formatNumber(t.loop_rate, 0) + " Hz" +
+        " (" + t.missed_deadlines + " missed)";
+    clearTimeout(telemetryTimeoutId);
+    telemetryTimeoutId = setTimeout(function(){
+        telemetryElement.innerText = "Telemetry lost";
+    }, 1000);
+};
@@ -2,29 +2,43 @@ import subprocess
 import re
 from time import sleep
 
+from drone.flight_controller.startup import wait_until
+
 
 dhcpcd_conf_lines = ["interface wlan0\n",
                      "static ip_address=192.168.4.1/24\n",
                      "nohook wpa_supplicant\n"]
 
 
-def start_access_point():
+def start_access_point(timeout=30.0):
     """Start the wifi access point.
 
-    Sets up dhcpcd dnsmasq and hostapd.
+    Sets up dhcpcd dnsmasq and hostapd. Each systemctl call returns when its
+    job is done, and in the end hostapd is waited for until it reports that
+    the access point is enabled.
+
+    Parameters
+    ----------
+    timeout : float (default 30.0)
+        Seconds to wait for hostapd at most.
     """
     if not _is_dhcpcd_configured_for_ap():
         with open("/etc/dhcpcd.conf", "a") as f:
             f.writelines(dhcpcd_conf_lines)
-    subprocess.Popen("sudo systemctl restart dhcpcd", shell=True)
-    sleep(1)
-    subprocess.Popen("sudo systemctl start dnsmasq", shell=True)
-    sleep(1)
-    subprocess.Popen("sudo systemctl unmask hostapd", shell=True)
-    sleep(1)
-    subprocess.Popen("sudo systemctl enable hostapd", shell=True)
-    sleep(1)
-    subprocess.Popen("sudo systemctl start hostapd", shell=True)
+    subprocess.run("sudo systemctl restart dhcpcd", shell=True)
+    subprocess.run("sudo systemctl start dnsmasq", shell=True)
+    subprocess.run("sudo systemctl unmask hostapd", shell=True)
+    subprocess.run("sudo systemctl enable hostapd", shell=True)
+    subprocess.run("sudo systemctl start hostapd", shell=True)
+    wait_until(is_access_point_enabled, timeout, interval=0.1,
+               description="hostapd")
+
+
+def is_access_point_enabled():
+    """Check if hostapd reports the access point as enabled."""
+    output = subprocess.run("sudo hostapd_cli -i wlan0 status", shell=True,
+                            stdout=subprocess.PIPE).stdout.decode()
+    return "state=ENABLED" in output
 
 
 def stop_access_point():